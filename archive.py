@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Look up codes in the archive written by run.py --url-archive
+
+    ./archive.py DIR SERVICE CODE...
+    ./archive.py -p PREFIX DIR SERVICE
+"""
+
+import optparse
+import sys
+import time
+
+from tinyback import archive
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] DIR SERVICE [CODE...]")
+
+    parser.add_option("-p", "--prefix", dest="prefix",
+        help="List all codes starting with PREFIX", metavar="PREFIX")
+    parser.add_option("-l", "--limit", dest="limit", type="int",
+        help="List at most N codes", metavar="N")
+    parser.add_option("--compact", dest="compact", action="store_true",
+        help="Merge recent results into the index")
+    parser.add_option("--stats", dest="stats", action="store_true",
+        help="Show the size of the index and of the tail")
+    parser.add_option("-t", "--time", dest="time", action="store_true",
+        help="Show how long each lookup took")
+
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("DIR and SERVICE are required")
+
+    return options, args
+
+def main():
+    options, args = parse_options()
+    archive.configure(args[0])
+    if not archive.exists(args[1]):
+        sys.exit("No archive for service %s" % args[1])
+    store = archive.get(args[1])
+
+    if options.compact:
+        store.compact()
+    if options.stats:
+        codes, tail = store.stats()
+        print "Indexed codes: %i" % codes
+        print "Tail:          %i bytes" % tail
+
+    status = 0
+    for code in args[2:]:
+        start = time.time()
+        url = store.lookup(code)
+        elapsed = (time.time() - start) * 1000
+        if url is None:
+            print "%s not found" % code
+            status = 1
+        else:
+            print "%s|%s" % (code, url)
+        if options.time:
+            print "  %.2f ms" % elapsed
+
+    if options.prefix is not None:
+        start = time.time()
+        results = store.prefix(options.prefix)
+        elapsed = (time.time() - start) * 1000
+        for code, url in results[:options.limit]:
+            print "%s|%s" % (code, url)
+        if options.time:
+            print "  %i codes, %.2f ms" % (len(results), elapsed)
+
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
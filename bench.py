@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Benchmark a Reaper against a local mock URL shortener
+
+The mock server runs in a separate process, so the reported CPU time only
+covers the Reaper.
+"""
+
+import logging
+import multiprocessing
+import optparse
+import os
+import threading
+import time
+
+import tinyback
+from tinyback import mockserver, services, strategy
+
+def parse_options():
+    parser = optparse.OptionParser()
+
+    parser.add_option("-s", "--service", dest="service", default="bitly",
+        help="Imitate service NAME (default: bitly)", metavar="NAME")
+    parser.add_option("-c", "--codes", dest="codes", type="int", default=1000,
+        help="Fetch N codes (default: 1000)", metavar="N")
+    parser.add_option("-a", "--async", dest="concurrency", type="int",
+        help="Keep up to N requests in flight", metavar="N")
+    parser.add_option("-p", "--pipeline", dest="pipeline", type="int",
+        help="Pipeline up to N HEAD requests per connection", metavar="N")
+    parser.add_option("--fetch-strategy", dest="fetch_strategy",
+        default="auto", choices=["auto", "head", "get"],
+        help="Send HEAD or GET requests first, or decide by the pages seen "
+        "(auto, the default)")
+    parser.add_option("-r", "--rate-limit", dest="rate_limit",
+        action="store_true", help="Keep the service's rate limit")
+    parser.add_option("--latency", dest="latency", type="float", default=0,
+        help="Delay each response by SECONDS", metavar="SECONDS")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0,
+        help="Add up to SECONDS of random delay", metavar="SECONDS")
+    parser.add_option("--block-rate", dest="block_rate", type="float",
+        default=0, help="Start a burst of blocked responses with probability P",
+        metavar="P")
+    parser.add_option("--block-burst", dest="block_burst", type="int",
+        default=10, help="Block N requests per burst (default: 10)",
+        metavar="N")
+    parser.add_option("--error-rate", dest="error_rate", type="float",
+        default=0, help="Answer with HTTP 500 with probability P", metavar="P")
+    parser.add_option("--drop-rate", dest="drop_rate", type="float",
+        default=0, help="Drop the connection with probability P", metavar="P")
+    parser.add_option("-d", "--debug", action="store_const", dest="loglevel",
+        const=logging.DEBUG, default=logging.WARNING, help="Enable debug output")
+
+    options, args = parser.parse_args()
+    if args:
+        parser.error("Unexpected argument %s" % args[0])
+
+    return options
+
+def serve(options, conn):
+    faults = mockserver.Faults(options.latency, options.jitter,
+        options.block_rate, options.block_burst, options.error_rate,
+        options.drop_rate)
+    server = mockserver.create(options.service, faults)
+    conn.send(server.url)
+    server.serve_forever()
+
+def timed_service(klass, latencies):
+    lock = threading.Lock()
+
+    def fetch(self, code):
+        start = time.time()
+        try:
+            return klass.fetch(self, code)
+        finally:
+            with lock:
+                latencies.append(time.time() - start)
+
+    return type(klass.__name__, (klass,), {"fetch": fetch})
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    options = parse_options()
+
+    logging.basicConfig(level=options.loglevel,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(options, child_conn))
+    server.daemon = True
+    server.start()
+    url = parent_conn.recv()
+
+    strategy.configure(options.fetch_strategy)
+
+    latencies = []
+    klass = mockserver.mock_service(options.service, url, options.rate_limit)
+    name = "mock-" + options.service
+    services.register(name, timed_service(klass, latencies))
+
+    task = {
+        "id": "bench",
+        "service": name,
+        "generator_type": "chain",
+        "generator_options": {
+            "charset": services.factory(options.service).charset,
+            "count": options.codes,
+            "length": 6,
+            "seed": "bench",
+        },
+    }
+
+    if options.concurrency:
+        reaper = tinyback.AsyncReaper(task, concurrency=options.concurrency)
+    else:
+        reaper = tinyback.Reaper(task, pipeline=options.pipeline)
+
+    cpu = os.times()
+    start = time.time()
+    fileobj = reaper.run()
+    elapsed = time.time() - start
+    cpu = sum(os.times()[0:2]) - sum(cpu[0:2])
+    fileobj.close()
+    server.terminate()
+
+    print "Service:           %s (%s)" % (options.service, url)
+    print "Codes:             %i" % options.codes
+    print "Fetches:           %i" % len(latencies)
+    print "Time:              %.2f s" % elapsed
+    print "Codes/sec:         %.1f" % (options.codes / elapsed)
+    print "Fetch latency p50: %.1f ms" % (percentile(latencies, 0.5) * 1000)
+    print "Fetch latency p99: %.1f ms" % (percentile(latencies, 0.99) * 1000)
+    print "CPU per code:      %.3f ms" % (cpu / options.codes * 1000)
+    for fetch_strategy in strategy.strategies():
+        print "Strategy:          %s" % fetch_strategy.summary()
+
+if __name__ == "__main__":
+    main()
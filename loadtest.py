@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run the run.py worker loop against a local mock tracker and URL shortener
+
+Options after -- are passed on to run.py, e.g.
+
+    ./loadtest.py -s bitly --tasks 50 -- -n 8 -a 4
+
+The mock URL shortener runs in a separate process, the mock tracker in this
+one. When all tasks have been delivered, the throughput and the request
+rates seen by the tracker are reported.
+"""
+
+import logging
+import multiprocessing
+import optparse
+import threading
+import time
+
+import run
+from tinyback import mockserver, mocktracker, services
+
+def parse_options():
+    parser = optparse.OptionParser(usage="%prog [options] [-- run.py options]")
+
+    parser.add_option("-s", "--service", dest="service", default="bitly",
+        help="Imitate service NAME (default: bitly)", metavar="NAME")
+    parser.add_option("-g", "--generator", dest="generator", default="chain",
+        help="Use chain, sequence or list tasks (default: chain)",
+        metavar="TYPE")
+    parser.add_option("--tasks", dest="tasks", type="int", default=20,
+        help="Hand out N tasks (default: 20)", metavar="N")
+    parser.add_option("--codes", dest="codes", type="int", default=500,
+        help="Put N codes into each task (default: 500)", metavar="N")
+    parser.add_option("--length", dest="length", type="int", default=5,
+        help="Use codes with N characters (default: 5)", metavar="N")
+    parser.add_option("--no-batches", dest="batches", action="store_false",
+        default=True, help="Hand out single tasks like older trackers")
+    parser.add_option("--lease", dest="lease", type="int", default=600,
+        help="Hand out tasks again after N seconds (default: 600)",
+        metavar="N")
+    parser.add_option("--latency", dest="latency", type="float", default=0,
+        help="Delay each tracker response by SECONDS", metavar="SECONDS")
+    parser.add_option("--jitter", dest="jitter", type="float", default=0,
+        help="Add up to SECONDS of random delay", metavar="SECONDS")
+    parser.add_option("--conflict-rate", dest="conflict_rate", type="float",
+        default=0, help="Refuse uploads with probability P", metavar="P")
+    parser.add_option("--forbidden-rate", dest="forbidden_rate", type="float",
+        default=0, help="Answer with 403 Forbidden with probability P",
+        metavar="P")
+    parser.add_option("--error-rate", dest="error_rate", type="float",
+        default=0, help="Answer with HTTP 500 with probability P", metavar="P")
+    parser.add_option("-r", "--rate-limit", dest="rate_limit",
+        action="store_true", help="Keep the service's rate limit")
+    parser.add_option("-d", "--debug", action="store_const", dest="loglevel",
+        const=logging.DEBUG, default=logging.WARNING, help="Enable debug output")
+
+    return parser.parse_args()
+
+def serve(service, conn):
+    server = mockserver.create(service)
+    conn.send(server.url)
+    server.serve_forever()
+
+def main():
+    options, run_args = parse_options()
+
+    logging.basicConfig(level=options.loglevel,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    parent_conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(options.service, child_conn))
+    server.daemon = True
+    server.start()
+    url = parent_conn.recv()
+
+    name = "mock-" + options.service
+    services.register(name, mockserver.mock_service(options.service, url, options.rate_limit))
+
+    faults = mocktracker.Faults(options.latency, options.jitter,
+        options.conflict_rate, options.forbidden_rate, options.error_rate)
+    tasks = mocktracker.make_tasks(name, options.generator, options.tasks,
+        options.codes, services.factory(options.service).charset,
+        options.length)
+    tracker = mocktracker.MockTracker(tasks, faults, lease_time=options.lease,
+        batches=options.batches, expected=mockserver.long_url)
+    thread = threading.Thread(target=tracker.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    run_options = run.parse_options(run_args + ["--tracker", tracker.url])
+    if run_options.processes:
+        raise SystemExit("Worker processes can not use the mock service")
+    run.configure(run_options)
+
+    def watch():
+        while not tracker.finished():
+            time.sleep(0.1)
+        run.stopping.set()
+    watcher = threading.Thread(target=watch)
+    watcher.daemon = True
+    watcher.start()
+
+    start = time.time()
+    run.run_threads(run_options, run.tinyback.tracker.Tracker(tracker.url))
+    elapsed = time.time() - start
+    tracker.shutdown()
+    server.terminate()
+
+    print "Service:           %s (%s)" % (options.service, url)
+    print "Threads:           %i" % run_options.num_threads
+    print "Tasks:             %i (%i codes each)" % (tracker.done, options.codes)
+    print "Time:              %.2f s" % elapsed
+    print "Tasks/hour:        %.0f" % (tracker.done / elapsed * 3600)
+    for endpoint in sorted(tracker.requests):
+        count = tracker.requests[endpoint]
+        print "%-18s %i requests, %.2f/s" % (endpoint + ":", count, count / elapsed)
+    for fetch_strategy in run.tinyback.strategy.strategies():
+        print "Strategy:          %s" % fetch_strategy.summary()
+    print "Verification:      %i errors" % len(tracker.errors)
+    for error in tracker.errors:
+        print "  %s" % error
+
+if __name__ == "__main__":
+    main()
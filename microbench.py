@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks for CPU-bound parts of tinyback
+
+Each benchmark compares the current code against the original (reference)
+implementation, checks that both produce the same output and prints the
+throughput of both.
+"""
+
+import HTMLParser
+import hashlib
+import optparse
+import re
+import time
+
+from tinyback import connections, generators, services
+
+CHARSET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def reference_chain_generator(options):
+    """
+    The chain generator as it was originally written
+    """
+    m = 256 - (256 % len(options["charset"]))
+    digest = options["seed"]
+    count = 0
+
+    while count < options["count"]:
+        md5 = hashlib.md5()
+        md5.update(digest)
+        digest = md5.digest()
+
+        code = ""
+        for byte in map(ord, digest):
+            if byte > m:
+                continue
+            code += options["charset"][byte % len(options["charset"])]
+            if len(code) == options["length"]:
+                count += 1
+                yield code
+                break
+
+def reference_sequence_generator(options):
+    """
+    The sequence generator as it was originally written
+    """
+    code = options["start"]
+    yield code
+    while code != options["stop"]:
+        for i in range(len(code) - 1, -1, -1):
+            if code[i] == options["charset"][-1]:
+                code = code[0:i] + options["charset"][0] + code[i+1:len(code)]
+            else:
+                code = code[0:i] + options["charset"][options["charset"].index(code[i]) + 1] + code[i+1:len(code)]
+                yield code
+                break
+        else:
+            code = options["charset"][0] + code
+            yield code
+
+FOOTER = "".join("<li><a href=\"/page/%i\">Related link number %i</a></li>\n" % (i, i) for i in range(100))
+
+# Pages as the services return them, shortened to the parts that matter and
+# padded with the boilerplate that follows them
+SAMPLE_PAGES = [
+    ("isgd preview", services.Isgd, "_preview_rule", "_parser",
+        "<html>\n<head><title>is.gd - preview</title></head>\n<body>\n"
+        "<p>The full original link is shown below. <b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"http://example.com/search?q=tiny&amp;lang=en\" class=\"biglink\">http://example.com/search?q=tiny&amp;lang=en</a></p>\n"
+        + FOOTER + "</body>\n</html>\n"),
+    ("isgd blocked", services.Isgd, "_blocked_rule", "_parser",
+        "<html>\n<head><title>is.gd - link disabled</title></head>\n<body>\n<div id=\"disabled\"><h2>Link Disabled</h2>\n"
+        "<p>For reference and to help those fighting spam the original destination of this URL is given below (we strongly recommend you don't visit it since it may damage your PC): -<br />http://spam.example.com/buy?now=1&amp;cheap=1</p><h2>is.gd</h2><p>is.gd is a free service used to shorten long URLs.</p></div>\n"
+        + FOOTER + "</body>\n</html>\n"),
+    ("owly warning", services.Owly, "_warning_rule", "_parser",
+        "<html>\n<head><title>Ow.ly - Warning</title></head>\n<body>\n"
+        "<p>This link has been flagged as potentially unsafe.</p>\n"
+        "<a class=\"btn ignore\" href=\"http://example.org/files/setup.exe?id=7&amp;ref=owly\" title=\"Ignore\">Proceed anyway</a>\n"
+        + FOOTER + "</body>\n</html>\n"),
+    ("tinyurl redirect", services.Tinyurl, "_tinyurl_redirect_rule", "_parser",
+        "<html>\n<head><title>TinyURL Error</title></head>\n<body>\n<h1>Error: TinyURL redirects to a TinyURL.</h1>\n"
+        "<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site. The URL it redirects to is <a href=\"http://tinyurl.com/abc123?x=1&amp;y=2\">http://tinyurl.com/abc123</a>.</p>\n"
+        + FOOTER + "</body>\n</html>\n"),
+    ("tinyurl preview", services.Tinyurl, "_preview_rule", "_preview_parser",
+        "<html>\n<head><title>TinyURL Preview</title></head>\n<body>\n<p>This TinyURL redirects to:</p>\n"
+        "<a id=\"redirecturl\" href=\"http://example.net/article/2012/11/tiny-urls.html\">Proceed to this site.</a>\n"
+        + FOOTER + "</body>\n</html>\n"),
+    ("snipurl", services.Snipurl, "_preview_rule", "_parser",
+        "<html>\n<head><title>Snipurl</title></head>\n<body>\n"
+        "<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>http://example.com/very/long/path?with=query&amp;and=more</div> <br />\n"
+        + FOOTER + "</body>\n</html>\n"),
+    ("visibli", services.Visibli, "_iframe_rule", "_parser",
+        "<html>\n<head><title>SharedBy</title></head>\n<body>\n"
+        "<iframe id=\"visibli-frame\" src=\"http://example.com/news/story?id=42&amp;src=visibli\"></iframe>\n"
+        + FOOTER + "</body>\n</html>\n"),
+]
+
+def reference_extract(rule, data):
+    """
+    Extract the URL like the services originally did
+    """
+    match = re.search(rule.regex.pattern, data, rule.regex.flags)
+    if not match:
+        return None
+    if not rule.unescape:
+        return match.group(1)
+    url = match.group(1).decode("utf-8")
+    return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+
+def bytes_read(parser, data):
+    """
+    Return how much of data is read until parser has found the URL
+    """
+    size = connections.ConnectionPool.CHUNK_SIZE
+    read = 0
+    while read < len(data):
+        read = min(read + size, len(data))
+        if parser.complete(data[:read]):
+            break
+    return read
+
+def measure(name, function):
+    start = time.time()
+    result = list(function())
+    elapsed = time.time() - start
+    print "%-12s %10i codes %12.0f codes/sec" % (name, len(result), len(result) / elapsed)
+    return result
+
+def bench_chain(count):
+    options = {"charset": CHARSET, "count": count, "length": 6, "seed": "microbench"}
+    reference = measure("reference", lambda: reference_chain_generator(options))
+    current = measure("current", lambda: generators.chain_generator(options))
+
+    def batched():
+        chain = generators.ChainGenerator(options)
+        codes = []
+        while True:
+            batch = chain.batch(10000)
+            if not batch:
+                return codes
+            codes.extend(batch)
+    batched = measure("batched", batched)
+
+    def resumed():
+        chain = generators.ChainGenerator(options)
+        codes = chain.batch(count // 2)
+        return codes + list(generators.ChainGenerator(options, chain.checkpoint()))
+    resumed = measure("checkpoint", resumed)
+
+    return reference == current == batched == resumed
+
+def bench_sequence(count):
+    codec = generators.Codec(CHARSET)
+    stop = codec.decode(codec.encode("0000") + count - 1)
+    options = {"charset": CHARSET, "start": "0000", "stop": stop}
+    reference = measure("reference", lambda: reference_sequence_generator(options))
+    current = measure("current", lambda: generators.sequence_generator(options))
+    return reference == current
+
+def bench_parsers(count):
+    count = max(count // 10, 1)
+    same = True
+    for name, klass, rule_name, parser_name, data in SAMPLE_PAGES:
+        rule = getattr(klass, rule_name)
+        parser = getattr(klass, parser_name)
+        print "%s (%i of %i bytes read):" % (name, bytes_read(parser, data), len(data))
+
+        # Every page leads somewhere else, as it would for different codes
+        pages = [data.replace("http://", "http://%i." % i) for i in xrange(count)]
+
+        def run(extract):
+            start = time.time()
+            result = [extract(rule, page) for page in pages]
+            elapsed = time.time() - start
+            return result, elapsed
+
+        reference, reference_time = run(reference_extract)
+        current, current_time = run(lambda rule, data: rule.extract(data))
+        print "  %-12s %10i pages %12.0f pages/sec" % ("reference", count, count / reference_time)
+        print "  %-12s %10i pages %12.0f pages/sec" % ("current", count, count / current_time)
+        same = same and reference == current and None not in current
+    return same
+
+BENCHMARKS = {
+    "chain": bench_chain,
+    "parsers": bench_parsers,
+    "sequence": bench_sequence,
+}
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark...]")
+    parser.add_option("-n", "--count", dest="count", type="int",
+        default=200000, help="Generate N codes (default: 200000)", metavar="N")
+    options, args = parser.parse_args()
+
+    for name in args or sorted(BENCHMARKS):
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark %s" % name)
+        print "%s:" % name
+        if not BENCHMARKS[name](options.count):
+            print "ERROR: Output differs from reference implementation"
+
+if __name__ == "__main__":
+    main()
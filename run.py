@@ -16,16 +16,31 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import Queue
 import optparse
 import logging
+import multiprocessing
+import multiprocessing.managers
+import os
+import signal
 import sys
 import threading
 import time
 
 import tinyback
+import tinyback.archive
+import tinyback.bgzf
+import tinyback.checkpoint
+import tinyback.connections
+import tinyback.coverage
+import tinyback.ratelimit
+import tinyback.scheduler
+import tinyback.sinks
+import tinyback.spool
+import tinyback.strategy
 import tinyback.tracker
 
-def parse_options():
+def parse_options(args=None):
     parser = optparse.OptionParser()
 
     parser.add_option("-t", "--tracker", dest="tracker",
@@ -35,9 +50,70 @@ def parse_options():
         help="Clear all pending tasks from tracker")
     parser.add_option("-n", "--num-threads", dest="num_threads", type="int",
         default=1, help="Use N threads", metavar="N")
+    parser.add_option("-P", "--processes", dest="processes", type="int",
+        help="Run N worker processes, each with its own threads",
+        metavar="N")
+    parser.add_option("--open-tasks", dest="open_tasks", type="int",
+        help="Work on up to N tasks at once, with all threads sending "
+        "requests for any of them", metavar="N")
+    parser.add_option("--prefetch", dest="prefetch", type="int",
+        help="Lease up to N tasks ahead of time (default: one per thread "
+        "or open task)", metavar="N")
     parser.add_option("-s", "--sleep", dest="sleep", type="int", default=300,
         help="Sleep for N seconds when idle (default: 5 minutes)",
         metavar="N")
+    parser.add_option("-a", "--async", dest="concurrency", type="int",
+        help="Keep up to N requests in flight per task", metavar="N")
+    parser.add_option("-p", "--pipeline", dest="pipeline", type="int",
+        help="Pipeline up to N HEAD requests per connection, where the "
+        "service allows it", metavar="N")
+    parser.add_option("--shards", dest="shards", type="int",
+        help="Split each task into N shards that run in parallel",
+        metavar="N")
+    parser.add_option("--connections", dest="connections", type="int",
+        help="Keep up to N idle connections per host (default: 4)",
+        metavar="N")
+    parser.add_option("--fetch-strategy", dest="fetch_strategy",
+        default="auto", choices=["auto", "head", "get"],
+        help="Look at codes with HEAD or GET requests, or switch to GET for "
+        "services where most codes need the page (auto, the default)")
+    parser.add_option("--compression-level", dest="compression_level",
+        type="int", help="Compress results with level N (default: 6)",
+        metavar="N")
+    parser.add_option("--compression-threads", dest="compression_threads",
+        type="int", help="Compress results in N background threads, 0 to "
+        "compress them in the worker threads (default: 1)", metavar="N")
+    parser.add_option("--rate-state", dest="rate_state",
+        help="Remember learned rate limits in FILE", metavar="FILE")
+    parser.add_option("--checkpoint-dir", dest="checkpoint_dir",
+        help="Save progress of tasks in DIR and resume interrupted tasks "
+        "from there. Running tasks are interrupted when stopping; without "
+        "a checkpoint directory, run.py waits until they are finished",
+        metavar="DIR")
+    parser.add_option("--spool-dir", dest="spool_dir",
+        help="Keep results that could not be uploaded in DIR and upload "
+        "them later", metavar="DIR")
+    parser.add_option("--spool-quota", dest="spool_quota", type="int",
+        help="Keep at most N megabytes of results in the spool",
+        metavar="N")
+    parser.add_option("--sink", dest="sink", default="temp",
+        choices=["temp", "memory", "archive", "stream"],
+        help="Keep results in a temporary file (temp), in memory (memory), "
+        "in the archive directory (archive) or upload them while the task "
+        "is running (stream) (default: temp)", metavar="SINK")
+    parser.add_option("--memory-limit", dest="memory_limit", type="int",
+        default=16, help="Move results larger than N megabytes from memory "
+        "to a temporary file (default: 16)", metavar="N")
+    parser.add_option("--archive-dir", dest="archive_dir",
+        help="Keep results in DIR (with --sink archive)", metavar="DIR")
+    parser.add_option("--url-archive", dest="url_archive",
+        help="Also keep all results in an indexed archive in DIR, see "
+        "archive.py", metavar="DIR")
+    parser.add_option("--coverage-dir", dest="coverage_dir",
+        help="Remember examined codes in DIR and skip codes that earlier "
+        "tasks already examined in chain tasks. Skipped codes are missing "
+        "from the results (unless --url-archive has the URLs), which the "
+        "ArchiveTeam tracker does not accept yet", metavar="DIR")
     parser.add_option("--temp-dir", dest="temp_dir",
         help="Set directory for temporary files to DIR", metavar="DIR")
     parser.add_option("-u", "--username", dest="username",
@@ -45,60 +121,425 @@ def parse_options():
     parser.add_option("-d", "--debug", action="store_const", dest="loglevel",
         const=logging.DEBUG, default=logging.INFO, help="Enable debug output")
 
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(args)
     if args:
         parser.error("Unexpected argument %s" % args[0])
+    if options.open_tasks and options.shards:
+        parser.error("Sharding is not supported with --open-tasks")
+    if options.checkpoint_dir and options.shards:
+        parser.error("Checkpoints are not supported for sharded tasks")
+    if options.checkpoint_dir and options.sink != "temp":
+        parser.error("Checkpoints keep results in the checkpoint directory, "
+            "--sink can not be used")
+    if options.sink == "archive" and not options.archive_dir:
+        parser.error("--sink archive requires --archive-dir")
+    if options.compression_threads is not None and options.compression_threads < 0:
+        parser.error("--compression-threads can not be negative")
+    if options.coverage_dir and options.sink == "stream":
+        parser.error("Streamed results can not report skipped codes, "
+            "--coverage-dir can not be used with --sink stream")
 
     return options
 
-def run_thread(options, tracker):
-    log = logging.getLogger("run_thread")
-    while True:
-        try:
-            task = tracker.fetch()
-        except:
-            log.info("Error contacting tracker - Sleeping for 60 seconds")
-            time.sleep(60)
-            continue
+stopping = threading.Event()
+
+class SharedState(multiprocessing.managers.BaseManager):
+    """
+    Supervisor process serving the state shared by all worker processes
+    """
+
+SharedState.register("Registry", tinyback.ratelimit.Registry,
+    exposed=["call", "call_circuit", "load", "save"])
+SharedState.register("Tracker", tinyback.tracker.Tracker,
+    exposed=["clear", "fetch", "fetch_many"])
+
+class WorkerTracker:
+    """
+    Tracker client for worker processes
+
+    Tasks are fetched through the tracker client shared by all workers,
+    results are uploaded directly.
+    """
+
+    def __init__(self, shared_tracker, tracker_url):
+        self._shared_tracker = shared_tracker
+        self._tracker = tinyback.tracker.Tracker(tracker_url)
+
+    def fetch(self):
+        return self._shared_tracker.fetch()
+
+    def fetch_many(self, count):
+        return self._shared_tracker.fetch_many(count)
+
+    def put(self, task, data_file, username=None):
+        return self._tracker.put(task, data_file, username)
+
+    def put_stream(self, task, username=None):
+        return self._tracker.put_stream(task, username)
+
+def resume_task(options):
+    """
+    Claim an interrupted task from the checkpoint directory
+    """
+    for checkpoint in tinyback.checkpoint.pending(options.checkpoint_dir):
+        if checkpoint.claim():
+            return checkpoint
+    return None
+
+class TaskFeeder(threading.Thread):
+    """
+    Fetches tasks ahead of time
+
+    Up to size tasks are kept waiting, so worker threads can start on their
+    next task as soon as the current one is done. Tasks are leased in
+    batches; tasks whose lease has expired while waiting are dropped, since
+    the tracker has handed them out again.
+    """
+
+    def __init__(self, tracker, size, sleep):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._log = logging.getLogger("TaskFeeder")
+        self._tracker = tracker
+        self._sleep = sleep
+        self._tasks = Queue.Queue(size)
+
+    def get(self):
+        """
+        Return the next task, or None once the process is stopping
+        """
+        while not stopping.is_set():
+            try:
+                task, expires = self._tasks.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if expires is not None and time.time() >= expires:
+                self._log.info("Lease for task %s has expired, dropping it" % task["id"])
+                continue
+            return task
+        return None
+
+    def run(self):
+        backoff = tinyback.tracker.Backoff()
+        while not stopping.is_set():
+            if self._tasks.full():
+                stopping.wait(0.5)
+                continue
 
-        if not task:
-            log.debug("Sleeping for %i seconds" % options.sleep)
-            time.sleep(options.sleep)
-        else:
-            reaper = tinyback.Reaper(task)
-            fileobj = reaper.run(options.temp_dir)
             try:
-                tracker.put(task, fileobj, options.username)
+                tasks, expires = self._tracker.fetch_many(self._tasks.maxsize - self._tasks.qsize())
             except:
-                time.sleep(60)
-                log.info("Error contacting tracker - Sleeping for 60 seconds")
+                wait = backoff.failure()
+                self._log.info("Error contacting tracker - Sleeping for %i seconds" % wait)
+                stopping.wait(wait)
                 continue
+            backoff.reset()
+
+            if tasks:
+                for task in tasks:
+                    self._tasks.put((task, expires))
+            else:
+                self._log.debug("Sleeping for %i seconds" % self._sleep)
+                stopping.wait(self._sleep)
+
+class Uploader(threading.Thread):
+    """
+    Uploads results to the tracker in the background
+
+    Failed uploads are moved to the spool, if there is one. Otherwise (or
+    if the spool is full), they are retried with exponential backoff.
+    Worker threads block when size results are already waiting for upload.
+    """
+
+    def __init__(self, tracker, username, size, spool=None, sender=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._log = logging.getLogger("Uploader")
+        self._tracker = tracker
+        self._username = username
+        self._results = Queue.Queue(size)
+        self._spool = spool
+        self._sender = sender
+
+    def put(self, task, fileobj, checkpoint=None):
+        """
+        Queue the results of a task for upload
+        """
+        self._results.put((task, fileobj, checkpoint))
+
+    def finish(self):
+        """
+        Upload all queued results and stop
+        """
+        self._results.put(None)
+        while self.is_alive():
+            self.join(1)
+
+    def run(self):
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            task, fileobj, checkpoint = item
+            try:
+                self._upload(task, fileobj, checkpoint)
+            except:
+                # Keep going, workers block once the queue is full
+                self._log.exception("Error uploading task %s" % task["id"])
             finally:
                 fileobj.close()
 
-def main():
-    options = parse_options()
+    def _upload(self, task, fileobj, checkpoint):
+        backoff = tinyback.tracker.Backoff()
+        while True:
+            try:
+                self._tracker.put(task, fileobj, self._username)
+            except:
+                if self._spool and self._add_to_spool(task, fileobj):
+                    break
+                if stopping.is_set():
+                    if checkpoint:
+                        self._log.warn("Could not upload task %s, leaving it for the next run" % task["id"])
+                    else:
+                        self._log.warn("Could not upload task %s, results are lost" % task["id"])
+                    return
+                wait = backoff.failure()
+                self._log.info("Error contacting tracker - Sleeping for %i seconds" % wait)
+                stopping.wait(wait)
+                continue
+            break
+        if checkpoint:
+            checkpoint.remove()
 
-    logging.basicConfig(level=options.loglevel,
-        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    def _add_to_spool(self, task, fileobj):
+        try:
+            self._spool.add(task, fileobj)
+        except tinyback.exceptions.SpoolFullException:
+            self._log.warn("Spool is full, retrying upload of task %s" % task["id"])
+            return False
+        except (IOError, OSError), e:
+            self._log.warn("Could not spool task %s: %s" % (task["id"], e))
+            return False
+        self._sender.notify()
+        return True
 
-    tracker = tinyback.tracker.Tracker(options.tracker)
-    if options.clear:
-        tracker.clear()
+def create_sink(options, tracker):
+    memory_limit = options.memory_limit * 1024 * 1024
+    if options.sink == "memory":
+        return tinyback.sinks.MemorySink(memory_limit, options.temp_dir)
+    elif options.sink == "archive":
+        return tinyback.sinks.ArchiveSink(options.archive_dir)
+    elif options.sink == "stream":
+        return tinyback.sinks.StreamSink(tracker, options.username, memory_limit, options.temp_dir)
+    return tinyback.sinks.TemporaryFileSink(options.temp_dir)
+
+def next_task(options, feeder):
+    """
+    Return the next task to work on and its checkpoint, or None and None
+
+    Interrupted tasks from the checkpoint directory come first.
+    """
+    log = logging.getLogger("next_task")
+    checkpoint = None
+    if options.checkpoint_dir:
+        checkpoint = resume_task(options)
 
-    if options.num_threads == 1:
-        run_thread(options, tracker)
+    if checkpoint:
+        task = checkpoint.task
+        log.info("Resuming task %s for service %s" % (task["id"], task["service"]))
+        return task, checkpoint
+
+    task = feeder.get()
+    if not task:
+        return None, None
+
+    if options.checkpoint_dir:
+        checkpoint = tinyback.checkpoint.Checkpoint(options.checkpoint_dir, task)
+        if not checkpoint.claim():
+            log.info("Task %s is already running" % task["id"])
+            return None, None
+    return task, checkpoint
+
+def deliver(task, reaper, fileobj, checkpoint, uploader):
+    """
+    Hand the results of a finished task to the uploader
+    """
+    if reaper.codes_skipped:
+        task = dict(task, skipped=reaper.codes_skipped)
+    if fileobj:
+        uploader.put(task, fileobj, checkpoint)
+
+def run_thread(options, tracker, feeder, uploader):
+    while not stopping.is_set():
+        task, checkpoint = next_task(options, feeder)
+        if not task:
+            continue
+
+        if options.shards:
+            reaper = tinyback.ShardedReaper(task, options.shards, pipeline=options.pipeline)
+        elif options.concurrency:
+            reaper = tinyback.AsyncReaper(task, concurrency=options.concurrency, checkpoint=checkpoint, stop=stopping)
+        else:
+            reaper = tinyback.Reaper(task, pipeline=options.pipeline, checkpoint=checkpoint, stop=stopping)
+        fileobj = reaper.run(options.temp_dir, create_sink(options, tracker))
+        deliver(task, reaper, fileobj, checkpoint, uploader)
+
+def run_scheduler(options, tracker, feeder, uploader):
+    """
+    Work on up to options.open_tasks tasks with options.num_threads workers
+    """
+    log = logging.getLogger("run_scheduler")
+    checkpoints = {}
+
+    def done(reaper, fileobj, error):
+        checkpoint = checkpoints.pop(id(reaper), None)
+        if error:
+            log.warn("Task %s failed, skipping it" % reaper.task["id"])
+            return
+        deliver(reaper.task, reaper, fileobj, checkpoint, uploader)
+
+    scheduler = tinyback.scheduler.Scheduler(options.num_threads)
+    scheduler.start()
+    while not stopping.is_set():
+        if not scheduler.wait(options.open_tasks, 1):
+            continue
+        task, checkpoint = next_task(options, feeder)
+        if not task:
+            continue
+
+        reaper = tinyback.ScheduledReaper(task, options.concurrency or 8, checkpoint, stopping)
+        fileobj = reaper.start(options.temp_dir, create_sink(options, tracker))
+        if fileobj:
+            deliver(task, reaper, fileobj, checkpoint, uploader)
+            continue
+        checkpoints[id(reaper)] = checkpoint
+        scheduler.submit(reaper, done)
+
+    log.info("Waiting for %i open tasks" % len(scheduler))
+    scheduler.stop()
+
+def run_threads(options, tracker):
+    feeder = TaskFeeder(tracker, options.prefetch or options.open_tasks or options.num_threads, options.sleep)
+    feeder.start()
+    spool = sender = None
+    if options.spool_dir:
+        quota = None
+        if options.spool_quota is not None:
+            quota = options.spool_quota * 1024 * 1024
+        spool = tinyback.spool.Spool(options.spool_dir, quota)
+        sender = tinyback.spool.Sender(spool, tracker, options.username)
+        sender.start()
+    uploader = Uploader(tracker, options.username, options.num_threads, spool, sender)
+    uploader.start()
+
+    if options.open_tasks:
+        run_scheduler(options, tracker, feeder, uploader)
+    elif options.num_threads == 1:
+        run_thread(options, tracker, feeder, uploader)
     else:
         threads = []
-
         for i in range(options.num_threads):
-            thread = threading.Thread(target=run_thread,args=(options, tracker))
+            thread = threading.Thread(target=run_thread,args=(options, tracker, feeder, uploader))
             time.sleep(1)
             thread.start()
             threads.append(thread)
 
-        for thread in threads:
-            thread.join()
+        # Thread.join() would keep signal handlers from running
+        while [thread for thread in threads if thread.is_alive()]:
+            time.sleep(1)
+
+    uploader.finish()
+    if sender:
+        sender.stop()
+
+def ignore_signals():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def stop(signum, frame):
+    logging.getLogger("run").info("Received signal %i - Finishing current tasks" % signum)
+    stopping.set()
+
+def run_worker(options, registry, tracker):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+
+    tinyback.ratelimit.registry.connect(registry)
+    run_threads(options, WorkerTracker(tracker, options.tracker))
+
+def supervise(options):
+    log = logging.getLogger("supervisor")
+
+    manager = SharedState()
+    manager.start(ignore_signals)
+    registry = manager.Registry()
+    if options.rate_state:
+        registry.load(options.rate_state)
+    tracker = manager.Tracker(options.tracker)
+    if options.clear:
+        tracker.clear()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    workers = [None] * options.processes
+    started = [0] * options.processes
+    while not stopping.is_set():
+        for i, worker in enumerate(workers):
+            if worker and worker.is_alive():
+                continue
+            if worker:
+                if time.time() - started[i] < 10:
+                    continue
+                log.warn("Worker %i exited with code %s - Restarting" % (i, worker.exitcode))
+            workers[i] = multiprocessing.Process(target=run_worker,
+                args=(options, registry, tracker))
+            workers[i].start()
+            started[i] = time.time()
+        time.sleep(1)
+
+    log.info("Waiting for workers to finish their tasks")
+    for worker in workers:
+        if worker and worker.is_alive():
+            os.kill(worker.pid, signal.SIGTERM)
+    while [worker for worker in workers if worker and worker.is_alive()]:
+        time.sleep(1)
+    manager.shutdown()
+
+def configure(options):
+    """
+    Apply the process-wide settings from options
+    """
+    if options.connections is not None:
+        tinyback.connections.configure(size=options.connections)
+    tinyback.bgzf.configure(options.compression_level, options.compression_threads)
+    tinyback.strategy.configure(options.fetch_strategy)
+    if options.url_archive:
+        tinyback.archive.configure(options.url_archive)
+    if options.coverage_dir:
+        tinyback.coverage.configure(options.coverage_dir)
+
+def main():
+    options = parse_options()
+
+    logging.basicConfig(level=options.loglevel,
+        format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+
+    configure(options)
+
+    if options.processes:
+        supervise(options)
+        return
+
+    if options.rate_state:
+        tinyback.ratelimit.registry.load(options.rate_state)
+
+    tracker = tinyback.tracker.Tracker(options.tracker)
+    if options.clear:
+        tracker.clear()
+
+    signal.signal(signal.SIGTERM, stop)
+    run_threads(options, tracker)
 
 if __name__ == "__main__":
     main()
@@ -19,9 +19,16 @@
 import logging
 import os
 import re
+import sys
+import unittest
 
 import tinyback
 
+# Unit tests first, they do not need the network
+tests = unittest.TestLoader().discover(os.path.join(os.path.dirname(os.path.abspath(__file__)), "tests"))
+if not unittest.TextTestRunner().run(tests).wasSuccessful():
+    sys.exit(1)
+
 logging.basicConfig(level=logging.DEBUG)
 
 tests_path = os.path.join(os.path.dirname(__file__), "test-definitions")
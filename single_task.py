@@ -17,13 +17,17 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import os
 import sys
 import time
 
 import tinyback
+import tinyback.checkpoint
+import tinyback.ratelimit
+import tinyback.spool
 import tinyback.tracker
 
-username = tmp_dir = None
+username = tmp_dir = concurrency = None
 tracker = "http://urlteam.terrywri.st/"
 
 for i, value in enumerate(sys.argv):
@@ -33,6 +37,8 @@ for i, value in enumerate(sys.argv):
         tmp_dir = value
     elif i == 3:
         tracker = value
+    elif i == 4:
+        concurrency = int(value)
 
 
 class StreamHandlerWithProgress(logging.StreamHandler):
@@ -67,16 +73,53 @@ logger = logging.getLogger()
 logger.addHandler(handler)
 logger.setLevel(logging.INFO)
 
+if tmp_dir:
+    tinyback.ratelimit.registry.load(os.path.join(tmp_dir, "ratelimit.json"))
+
 tracker = tinyback.tracker.Tracker(tracker)
-try:
-    task = tracker.fetch()
-except:
-    sys.exit(1)
-if not task:
-    time.sleep(300)
-    sys.exit(0)
 
-reaper = tinyback.Reaper(task, progress=True)
+spool = None
+if tmp_dir:
+    spool = tinyback.spool.Spool(os.path.join(tmp_dir, "spool"))
+    try:
+        spool.send(tracker, username)
+    except:
+        logger.info("Could not upload spooled results, keeping them for later")
+
+checkpoint = None
+if tmp_dir:
+    for pending in tinyback.checkpoint.pending(tmp_dir):
+        if pending.claim():
+            checkpoint = pending
+            break
+
+if checkpoint:
+    task = checkpoint.task
+else:
+    try:
+        task = tracker.fetch()
+    except:
+        sys.exit(1)
+    if not task:
+        time.sleep(300)
+        sys.exit(0)
+    if tmp_dir:
+        checkpoint = tinyback.checkpoint.Checkpoint(tmp_dir, task)
+        if not checkpoint.claim():
+            sys.exit(0)
+
+if concurrency:
+    reaper = tinyback.AsyncReaper(task, progress=True, concurrency=concurrency, checkpoint=checkpoint)
+else:
+    reaper = tinyback.Reaper(task, progress=True, checkpoint=checkpoint)
 fileobj = reaper.run(tmp_dir)
-tracker.put(task, fileobj, username)
+try:
+    tracker.put(task, fileobj, username)
+except:
+    if not spool:
+        raise
+    logger.info("Could not upload results, spooling them for later")
+    spool.add(task, fileobj)
 fileobj.close()
+if checkpoint:
+    checkpoint.remove()
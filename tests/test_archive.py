@@ -0,0 +1,121 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinyback import archive
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = archive.Store(os.path.join(self.directory, "bitly"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _add(self, results):
+        for code, url in results:
+            self.store.add(code, url)
+        self.store.flush()
+
+    def test_lookup(self):
+        self.assertEqual(self.store.lookup("a"), None)
+        self._add([("a", "http://example.com/a"), ("b", "http://example.com/b")])
+        self.assertEqual(self.store.lookup("a"), "http://example.com/a")
+        self.assertEqual(self.store.lookup("c"), None)
+        self.assertEqual(self.store.stats(), (0, 2 * len("a|http://example.com/a\n")))
+
+    def test_compact(self):
+        self._add([("b", "http://example.com/b1"), ("a", "http://example.com/a")])
+        self.store.compact()
+        self.assertEqual(self.store.stats(), (2, 0))
+        self._add([("c", "http://example.com/c"), ("b", "http://example.com/b2")])
+        self.assertEqual(self.store.lookup("b"), "http://example.com/b2")
+        self.store.compact()
+        self.assertEqual(self.store.stats(), (3, 0))
+        # The newest result wins, in the tail and in the index
+        self.assertEqual(self.store.lookup("b"), "http://example.com/b2")
+        self.assertEqual(self.store.lookup("a"), "http://example.com/a")
+        self.assertEqual(self.store.lookup("c"), "http://example.com/c")
+        self.assertEqual(self.store.lookup("d"), None)
+
+    def test_prefix(self):
+        self._add([("ab", "1"), ("abc", "2"), ("b", "3")])
+        self.store.compact()
+        self._add([("abd", "4"), ("ab", "5"), ("aa", "6")])
+        self.assertEqual(self.store.prefix("ab"), [("ab", "5"), ("abc", "2"), ("abd", "4")])
+        self.assertEqual(self.store.prefix("x"), [])
+
+    def test_long_codes(self):
+        prefix = "x" * archive.KEY_SIZE
+        self._add([(prefix + "1", "1"), (prefix + "2", "2"), (prefix, "0")])
+        self.store.compact()
+        self.assertEqual(self.store.lookup(prefix + "2"), "2")
+        self.assertEqual(self.store.lookup(prefix + "1"), "1")
+        self.assertEqual(self.store.lookup(prefix), "0")
+        self.assertEqual(self.store.lookup(prefix + "3"), None)
+        self.assertEqual(self.store.prefix(prefix), [(prefix, "0"), (prefix + "1", "1"), (prefix + "2", "2")])
+
+    def test_segments(self):
+        self.store.SEGMENT_SIZE = 100
+        self._add([("%04i" % i, "http://example.com/%i" % i) for i in xrange(50)])
+        self.store.compact()
+        self._add([("%04i" % i, "http://example.org/%i" % i) for i in xrange(25, 75)])
+        self.assertTrue(len(self.store._segment_numbers()) > 1)
+        for i in xrange(75):
+            url = "http://example.%s/%i" % ("com" if i < 25 else "org", i)
+            self.assertEqual(self.store.lookup("%04i" % i), url)
+
+    def test_other_store(self):
+        other = archive.Store(self.store.directory)
+        self.assertEqual(other.lookup("a"), None)
+        self._add([("a", "http://example.com/a")])
+        other._tail_time -= other.REFRESH_INTERVAL
+        self.assertEqual(other.lookup("a"), "http://example.com/a")
+        self.store.compact()
+        self._add([("a", "http://example.com/b")])
+        other._tail_time -= other.REFRESH_INTERVAL
+        self.assertEqual(other.lookup("a"), "http://example.com/b")
+
+    def test_background_compaction(self):
+        self.store.COMPACT_SIZE = 1000
+        self._add([("%04i" % i, "http://example.com/%i" % i) for i in xrange(100)])
+        self.store._compactor.join()
+        self.assertEqual(self.store.stats(), (100, 0))
+        self.assertEqual(self.store.lookup("0042"), "http://example.com/42")
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        archive.configure(None)
+        archive._stores.clear()
+        shutil.rmtree(self.directory)
+
+    def test_get(self):
+        self.assertEqual(archive.get("bitly"), None)
+        archive.configure(self.directory)
+        self.assertFalse(archive.exists("bit.ly/x"))
+        store = archive.get("bit.ly/x")
+        self.assertTrue(archive.get("bit.ly/x") is store)
+        self.assertTrue(archive.exists("bit.ly/x"))
+        self.assertEqual(os.listdir(self.directory), ["bit.ly_x"])
@@ -0,0 +1,88 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import gzip
+import os
+import unittest
+
+from tinyback import bgzf
+
+class BlockWriterTest(unittest.TestCase):
+
+    def _write(self, lines):
+        fileobj = StringIO.StringIO()
+        writer = bgzf.BlockWriter(fileobj)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+        return fileobj
+
+    def test_long_line(self):
+        # Random data does not compress, so the line needs several blocks
+        url = "data:," + os.urandom(160 * 1024).encode("hex")
+        lines = ["a|http://example.com/\n", "b|" + url + "\n", "c|http://example.org/\n"]
+        fileobj = self._write(lines)
+
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj).read(), "".join(lines))
+        blocks = bgzf.index(fileobj)
+        self.assertEqual([code for offset, code in blocks], ["a", "b", "c"])
+        self.assertEqual(bgzf.lookup(fileobj, "b", key=ord, blocks=blocks), url)
+        self.assertEqual(bgzf.lookup(fileobj, "c", key=ord, blocks=blocks), "http://example.org/")
+
+    def test_small_blocks(self):
+        lines = ["%x|http://example.com/%i\n" % (i, i) for i in xrange(1000)]
+        fileobj = StringIO.StringIO()
+        writer = bgzf.BlockWriter(fileobj, block_size=1000)
+        for line in lines:
+            writer.write(line)
+        writer.close()
+
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj).read(), "".join(lines))
+        self.assertTrue(len(bgzf.index(fileobj)) > 10)
+
+    def test_no_threads(self):
+        threads = bgzf._threads
+        bgzf.configure(threads=0)
+        try:
+            self.test_small_blocks()
+        finally:
+            bgzf.configure(threads=threads)
+        self.assertRaises(ValueError, bgzf.configure, threads=-1)
+
+    def test_shared_threads(self):
+        for i in xrange(20):
+            writer = bgzf.BlockWriter(StringIO.StringIO())
+            writer.write("a|http://example.com/\n")
+        self.assertEqual(len(bgzf._pool), bgzf._threads)
+
+    def test_abort(self):
+        fileobj = StringIO.StringIO()
+        writer = bgzf.BlockWriter(fileobj)
+        writer.write("a|http://example.com/\n")
+        writer.flush()
+        size = fileobj.tell()
+        writer.write("b|http://example.org/\n")
+        writer.abort()
+        writer.flush()
+        self.assertEqual(fileobj.tell(), size)
+        fileobj.seek(0)
+        self.assertEqual([code for offset, code in bgzf.index(fileobj)], ["a"])
+
+if __name__ == "__main__":
+    unittest.main()
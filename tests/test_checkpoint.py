@@ -0,0 +1,98 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinyback import checkpoint
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.task = {"id": "1/2", "service": "bitly", "generator_type": "chain"}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_create_directory(self):
+        directory = os.path.join(self.directory, "a", "b")
+        checkpoint.Checkpoint(directory, self.task).resume()
+        self.assertTrue(os.path.isdir(directory))
+        checkpoint.Checkpoint(directory, self.task)
+
+    def test_fresh_start(self):
+        fileobj, state = checkpoint.Checkpoint(self.directory, self.task).resume()
+        self.assertEqual(state["codes_tried"], 0)
+        self.assertEqual(state["offset"], 0)
+        self.assertEqual(fileobj.tell(), 0)
+
+    def test_resume(self):
+        first = checkpoint.Checkpoint(self.directory, self.task)
+        fileobj, state = first.resume()
+        fileobj.write("saved")
+        first.save(100, 3, codes_skipped=10)
+        fileobj.write("lost")
+        first.release()
+
+        fileobj, state = checkpoint.Checkpoint(self.directory, self.task).resume()
+        self.assertEqual(state["codes_tried"], 100)
+        self.assertEqual(state["codes_skipped"], 10)
+        self.assertEqual(state["urls_found"], 3)
+        self.assertFalse(state["finished"])
+        # Results written after the checkpoint are dropped
+        self.assertEqual(fileobj.tell(), 5)
+        fileobj.seek(0)
+        self.assertEqual(fileobj.read(), "saved")
+
+    def test_claim(self):
+        first = checkpoint.Checkpoint(self.directory, self.task)
+        second = checkpoint.Checkpoint(self.directory, self.task)
+        self.assertTrue(first.claim())
+        self.assertFalse(second.claim())
+        self.assertRaises(Exception, second.resume)
+        first.release()
+        self.assertTrue(second.claim())
+        second.release()
+
+    def test_other_task(self):
+        first = checkpoint.Checkpoint(self.directory, self.task)
+        fileobj, state = first.resume()
+        fileobj.write("saved")
+        first.save(100, 3)
+        first.release()
+
+        # Same file name, but not the same task
+        task = dict(self.task, id="1_2")
+        fileobj, state = checkpoint.Checkpoint(self.directory, task).resume()
+        self.assertEqual(state["codes_tried"], 0)
+        self.assertEqual(fileobj.tell(), 0)
+
+    def test_pending(self):
+        tasks = [dict(self.task, id=str(i)) for i in xrange(3)]
+        for task in tasks:
+            cp = checkpoint.Checkpoint(self.directory, task)
+            cp.resume()
+            cp.save(1, 0)
+            cp.release()
+        open(os.path.join(self.directory, "broken.checkpoint"), "w").close()
+        checkpoint.Checkpoint(self.directory, tasks[1]).remove()
+
+        pending = checkpoint.pending(self.directory)
+        self.assertEqual([cp.task for cp in pending], [tasks[0], tasks[2]])
+        self.assertEqual(sorted(os.listdir(self.directory)), ["bitly-0.checkpoint", "bitly-0.gz", "bitly-2.checkpoint", "bitly-2.gz", "broken.checkpoint"])
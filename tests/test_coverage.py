@@ -0,0 +1,116 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import tinyback
+from tinyback import coverage, services
+
+class Service(services.Service):
+
+    charset = "abcdef"
+    rate_limit = None
+
+    def fetch(self, code):
+        return "http://example.com/" + code
+
+services.register("coverage-test", Service)
+
+class BitmapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "bits")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_add(self):
+        bitmap = coverage.Bitmap(self.path, 100)
+        self.assertEqual(os.path.getsize(self.path), 13)
+        bitmap.add(0)
+        bitmap.add(9)
+        bitmap.add(99)
+        self.assertEqual([n for n in xrange(100) if n in bitmap], [0, 9, 99])
+        self.assertTrue(99 in coverage.Bitmap(self.path, 100))
+
+    def test_processes(self):
+        pids = []
+        for i in xrange(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    bitmap = coverage.Bitmap(self.path, 8000)
+                    for n in xrange(i, 8000, 4):
+                        bitmap.add(n)
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        bitmap = coverage.Bitmap(self.path, 8000)
+        self.assertEqual([n for n in xrange(8000) if n not in bitmap], [])
+
+class CoverageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        coverage.configure(None)
+        coverage._coverages.clear()
+        shutil.rmtree(self.directory)
+
+    def test_codes(self):
+        codes = coverage.Coverage(self.directory, "abc")
+        codes.add("ab")
+        codes.add("abc")
+        codes.add("")
+        codes.add("abd")
+        self.assertTrue("ab" in codes)
+        self.assertTrue("abc" in codes)
+        self.assertFalse("ba" in codes)
+        self.assertFalse("abd" in codes)
+        self.assertFalse("" in codes)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["length-2.bits", "length-3.bits"])
+
+    def test_too_large(self):
+        codes = coverage.Coverage(self.directory, "0123456789")
+        codes.add("1" * 12)
+        self.assertFalse("1" * 12 in codes)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def _run(self, generator_type, generator_options):
+        task = {"id": 1, "service": "coverage-test", "generator_type": generator_type, "generator_options": generator_options}
+        reaper = tinyback.Reaper(task)
+        reaper.run()
+        return reaper
+
+    def test_chain_only(self):
+        coverage.configure(self.directory)
+        options = {"charset": "abcdef", "start": "aa", "stop": "ff"}
+        for i in xrange(2):
+            self.assertEqual(self._run("sequence", options).codes_skipped, 0)
+
+        # Chain tasks skip the codes covered by the sequence tasks
+        options = {"charset": "abcdef", "count": 20, "length": 2, "seed": "seed"}
+        self.assertEqual(self._run("chain", options).codes_skipped, 20)
+        options = {"charset": "abcdef", "count": 20, "length": 3, "seed": "seed"}
+        self.assertEqual(self._run("chain", options).codes_skipped, 0)
+        self.assertTrue(self._run("chain", options).codes_skipped > 0)
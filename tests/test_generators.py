@@ -0,0 +1,190 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import gzip
+import hashlib
+import json
+import unittest
+
+import tinyback
+from tinyback import bgzf, generators
+
+CHARSET = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def chain(options):
+    """
+    The chain generator before batches and checkpoints
+    """
+    m = 256 - (256 % len(options["charset"]))
+    digest = options["seed"]
+    count = 0
+    while count < options["count"]:
+        digest = hashlib.md5(digest).digest()
+        code = ""
+        for byte in map(ord, digest):
+            if byte > m:
+                continue
+            code += options["charset"][byte % len(options["charset"])]
+            if len(code) == options["length"]:
+                count += 1
+                yield code
+                break
+
+def sequence(options):
+    """
+    The string-based sequence generator
+    """
+    code = options["start"]
+    yield code
+    while code != options["stop"]:
+        for i in range(len(code) - 1, -1, -1):
+            if code[i] == options["charset"][-1]:
+                code = code[0:i] + options["charset"][0] + code[i+1:len(code)]
+            else:
+                code = code[0:i] + options["charset"][options["charset"].index(code[i]) + 1] + code[i+1:len(code)]
+                yield code
+                break
+        else:
+            code = options["charset"][0] + code
+            yield code
+
+class CodecTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        codec = generators.Codec("abc")
+        codes = list(sequence({"charset": "abc", "start": "", "stop": "cccc"}))
+        for i, code in enumerate(codes):
+            self.assertEqual(codec.encode(code), i)
+            self.assertEqual(codec.decode(i), code)
+
+    def test_single_character(self):
+        codec = generators.Codec("a")
+        self.assertEqual(codec.encode("aaa"), 3)
+        self.assertEqual(codec.decode(3), "aaa")
+
+    def test_invalid(self):
+        codec = generators.Codec("abc")
+        self.assertRaises(ValueError, codec.encode, "abd")
+        self.assertRaises(ValueError, codec.decode, -1)
+
+class SequenceGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.options = {"charset": CHARSET, "start": "zY", "stop": "a5b"}
+        self.codes = list(sequence(self.options))
+
+    def test_same_codes(self):
+        self.assertEqual(list(generators.factory("sequence", self.options)), self.codes)
+        options = {"charset": "ab", "start": "", "stop": "bbab"}
+        self.assertEqual(list(generators.factory("sequence", options)), list(sequence(options)))
+
+    def test_random_access(self):
+        codes = generators.SequenceGenerator(self.options)
+        self.assertEqual(len(codes), len(self.codes))
+        self.assertEqual(codes[0], "zY")
+        self.assertEqual(codes[-1], "a5b")
+        self.assertEqual(codes[100], self.codes[100])
+        self.assertRaises(IndexError, codes.__getitem__, len(self.codes))
+        self.assertEqual(list(codes[100:200]), self.codes[100:200])
+        self.assertEqual(codes[100:200:7], self.codes[100:200:7])
+        self.assertEqual(list(codes[200:100]), [])
+
+    def test_seek(self):
+        codes = generators.SequenceGenerator(self.options)
+        result = []
+        for code in codes:
+            result.append(code)
+            if len(result) == 10:
+                codes.seek(1000)
+        self.assertEqual(result, self.codes[:10] + self.codes[1000:])
+        self.assertEqual(codes.tell(), len(self.codes))
+
+    def test_skip(self):
+        codes = generators.skip(generators.factory("sequence", self.options), 500)
+        self.assertEqual(list(codes), self.codes[500:])
+
+    def test_empty(self):
+        self.assertEqual(list(generators.SequenceGenerator({"charset": CHARSET, "start": "b", "stop": "a"})), [])
+
+class ChainGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.options = {"charset": CHARSET, "count": 5000, "length": 6, "seed": "seed"}
+        self.codes = list(chain(self.options))
+
+    def test_same_codes(self):
+        self.assertEqual(list(generators.factory("chain", self.options)), self.codes)
+        options = dict(self.options, charset=u"abc", length=16)
+        self.assertEqual(list(generators.factory("chain", options)), list(chain(options)))
+
+    def test_batch(self):
+        codes = generators.ChainGenerator(self.options)
+        self.assertEqual(codes.batch(1000), self.codes[:1000])
+        self.assertEqual(codes.tell(), 1000)
+        self.assertEqual(codes.batch(10000), self.codes[1000:])
+        self.assertEqual(codes.batch(10), [])
+
+    def test_checkpoint(self):
+        codes = generators.ChainGenerator(self.options)
+        codes.batch(1234)
+        checkpoint = json.loads(json.dumps(codes.checkpoint()))
+        self.assertEqual(list(generators.ChainGenerator(self.options, checkpoint)), self.codes[1234:])
+
+    def test_skip(self):
+        for n in (0, 1, 1000, 4999, 5000, 6000):
+            codes = generators.skip(generators.factory("chain", self.options), n)
+            self.assertEqual(list(codes), self.codes[n:])
+
+    def test_length(self):
+        self.assertRaises(ValueError, generators.ChainGenerator, dict(self.options, length=17))
+
+class ShardTest(unittest.TestCase):
+
+    def _check(self, generator_type, options):
+        codes = list(generators.factory(generator_type, options))
+        for k in (1, 2, 3, 7):
+            shards = [list(generators.shard(generator_type, options, k, i)) for i in xrange(k)]
+            self.assertEqual(sum(shards, []), codes)
+            self.assertTrue(max(map(len, shards)) - min(map(len, shards)) <= 1)
+
+    def test_chain(self):
+        self._check("chain", {"charset": CHARSET, "count": 1000, "length": 5, "seed": "seed"})
+
+    def test_sequence(self):
+        self._check("sequence", {"charset": CHARSET, "start": "a", "stop": "cZ"})
+
+    def test_list(self):
+        self._check("list", {"list": ["code%i" % i for i in xrange(100)]})
+
+    def test_range(self):
+        self.assertRaises(ValueError, generators.shard, "list", {"list": []}, 2, 2)
+        self.assertRaises(ValueError, generators.shard, "unknown", {}, 2, 0)
+
+class MergeTest(unittest.TestCase):
+
+    def test_merge(self):
+        shards = []
+        for i in xrange(3):
+            fileobj = StringIO.StringIO()
+            writer = bgzf.BlockWriter(fileobj)
+            writer.write("%i|http://example.com/%i\n" % (i, i))
+            writer.close()
+            shards.append(fileobj)
+        fileobj = StringIO.StringIO()
+        tinyback.merge(shards, fileobj)
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj).read(), "".join("%i|http://example.com/%i\n" % (i, i) for i in xrange(3)))
@@ -0,0 +1,106 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import HTMLParser
+import re
+import unittest
+
+from tinyback import parsers, services
+
+FOOTER = "<div id=\"footer\">" + "<p>Boilerplate</p>\n" * 200 + "</div>\n"
+
+# (rule, pattern and flags of the original re.search, page)
+PAGES = [
+    (services.Isgd._preview_rule,
+        "<b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"(.*)\" class=\"biglink\">", 0,
+        "<p>The full original link is shown below. <b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"http://example.com/search?q=tiny&amp;lang=en\" class=\"biglink\">http://example.com/</a></p>\n"),
+    (services.Isgd._blocked_rule,
+        "<p>For reference and to help those fighting spam the original destination of this URL is given below \\(we strongly recommend you don't visit it since it may damage your PC\\): -<br />(.*)</p><h2>is\\.gd</h2><p>is\\.gd is a free service used to shorten long URLs\\.", 0,
+        "<div id=\"disabled\"><h2>Link Disabled</h2>\n<p>For reference and to help those fighting spam the original destination of this URL is given below (we strongly recommend you don't visit it since it may damage your PC): -<br />http://spam.example.com/buy?now=1&amp;cheap=1</p><h2>is.gd</h2><p>is.gd is a free service used to shorten long URLs.</p></div>\n"),
+    (services.Owly._warning_rule,
+        "<a class=\"btn ignore\" href=\"(.*?)\" title=", 0,
+        "<a class=\"btn ignore\" href=\"http://example.org/setup.exe?id=7&amp;ref=owly\" title=\"Ignore\">Proceed anyway</a>\n"),
+    (services.Tinyurl._errorhelp_rule,
+        "<meta http-equiv=\"refresh\" content=\"0;url=(.*?)\">", 0,
+        "<title>Redirecting...</title>\n<meta http-equiv=\"refresh\" content=\"0;url=http://example.com/?a=1&amp;b=2\">\n"),
+    (services.Tinyurl._tinyurl_redirect_rule,
+        "<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site\\. The URL it redirects to is <a href=\"(.*?)\">", re.DOTALL,
+        "<h1>Error: TinyURL redirects to a TinyURL.</h1>\n<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site. The URL it redirects to is <a href=\"http://tinyurl.com/abc123?x=1&amp;y=2\">http://tinyurl.com/abc123</a>.</p>\n"),
+    (services.Tinyurl._preview_rule,
+        "<a id=\"redirecturl\" href=\"(.*?)\">Proceed to this site.</a>", re.DOTALL,
+        "<p>This TinyURL redirects to:</p>\n<a id=\"redirecturl\" href=\"http://example.net/2012/tiny-urls.html\">Proceed to this site.</a>\n"),
+    (services.Snipurl._preview_rule,
+        "<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>(.*?)</div> <br />", 0,
+        "<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>http://example.com/path?with=query&amp;and=more</div> <br />\n"),
+    (services.Visibli._iframe_rule,
+        "<iframe id=\"[^\"]+\" src=\"([^\"]+)\">", 0,
+        "<iframe id=\"visibli-frame\" src=\"http://example.com/story?id=42&amp;src=visibli\"></iframe>\n"),
+]
+
+class RuleTest(unittest.TestCase):
+
+    def test_same_as_original(self):
+        for rule, pattern, flags, page in PAGES:
+            self.assertEqual((rule.regex.pattern, rule.regex.flags & re.DOTALL), (pattern, flags))
+            match = re.search(pattern, page + FOOTER, flags)
+            url = match.group(1)
+            if rule.unescape:
+                url = HTMLParser.HTMLParser().unescape(url.decode("utf-8")).encode("utf-8")
+            self.assertEqual(rule.extract(page + FOOTER), url)
+            self.assertEqual(rule.extract(FOOTER), None)
+
+    def test_complete(self):
+        for rule, pattern, flags, page in PAGES:
+            # The page is complete once the match and the line it is on are
+            # read, the boilerplate after it is not needed
+            self.assertTrue(rule.complete(page))
+            match = rule.regex.search(page)
+            self.assertFalse(rule.complete(page[:match.end() - 1]))
+            self.assertFalse(rule.complete(FOOTER))
+
+    def test_greedy(self):
+        rule = parsers.Rule("href=\"(.*)\"", final="\n")
+        self.assertFalse(rule.complete("<a href=\"http://example.com/\""))
+        self.assertTrue(rule.complete("<a href=\"http://example.com/\">\n"))
+        self.assertFalse(parsers.Rule("href=\"(.*)\"").complete("<a href=\"http://example.com/\">\n"))
+
+    def test_marker(self):
+        rule = parsers.Rule("href=\"(.*?)\"", final="", marker="<title>Preview</title>")
+        self.assertFalse(rule.complete("<a href=\"http://example.com/\">"))
+        self.assertTrue(rule.complete("<title>Preview</title><a href=\"http://example.com/\">"))
+
+    def test_parser(self):
+        parser = services.Tinyurl._parser
+        self.assertFalse(parser.complete(FOOTER))
+        self.assertTrue(parser.complete(PAGES[3][3]))
+        self.assertTrue(parser.complete(PAGES[4][3]))
+
+class UnescapeTest(unittest.TestCase):
+
+    def test_same_as_htmlparser(self):
+        html_parser = HTMLParser.HTMLParser()
+        for url in ("http://example.com/", "a&amp;b", "&lt;&gt;&quot;&#39;&#x41;&#65;", "&unknown; & &amp", "caf\xc3\xa9&eacute;"):
+            self.assertEqual(parsers.unescape(url), html_parser.unescape(url.decode("utf-8")).encode("utf-8"))
+        self.assertRaises(UnicodeDecodeError, parsers.unescape, "\xff")
+
+    def test_cache(self):
+        size = parsers.CACHE_SIZE
+        parsers.CACHE_SIZE = 2
+        try:
+            self.assertEqual(parsers.unescape("&amp;&lt;&gt;&quot;"), "&<>\"")
+            self.assertTrue(len(parsers._entities) <= 2)
+        finally:
+            parsers.CACHE_SIZE = size
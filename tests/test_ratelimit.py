@@ -0,0 +1,240 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinyback import ratelimit
+
+class Clock:
+    """
+    Stands in for the time module, so tests do not have to sleep
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class ClockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self._time = ratelimit.time
+        ratelimit.time = self.clock
+
+    def tearDown(self):
+        ratelimit.time = self._time
+
+class TokenBucketTest(ClockTestCase):
+
+    def test_reserve(self):
+        bucket = ratelimit.TokenBucket(2, 1)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0.5)
+        self.assertEqual(bucket.reserve(), 1.0)
+
+        self.clock.now += 1
+        self.assertEqual(bucket.delay(), 0.5)
+        self.clock.now += 1
+        self.assertEqual(bucket.delay(), 0)
+
+    def test_acquire(self):
+        bucket = ratelimit.TokenBucket(1, 2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 2)
+        self.assertEqual(self.clock.now, 1002)
+
+    def test_drain(self):
+        bucket = ratelimit.TokenBucket(5, 1)
+        bucket.drain()
+        self.assertEqual(bucket.delay(), 0.2)
+
+class RegistryTest(ClockTestCase):
+
+    def test_shared_by_name(self):
+        registry = ratelimit.Registry()
+        bucket = registry.get("bitly", (5, 1))
+        self.assertTrue(registry.get("bitly", (5, 1)) is bucket)
+        self.assertFalse(registry.get("isgd", (5, 1)) is bucket)
+        self.assertEqual(registry.get("tinyurl", None), None)
+        self.assertTrue(registry.circuit("bitly") is registry.circuit("bitly"))
+
+    def test_call(self):
+        registry = ratelimit.Registry()
+        self.assertEqual(registry.call("bitly", (2, 1), "rate"), 2)
+        registry.call("bitly", (2, 1), "reserve")
+        registry.call("bitly", (2, 1), "reserve")
+        self.assertEqual(registry.get("bitly", (2, 1)).delay(), 0.5)
+        self.assertEqual(registry.call_circuit("bitly", "closed"), True)
+
+class AdaptiveTokenBucketTest(ClockTestCase):
+
+    def test_increase(self):
+        bucket = ratelimit.AdaptiveTokenBucket(10, 1)
+        for i in xrange(10):
+            bucket.success(0.1)
+        self.assertEqual(bucket.rate, 11)
+        for i in xrange(10):
+            bucket.success(None)
+        self.assertEqual(bucket.rate, 11)
+        bucket.success(None)
+        self.assertEqual(bucket.rate, 12)
+
+    def test_failure(self):
+        bucket = ratelimit.AdaptiveTokenBucket(10, 1)
+        bucket.failure()
+        self.assertEqual(bucket.rate, 5)
+        self.assertEqual(bucket.delay(), 0.2)
+        # Only one decrease per window
+        bucket.failure()
+        self.assertEqual(bucket.rate, 5)
+        self.clock.now += 1
+        bucket.failure()
+        self.assertEqual(bucket.rate, 2.5)
+
+    def test_clamp(self):
+        bucket = ratelimit.AdaptiveTokenBucket(10, 1)
+        for i in xrange(10):
+            self.clock.now += 1
+            bucket.failure()
+        self.assertEqual(bucket.rate, 1)
+        self.assertEqual(ratelimit.AdaptiveTokenBucket(10, 1, 1000).rate, 100)
+        self.assertEqual(ratelimit.AdaptiveTokenBucket(10, 1, 20).rate, 20)
+
+    def test_latency_spike(self):
+        bucket = ratelimit.AdaptiveTokenBucket(100, 1)
+        for i in xrange(ratelimit.AdaptiveTokenBucket.LATENCY_SAMPLES + 1):
+            bucket.success(0.1)
+        bucket.success(2.0)
+        bucket.success(2.0)
+        self.assertEqual(bucket.rate, 100)
+        bucket.success(2.0)
+        self.assertEqual(bucket.rate, 50)
+
+    def test_lasting_change(self):
+        bucket = ratelimit.AdaptiveTokenBucket(1000, 1)
+        for i in xrange(ratelimit.AdaptiveTokenBucket.LATENCY_SAMPLES + 1):
+            bucket.success(0.1)
+        for i in xrange(100):
+            self.clock.now += 1
+            bucket.success(1.0)
+        self.assertEqual(bucket.rate, 1000)
+
+class StateFileTest(ClockTestCase):
+
+    def setUp(self):
+        ClockTestCase.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.directory, "ratelimit.json")
+
+    def tearDown(self):
+        ClockTestCase.tearDown(self)
+        shutil.rmtree(self.directory)
+
+    def test_save_load(self):
+        registry = ratelimit.Registry()
+        registry.load(self.state_file)
+        registry.get("bitly", (10, 1)).failure()
+        registry.save()
+
+        registry = ratelimit.Registry()
+        registry.load(self.state_file)
+        self.assertEqual(registry.get("bitly", (10, 1)).rate, 5)
+        self.assertEqual(registry.get("isgd", (10, 1)).rate, 10)
+
+    def test_broken_file(self):
+        f = open(self.state_file, "w")
+        f.write("{")
+        f.close()
+        registry = ratelimit.Registry()
+        registry.load(self.state_file)
+        self.assertEqual(registry.get("bitly", (10, 1)).rate, 10)
+
+class CircuitTest(ClockTestCase):
+
+    def _open(self, circuit):
+        cooldown = circuit.report(False, True)
+        self.assertEqual(circuit.state, ratelimit.Circuit.OPEN)
+        return cooldown
+
+    def test_open(self):
+        circuit = ratelimit.Circuit()
+        self.assertTrue(circuit.closed)
+        self.assertEqual(circuit.reserve(), (0, False))
+        cooldown = self._open(circuit)
+        self.assertTrue(ratelimit.Circuit.INITIAL * 0.5 <= cooldown <= ratelimit.Circuit.INITIAL)
+        delay, probe = circuit.reserve()
+        self.assertAlmostEqual(delay, cooldown)
+        self.assertFalse(probe)
+        # Requests sent before the circuit opened do not extend the cooldown
+        self.assertEqual(circuit.report(False, True), None)
+        self.assertAlmostEqual(circuit.delay(), cooldown)
+
+    def test_probe(self):
+        circuit = ratelimit.Circuit()
+        self.clock.now += self._open(circuit)
+        self.assertEqual(circuit.reserve(), (0, True))
+        self.assertEqual(circuit.state, ratelimit.Circuit.HALF_OPEN)
+        self.assertEqual(circuit.reserve(), (ratelimit.Circuit.POLL, False))
+        # Only blocks of the probe count while half-open
+        self.assertEqual(circuit.report(False, True), None)
+        circuit.report(True)
+        self.assertTrue(circuit.closed)
+        self.assertEqual(circuit.reserve(), (0, False))
+
+    def test_release(self):
+        circuit = ratelimit.Circuit()
+        self.clock.now += self._open(circuit)
+        self.assertTrue(circuit.wait())
+        circuit.release(True)
+        self.assertEqual(circuit.state, ratelimit.Circuit.HALF_OPEN)
+        self.assertEqual(circuit.reserve(), (0, True))
+        # Releasing a request that was not the probe changes nothing
+        circuit.release(False)
+        self.assertEqual(circuit.reserve(), (ratelimit.Circuit.POLL, False))
+
+    def test_blocked_probe(self):
+        circuit = ratelimit.Circuit()
+        self.clock.now += self._open(circuit)
+        self.assertTrue(circuit.wait())
+        cooldown = circuit.report(True, True)
+        self.assertEqual(circuit.state, ratelimit.Circuit.OPEN)
+        initial = ratelimit.Circuit.INITIAL * ratelimit.Circuit.FACTOR
+        self.assertTrue(initial * 0.5 <= cooldown <= initial)
+
+        # wait sleeps through the cooldown and returns the probe
+        self.assertTrue(circuit.wait())
+        self.assertTrue(self.clock.now >= 1000 + cooldown)
+        circuit.report(True)
+        self.assertTrue(circuit.closed)
+        self.assertTrue(self._open(circuit) <= ratelimit.Circuit.INITIAL)
+
+    def test_maximum(self):
+        circuit = ratelimit.Circuit()
+        cooldown = self._open(circuit)
+        for i in xrange(10):
+            self.clock.now += cooldown
+            self.assertTrue(circuit.wait())
+            cooldown = circuit.report(True, True)
+        self.assertTrue(ratelimit.Circuit.MAXIMUM * 0.5 <= cooldown <= ratelimit.Circuit.MAXIMUM)
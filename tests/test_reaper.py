@@ -0,0 +1,110 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tinyback
+from tinyback import checkpoint, generators, scheduler, services
+
+# Set by the service once it has been asked for STOP_CODE
+stop = threading.Event()
+STOP_CODE = "cf"
+
+class Service(services.Service):
+
+    charset = "abcdef"
+    rate_limit = None
+
+    def fetch(self, code):
+        if code == STOP_CODE:
+            stop.set()
+        return "http://example.com/" + code
+
+services.register("reaper-test", Service)
+
+TASK = {
+    "id": 1,
+    "service": "reaper-test",
+    "generator_type": "sequence",
+    "generator_options": {"charset": "abcdef", "start": "aa", "stop": "fff"},
+}
+
+class InterruptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        stop.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _run_reaper(self, task_checkpoint, stop):
+        reaper = tinyback.Reaper(TASK, checkpoint=task_checkpoint, stop=stop)
+        return reaper, reaper.run(self.directory)
+
+    def _run_async_reaper(self, task_checkpoint, stop):
+        reaper = tinyback.AsyncReaper(TASK, concurrency=4, checkpoint=task_checkpoint, stop=stop)
+        return reaper, reaper.run(self.directory)
+
+    def _run_scheduled_reaper(self, task_checkpoint, stop):
+        reaper = tinyback.ScheduledReaper(TASK, concurrency=4, checkpoint=task_checkpoint, stop=stop)
+        fileobj = reaper.start(self.directory)
+        if fileobj:
+            return reaper, fileobj
+        results = []
+        pool = scheduler.Scheduler(4)
+        pool.start()
+        pool.submit(reaper, lambda reaper, fileobj, exc_info: results.append(fileobj))
+        pool.stop()
+        return reaper, results[0]
+
+    def _check(self, run):
+        task_checkpoint = checkpoint.Checkpoint(self.directory, TASK)
+        reaper, fileobj = run(task_checkpoint, stop)
+        self.assertTrue(reaper.interrupted)
+        self.assertEqual(fileobj, None)
+
+        pending = checkpoint.pending(self.directory)
+        self.assertEqual([cp.task for cp in pending], [TASK])
+        self.assertTrue(0 < pending[0].resume()[1]["codes_tried"] < 252)
+        reaper, fileobj = run(pending[0], threading.Event())
+        self.assertFalse(reaper.interrupted)
+
+        codes = generators.factory(TASK["generator_type"], TASK["generator_options"])
+        fileobj.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fileobj, mode="rb").read(), "".join("%s|http://example.com/%s\n" % (code, code) for code in codes))
+        fileobj.close()
+
+    def test_reaper(self):
+        self._check(self._run_reaper)
+
+    def test_async_reaper(self):
+        self._check(self._run_async_reaper)
+
+    def test_scheduled_reaper(self):
+        self._check(self._run_scheduled_reaper)
+
+    def test_no_checkpoint(self):
+        stop.set()
+        reaper, fileobj = self._run_reaper(None, stop)
+        self.assertFalse(reaper.interrupted)
+        fileobj.seek(0)
+        self.assertEqual(len(gzip.GzipFile(fileobj=fileobj, mode="rb").read().splitlines()), 252)
+        fileobj.close()
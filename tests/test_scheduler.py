@@ -0,0 +1,116 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import shutil
+import tempfile
+import threading
+import unittest
+
+import tinyback
+from tinyback import checkpoint, scheduler, services
+
+class Service(services.Service):
+
+    charset = "abcdef"
+    rate_limit = None
+
+    def fetch(self, code):
+        return "http://example.com/" + code
+
+class BrokenService(Service):
+
+    def fetch(self, code):
+        if code >= "ad":
+            raise RuntimeError("Broken service")
+        return Service.fetch(self, code)
+
+services.register("scheduler-test", Service)
+services.register("scheduler-test-broken", BrokenService)
+
+def task(task_id, service="scheduler-test", stop="ff"):
+    options = {"charset": "abcdef", "start": "aa", "stop": stop}
+    return {"id": task_id, "service": service, "generator_type": "sequence", "generator_options": options}
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock = threading.Lock()
+        self.calls = []
+        self.scheduler = scheduler.Scheduler(4)
+        self.scheduler.start()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _callback(self, reaper, fileobj, exc_info):
+        lines = None
+        if fileobj:
+            fileobj.seek(0)
+            lines = gzip.GzipFile(fileobj=fileobj, mode="rb").read().splitlines()
+            fileobj.close()
+        with self.lock:
+            self.calls.append((reaper.task["id"], lines, exc_info and exc_info[0]))
+
+    def _submit(self, reaper, callback=None):
+        self.assertEqual(reaper.start(self.directory), None)
+        self.scheduler.submit(reaper, callback or self._callback)
+
+    def test_tasks(self):
+        for i in xrange(5):
+            self._submit(tinyback.ScheduledReaper(task(i), concurrency=3))
+        self.scheduler.stop()
+        self.assertEqual(len(self.scheduler), 0)
+        self.assertEqual(sorted(call[0] for call in self.calls), range(5))
+        codes = [prefix + char for prefix in "abcdef" for char in "abcdef"]
+        for task_id, lines, error in self.calls:
+            self.assertEqual(lines, ["%s|http://example.com/%s" % (code, code) for code in codes])
+            self.assertEqual(error, None)
+
+    def test_failed_task(self):
+        task_checkpoint = checkpoint.Checkpoint(self.directory, task(0, "scheduler-test-broken"))
+        self._submit(tinyback.ScheduledReaper(task_checkpoint.task, concurrency=4, checkpoint=task_checkpoint))
+        self._submit(tinyback.ScheduledReaper(task(1), concurrency=4))
+        self.scheduler.stop()
+
+        self.assertEqual(sorted(call[0] for call in self.calls), [0, 1])
+        for task_id, lines, error in self.calls:
+            if task_id == 0:
+                self.assertEqual((lines, error), (None, RuntimeError))
+            else:
+                self.assertEqual(len(lines), 36)
+        # The failed task let go of its checkpoint
+        other = checkpoint.Checkpoint(self.directory, task_checkpoint.task)
+        self.assertTrue(other.claim())
+        other.release()
+
+    def test_broken_callback(self):
+        def callback(reaper, fileobj, exc_info):
+            self._callback(reaper, fileobj, exc_info)
+            raise RuntimeError("Broken callback")
+
+        for i in xrange(8):
+            self._submit(tinyback.ScheduledReaper(task(i, stop="ab")), callback)
+        self.scheduler.stop()
+        self.assertEqual(sorted(call[0] for call in self.calls), range(8))
+
+    def test_wait(self):
+        self.assertTrue(self.scheduler.wait(1, 0))
+        self._submit(tinyback.ScheduledReaper(task(0)))
+        self.assertTrue(self.scheduler.wait(2, 0))
+        self.assertTrue(self.scheduler.wait(1, 10))
+        self.scheduler.stop()
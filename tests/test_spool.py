@@ -0,0 +1,133 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import StringIO
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tinyback import exceptions, spool
+
+class Rejected(Exception):
+    pass
+
+class Tracker:
+    """
+    Records uploads, rejecting the tasks in fail
+    """
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.uploads = []
+
+    def put(self, task, fileobj, username=None):
+        if task["id"] in self.fail:
+            raise Rejected("Rejected task %s" % task["id"])
+        self.uploads.append((task["id"], fileobj.read(), username))
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = spool.Spool(os.path.join(self.directory, "spool"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _add(self, task_id, data="results", age=0):
+        self.spool.add({"id": task_id, "service": "bitly"}, StringIO.StringIO(data))
+        path = os.path.join(self.spool.directory, "bitly-%s.task" % task_id)
+        mtime = time.time() - 1000 + age
+        os.utime(path, (mtime, mtime))
+
+    def _files(self):
+        return sorted(os.listdir(self.spool.directory))
+
+    def test_send(self):
+        self._add("2", "second", 2)
+        self._add("1", "first", 1)
+        self.assertEqual(self.spool.pending(), ["bitly-1", "bitly-2"])
+        self.assertEqual(self.spool.size(), 11)
+
+        tracker = Tracker()
+        self.assertEqual(self.spool.send(tracker, "user"), 2)
+        self.assertEqual(tracker.uploads, [("1", "first", "user"), ("2", "second", "user")])
+        self.assertEqual(self._files(), [])
+
+    def test_quota(self):
+        self.spool.quota = 10
+        self._add("1", "12345")
+        self.assertRaises(exceptions.SpoolFullException, self._add, "2", "123456")
+        self._add("3", "12345")
+        self.assertEqual(self.spool.pending(), ["bitly-1", "bitly-3"])
+
+    def test_retry(self):
+        self._add("1")
+        tracker = Tracker(["1"])
+        self.assertRaises(Rejected, self.spool.send, tracker)
+        self.assertEqual(self._files(), ["bitly-1.gz", "bitly-1.task"])
+        tracker.fail = set()
+        self.assertEqual(self.spool.send(tracker), 1)
+
+    def test_rejected_task(self):
+        self._add("1", age=1)
+        self._add("2", age=2)
+        tracker = Tracker(["1"])
+        for i in xrange(spool.Spool.MAX_FAILURES):
+            self.assertEqual(self.spool.pending(), ["bitly-1", "bitly-2"])
+            self.assertRaises(Rejected, self.spool.send, tracker)
+        self.assertEqual(tracker.uploads, [])
+
+        # The rejected task went to the back of the queue
+        self.assertEqual(self.spool.pending(), ["bitly-2", "bitly-1"])
+        self.assertRaises(Rejected, self.spool.send, tracker)
+        self.assertEqual([upload[0] for upload in tracker.uploads], ["2"])
+
+    def test_clean(self):
+        self._add("1")
+        old = time.time() - spool.Spool.ORPHAN_AGE - 1
+        for name in ("orphan.gz", "young.gz", "bitly-2.gz.123.tmp"):
+            open(os.path.join(self.spool.directory, name), "w").close()
+        for name in ("orphan.gz", "bitly-2.gz.123.tmp", "bitly-1.gz"):
+            os.utime(os.path.join(self.spool.directory, name), (old, old))
+        self.spool.clean()
+        self.assertEqual(self._files(), ["bitly-1.gz", "bitly-1.task", "young.gz"])
+
+class SenderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_drain(self):
+        results = spool.Spool(self.directory)
+        tracker = Tracker()
+        sender = spool.Sender(results, tracker, interval=0.01)
+        sender.start()
+        results.add({"id": "1", "service": "bitly"}, StringIO.StringIO("results"))
+        sender.notify()
+        for i in xrange(500):
+            if tracker.uploads:
+                break
+            time.sleep(0.01)
+        sender.stop()
+        sender.join(5)
+        self.assertFalse(sender.is_alive())
+        self.assertEqual(tracker.uploads, [("1", "results", None)])
@@ -0,0 +1,89 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from tinyback import strategy
+
+class StrategyTest(unittest.TestCase):
+
+    def _codes(self, fetch, count, body):
+        for i in xrange(count):
+            fetch.request()
+            if body:
+                fetch.body(True)
+
+    def test_switch(self):
+        fetch = strategy.Strategy("bitly")
+        self._codes(fetch, strategy.Strategy.SAMPLES - 1, True)
+        self.assertFalse(fetch.get)
+        self._codes(fetch, 1, True)
+        self.assertTrue(fetch.get)
+
+        # Between the two rates, nothing changes
+        while fetch.rate > strategy.Strategy.HEAD_RATE + 0.05:
+            self._codes(fetch, 1, False)
+        for i in xrange(100):
+            self._codes(fetch, 1, fetch.rate < 0.4)
+        self.assertTrue(fetch.get)
+
+        while fetch.get:
+            self._codes(fetch, 1, False)
+        self.assertTrue(fetch.rate < strategy.Strategy.HEAD_RATE)
+        self.assertEqual(fetch.switches, 2)
+
+    def test_counters(self):
+        fetch = strategy.Strategy("bitly")
+        self._codes(fetch, 10, False)
+        fetch.request()
+        fetch.body(True)
+        fetch.request()
+        fetch.body(False, True)
+        stats = fetch.stats()
+        self.assertEqual((stats["codes"], stats["bodies"], stats["saved"], stats["refetched"]), (12, 2, 1, 1))
+        self.assertEqual(stats["method"], "HEAD")
+        self.assertTrue("1 second requests saved, 1 bodies cut off, 0 switches" in fetch.summary())
+
+    def test_fixed_mode(self):
+        fetch = strategy.Strategy("bitly", "head")
+        self._codes(fetch, 100, True)
+        self.assertFalse(fetch.get)
+        fetch = strategy.Strategy("bitly", "get")
+        self._codes(fetch, 100, False)
+        self.assertTrue(fetch.get)
+
+class ModuleTest(unittest.TestCase):
+
+    def tearDown(self):
+        strategy.configure("auto")
+        strategy._strategies.clear()
+
+    def test_get(self):
+        fetch = strategy.get("bitly")
+        self.assertTrue(strategy.get("bitly") is fetch)
+        strategy.get("isgd").request()
+        fetch.request()
+        strategy.get("tinyurl")
+        self.assertEqual([used.name for used in strategy.strategies()], ["bitly", "isgd"])
+
+    def test_configure(self):
+        fetch = strategy.get("bitly")
+        strategy.configure("get")
+        self.assertTrue(fetch.get)
+        self.assertTrue(strategy.get("isgd").get)
+        strategy.configure("head")
+        self.assertFalse(fetch.get)
+        self.assertRaises(ValueError, strategy.configure, "post")
@@ -16,14 +16,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import gzip
+import Queue
 import hashlib
+import heapq
 import logging
+import shutil
 import sys
-import tempfile
+import threading
 import time
 
-from tinyback import exceptions, generators, services
+from tinyback import archive, bgzf, coverage, exceptions, generators, ratelimit, services, sinks
 
 __version__ = "2.12"
 
@@ -68,86 +70,799 @@ class ServiceTester:
         f.close()
         self._log.info("Finished testing")
 
+class RetryQueue:
+    """
+    Codes waiting to be tried again
+
+    A code that failed is tried again after delay seconds, and the delay
+    doubles with every further attempt.
+    """
+
+    def __init__(self, delay=2):
+        self._delay = delay
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, seq, code, attempts):
+        """
+        Schedule code (number seq in the task) after attempts failed tries
+        """
+        deadline = time.time() + self._delay * 2 ** (attempts - 1)
+        heapq.heappush(self._heap, (deadline, seq, code, attempts))
+
+    def due(self):
+        """
+        Remove and return (seq, code, attempts) for all codes that are due
+        """
+        now = time.time()
+        items = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, seq, code, attempts = heapq.heappop(self._heap)
+            items.append((seq, code, attempts))
+        return items
+
+    def wait(self):
+        """
+        Return the number of seconds until the next code is due
+        """
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.time(), 0)
+
 class Reaper:
+    """
+    Examines the codes of a task one after another
+
+    A code that can not be fetched does not hold up the task: it is put
+    into a retry queue and tried again later, up to MAX_TRIES times, while
+    the following codes are examined. Results are reordered, so they are
+    still written in generator order. At most REORDER_SIZE codes are
+    examined ahead of the oldest code that is not finished yet. When the
+    service blocks us, all Reapers of the service pause (see
+    ratelimit.Circuit).
+
+    With a checkpoint, the Reaper gives up the task as soon as the event
+    stop is set: it saves a checkpoint, so that the task is resumed from
+    there on the next start, and sets interrupted.
+    """
 
     MAX_TRIES = 3
+    REORDER_SIZE = 1000
 
-    def __init__(self, task, progress=False):
+    def __init__(self, task, progress=False, pipeline=None, checkpoint=None, stop=None):
         self._log = logging.getLogger("tinyback.Reaper")
         self._task = task
+        self._checkpoint = checkpoint
+        self._stop = stop
+        self.interrupted = False
+        self._last_checkpoint = time.time()
         self._service = services.factory(self._task["service"])
         self._progress = progress
 
+        self._pipeline = 1
+        if pipeline and getattr(self._service, "http_pipelining", False):
+            self._pipeline = pipeline
+
         self._codes_tried = 0
+        self._codes_skipped = 0
         self._urls_found = 0
+        self._failed = set()
+        self._retries = RetryQueue()
+        self._results = {}
+        self._next_seq = 0
+        self._archive = archive.get(self._task["service"])
+        self._coverage = coverage.get(self._task["service"], self._service.charset)
+        # Only chain tasks skip codes; sequence and list tasks may look at
+        # codes again on purpose, e.g. to find URLs created since
+        self._skip_covered = self._coverage is not None and self._task["generator_type"] == "chain"
 
-        if self._service.rate_limit:
-            self._log.info("Rate limit: %i requests per %i seconds" % self._service.rate_limit)
-            self._rate_limit_bucket = 0
-            self._rate_limit_next = time.time()
+        self._rate_limiter = ratelimit.get(self._task["service"], self._service.rate_limit)
+        self._circuit = ratelimit.circuit(self._task["service"])
+        if self._rate_limiter:
+            self._log.info("Rate limit: %.2f requests per %i seconds" % (self._rate_limiter.rate, self._rate_limiter.per))
 
-    def run(self, temp_dir=None):
+    def run(self, temp_dir=None, sink=None):
+        """
+        Examine all codes of the task
+
+        The results go to sink (a temporary file in temp_dir by default), or
+        to the spool file if the Reaper has a checkpoint. Returns a file with
+        the results, or None if the sink has already delivered them or the
+        task was interrupted.
+        """
         self._log.info("Starting Reaper")
-        fileobj = tempfile.TemporaryFile(dir=temp_dir)
-        gzip_fileobj = gzip.GzipFile(mode="wb", fileobj=fileobj)
+        fileobj, codes = self._open(temp_dir, sink)
+        if codes is None:
+            return fileobj
+        writer = bgzf.BlockWriter(fileobj)
 
-        for code in generators.factory(self._task["generator_type"], self._task["generator_options"]):
-            self._codes_tried += 1
-            blocked = 0
-            tries = 0
-            while tries < (self.MAX_TRIES + blocked):
-                tries += 1
-                self._rate_limit()
-                self._log.debug("Fetching code %s, try %i" % (code, tries))
-                try:
-                    result = self._service.fetch(code)
-                except exceptions.NoRedirectException:
-                    self._log.debug("Code %s does not exist" % code)
-                    break
-                except exceptions.BlockedException:
-                    if self._service.rate_limit:
-                        self._rate_limit_bucket = 0
-                    blocked += 1
-                    wait = (min(5 ** blocked, 3600))
-                    self._log.info("Service blocked us %i times, backing off for %i seconds" % (blocked, wait))
-                    time.sleep(wait)
-                except exceptions.ServiceException, e:
-                    self._log.warn("ServiceException(%s) on code %s" % (e, code))
+        seq = 0
+        for batch in self._batches(codes):
+            uncovered = []
+            for code in batch:
+                if self._skip_covered and code in self._coverage:
+                    self._results[seq] = (code, None, True)
                 else:
-                    if "\n" in result or "\r" in result:
-                        self._log.warn("URL for code %s contains newline" % code)
-                    else:
-                        self._urls_found += 1
-                        self._log.debug("Code %s leads to URL '%s'" % (code, result.decode("ascii", "replace")))
-                        self._print_progress()
-                        gzip_fileobj.write(code + "|")
-                        gzip_fileobj.write(result)
-                        gzip_fileobj.write("\n")
-                    break
+                    uncovered.append((seq, code))
+                seq += 1
+            prefetched, paid = self._prefetch(self._service, [code for code_seq, code in uncovered])
+            for code_seq, code in uncovered:
+                self._attempt(self._service, code_seq, code, 1, code in prefetched, code in paid)
+                # A code may appear twice, only its first fetch is prepaid
+                prefetched.discard(code)
+                paid.discard(code)
+
+            self._retry_due(self._service)
+            self._emit(writer)
+            while self._retries and seq - self._next_seq >= self.REORDER_SIZE and not self._stopping():
+                time.sleep(self._retries.wait())
+                self._retry_due(self._service)
+                self._emit(writer)
+            self._save_checkpoint(writer)
+            if self._stopping():
+                return self._interrupt(writer)
+
+        while self._retries:
+            if self._stopping():
+                return self._interrupt(writer)
+            time.sleep(self._retries.wait())
+            self._retry_due(self._service)
+            self._emit(writer)
+            self._save_checkpoint(writer)
+
+        self._log_summary()
+        return self._close(writer, fileobj)
+
+    @property
+    def codes_skipped(self):
+        """
+        Number of codes left out of the output
+
+        These codes were already examined by earlier tasks, and the archive
+        (if any) does not have a URL for them.
+        """
+        return self._codes_skipped
+
+    def _log_summary(self):
+        message = "Reaper examined %d codes and found %d URLs" % (self._codes_tried, self._urls_found)
+        if self._codes_skipped:
+            message += ", %d codes were skipped as already covered" % self._codes_skipped
+        self._log.info(message)
+
+    def _codes(self):
+        """
+        Return the codes of the task, or of one shard of it
+        """
+        if "shard" in self._task:
+            k, i = self._task["shard"]
+            return generators.shard(self._task["generator_type"], self._task["generator_options"], k, i)
+        return generators.factory(self._task["generator_type"], self._task["generator_options"])
+
+    def _open(self, temp_dir, sink):
+        """
+        Return the result file and the codes that still have to be examined
+
+        Without a checkpoint, the result file is opened by the sink.
+        Otherwise it is the spool file of the checkpoint, and the codes
+        examined before the last checkpoint are skipped. If the task was
+        already finished, the codes are None.
+        """
+        if not self._checkpoint:
+            self._sink = sink or sinks.TemporaryFileSink(temp_dir)
+            return self._sink.open(self._task), self._codes()
+
+        self._sink = None
+        fileobj, state = self._checkpoint.resume()
+        self._codes_tried = state["codes_tried"]
+        self._codes_skipped = state.get("codes_skipped", 0)
+        self._urls_found = state["urls_found"]
+        if state["finished"]:
+            self._log.info("Task was already finished, reusing results")
+            return fileobj, None
+        if self._codes_tried:
+            self._log.info("Resuming task after %i codes" % self._codes_tried)
+        return fileobj, generators.skip(self._codes(), self._codes_tried)
 
-        gzip_fileobj.close()
-        self._log.info("Reaper examined %d codes and found %d URLs" % (self._codes_tried, self._urls_found))
+    def _save_checkpoint(self, writer):
+        """
+        Write a checkpoint if one is due
+
+        Flushes the writer first, so that the spool file ends with a complete
+        block and can be truncated to this point.
+        """
+        if not self._checkpoint or time.time() - self._last_checkpoint < self._checkpoint.interval:
+            return
+        writer.flush()
+        self._checkpoint.save(self._codes_tried, self._urls_found, codes_skipped=self._codes_skipped)
+        self._last_checkpoint = time.time()
+        self._log.debug("Saved checkpoint after %i codes" % self._codes_tried)
+
+    def _stopping(self):
+        """
+        Whether the task should be interrupted
+        """
+        return self._checkpoint is not None and self._stop is not None and self._stop.is_set()
+
+    def _interrupt(self, writer):
+        """
+        Save a checkpoint and give up the task, see run
+        """
+        self._emit(writer)
+        writer.flush()
+        self._checkpoint.save(self._codes_tried, self._urls_found, codes_skipped=self._codes_skipped)
+        self._checkpoint.release()
+        if self._archive:
+            self._archive.flush()
+        ratelimit.registry.save()
+        self.interrupted = True
+        self._log.info("Interrupted task after %i codes, it will be resumed from the checkpoint" % self._codes_tried)
+        return None
+
+    def _close(self, writer, fileobj):
+        writer.close()
+        if self._archive:
+            self._archive.flush()
+        self._cover()
+        if self._checkpoint:
+            self._checkpoint.save(self._codes_tried, self._urls_found, True, self._codes_skipped)
+        ratelimit.registry.save()
+        if self._sink:
+            return self._sink.close()
         return fileobj
 
-    def _rate_limit(self):
-        if not self._service.rate_limit:
+    def _cover(self):
+        """
+        Mark all codes of the task as covered, except those that failed
+
+        This only happens once the task is finished, so the codes of a task
+        that is interrupted and examined again are not skipped.
+        """
+        if not self._coverage:
             return
+        for code in self._codes():
+            if code not in self._failed:
+                self._coverage.add(code)
+
+    def _attempt(self, service, seq, code, attempt, prefetched=False, paid=False):
+        """
+        Try to resolve code, the seq-th code of the task, for the attempt-th time
+        """
+        try:
+            result = self._fetch(service, code, prefetched, paid)
+        except exceptions.ServiceException, e:
+            self._failure(seq, code, attempt, e)
+        else:
+            self._results[seq] = (code, result, False)
+
+    def _failure(self, seq, code, attempt, e):
+        """
+        Schedule code for another try, or give up on it after MAX_TRIES
+        """
+        self._log.warn("ServiceException(%s) on code %s, try %i" % (e, code, attempt))
+        if attempt >= self.MAX_TRIES:
+            self._failed.add(code)
+            self._results[seq] = (code, None, False)
+        else:
+            self._retries.add(seq, code, attempt)
+
+    def _retry_due(self, service):
+        for seq, code, attempts in self._retries.due():
+            self._attempt(service, seq, code, attempts + 1)
+
+    def _emit(self, writer):
+        """
+        Write the results that are next in generator order
+        """
+        while self._next_seq in self._results:
+            code, result, skipped = self._results.pop(self._next_seq)
+            self._next_seq += 1
+            self._codes_tried += 1
+            if skipped:
+                result = self._archived(code)
+                if result is None:
+                    self._codes_skipped += 1
+                    continue
+                self._urls_found += 1
+                writer.write(str(code) + "|" + result + "\n")
+            elif result is not None:
+                self._write(writer, code, result)
+
+    def _archived(self, code):
+        """
+        Return the URL for a skipped code from the archive, or None
+        """
+        if not self._archive:
+            return None
+        return self._archive.lookup(str(code))
 
-        if self._rate_limit_bucket > 0:
-            self._rate_limit_bucket -= 1
+    def _batches(self, codes):
+        """
+        Split codes into lists of up to self._pipeline codes
+        """
+        batch = []
+        for code in codes:
+            batch.append(code)
+            if len(batch) >= self._pipeline:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _prefetch(self, service, batch):
+        """
+        Pipeline HEAD requests for a batch of codes
+
+        Returns two sets: the codes that were answered (see
+        HTTPService.prefetch), and the codes that were not answered but whose
+        rate limit token has already been taken. Codes that appear more than
+        once are only requested once. Nothing is pipelined unless the circuit
+        of the service is closed and the service sends HEAD requests first
+        (see tinyback.strategy).
+        """
+        unique = []
+        for code in batch:
+            if code not in unique:
+                unique.append(code)
+        if len(unique) < 2 or not self._circuit.closed or not service.http_prefetch:
+            return set(), set()
+        for code in unique:
+            self._rate_limit()
+        self._log.debug("Pipelining %i codes" % len(unique))
+        answered = set(service.prefetch(unique))
+        return answered, set(unique) - answered
+
+    def _fetch(self, service, code, prefetched=False, paid=False):
+        """
+        Try to resolve a single code
+
+        Returns the long URL or None if the code does not lead anywhere.
+        Raises ServiceException if the code could not be fetched. While the
+        service blocks us, waits for its circuit and tries again. If
+        prefetched is true, the first request has already been sent. If paid
+        is true, the rate limit token for the first request has already been
+        taken.
+        """
+        while True:
+            if prefetched:
+                probe = False
+                start = None
+                prefetched = False
+            else:
+                probe = self._circuit.wait()
+                if not paid:
+                    try:
+                        self._rate_limit()
+                    except:
+                        self._circuit.release(probe)
+                        raise
+                paid = False
+                start = time.time()
+            try:
+                return self._request(service, code, probe, start)
+            except exceptions.BlockedException:
+                pass
+
+    def _request(self, service, code, probe, start):
+        """
+        Send one request for code and report its outcome
+
+        Returns the long URL or None, as _fetch. Raises BlockedException if
+        the service blocked us. probe is true if the circuit let the request
+        through as the probe, start is the time the request was sent (None
+        if it was pipelined).
+        """
+        try:
+            self._log.debug("Fetching code %s" % code)
+            try:
+                result = service.fetch(code)
+            except exceptions.NoRedirectException:
+                self._circuit.report(probe)
+                probe = False
+                self._rate_limit_success(start)
+                self._log.debug("Code %s does not exist" % code)
+                return None
+            except exceptions.BlockedException:
+                if self._rate_limiter:
+                    self._rate_limiter.failure()
+                cooldown = self._circuit.report(probe, True)
+                probe = False
+                if cooldown is not None:
+                    self._log.info("Service blocked us, pausing all requests for %i seconds" % cooldown)
+                raise
+            self._circuit.report(probe)
+            probe = False
+            self._rate_limit_success(start)
+            if "\n" in result or "\r" in result:
+                self._log.warn("URL for code %s contains newline" % code)
+                return None
+            return result
+        finally:
+            # Other errors say nothing about a block, let someone else probe
+            if probe:
+                self._circuit.release(probe)
+
+    def _write(self, writer, code, result):
+        self._urls_found += 1
+        self._log.debug("Code %s leads to URL '%s'" % (code, result.decode("ascii", "replace")))
+        self._print_progress()
+        writer.write(str(code) + "|" + str(result) + "\n")
+        if self._archive:
+            self._archive.add(str(code), str(result))
+
+    def _rate_limit(self):
+        if not self._rate_limiter:
             return
 
-        wait = self._rate_limit_next - time.time()
+        wait = self._rate_limiter.acquire()
         if wait > 0:
-            self._log.debug("Sleeping for %f seconds to satisfy rate limit" % wait)
-            time.sleep(wait)
+            self._log.debug("Slept for %f seconds to satisfy rate limit" % wait)
 
-        settings = self._service.rate_limit
-        self._rate_limit_bucket = settings[0] - 1
-        self._rate_limit_next = time.time() + settings[1]
+    def _rate_limit_success(self, start):
+        if self._rate_limiter:
+            if start is None:
+                self._rate_limiter.success(None)
+            else:
+                self._rate_limiter.success(time.time() - start)
 
     def _print_progress(self):
         """Print progress for use in Seesaw"""
         if self._progress and self._codes_tried % 10 == 0:
             self._log.info('Found %d URLs of %d examined so far',
                 self._urls_found, self._codes_tried, extra={'progress': True})
+
+class AsyncReaper(Reaper):
+    """
+    Reaper that keeps several requests in flight at once
+
+    Codes are handed to a number of fetch threads, each with its own service
+    instance. Results are written in generator order, so the output is
+    identical to the one produced by Reaper. The number of concurrent
+    requests never exceeds the burst size of the service's rate limit.
+    Failed codes go through the retry queue, as with Reaper.
+    """
+
+    def __init__(self, task, progress=False, concurrency=8, checkpoint=None, stop=None):
+        Reaper.__init__(self, task, progress, checkpoint=checkpoint, stop=stop)
+        if self._service.rate_limit:
+            concurrency = min(concurrency, self._service.rate_limit[0])
+        self._concurrency = max(concurrency, 1)
+
+    def run(self, temp_dir=None, sink=None):
+        self._log.info("Starting AsyncReaper with %i requests in flight" % self._concurrency)
+        fileobj, codes = self._open(temp_dir, sink)
+        if codes is None:
+            return fileobj
+        writer = bgzf.BlockWriter(fileobj)
+
+        work_queue = Queue.Queue()
+        result_queue = Queue.Queue()
+        threads = []
+        for i in range(self._concurrency):
+            thread = threading.Thread(target=self._fetch_thread, args=(work_queue, result_queue))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        try:
+            codes = iter(codes)
+            window = 2 * self._concurrency
+            in_flight = 0
+            seq = 0
+            exhausted = False
+            while True:
+                for item in self._retries.due():
+                    work_queue.put(item)
+                    in_flight += 1
+                while not exhausted and in_flight < window and seq - self._next_seq < self.REORDER_SIZE:
+                    try:
+                        code = codes.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if self._skip_covered and code in self._coverage:
+                        self._results[seq] = (code, None, True)
+                    else:
+                        work_queue.put((seq, code, 0))
+                        in_flight += 1
+                    seq += 1
+
+                self._emit(writer)
+                self._save_checkpoint(writer)
+                if self._stopping():
+                    break
+                if not in_flight:
+                    if not self._retries:
+                        if exhausted:
+                            break
+                        continue
+                    time.sleep(self._retries.wait())
+                    continue
+
+                try:
+                    result_seq, code, attempt, result, error = result_queue.get(timeout=self._retries.wait())
+                except Queue.Empty:
+                    continue
+                in_flight -= 1
+                if not error:
+                    self._results[result_seq] = (code, result, False)
+                elif issubclass(error[0], exceptions.ServiceException):
+                    self._failure(result_seq, code, attempt, error[1])
+                else:
+                    raise error[0], error[1], error[2]
+        finally:
+            for thread in threads:
+                work_queue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        if self._stopping():
+            return self._interrupt(writer)
+        self._log_summary()
+        return self._close(writer, fileobj)
+
+    def _fetch_thread(self, work_queue, result_queue):
+        service = services.factory(self._task["service"])
+        while True:
+            item = work_queue.get()
+            if item is None:
+                return
+            seq, code, attempts = item
+            try:
+                result_queue.put((seq, code, attempts + 1, self._fetch(service, code), None))
+            except:
+                result_queue.put((seq, code, attempts + 1, None, sys.exc_info()))
+
+class ScheduledReaper(Reaper):
+    """
+    Reaper whose requests are sent by the workers of a Scheduler
+
+    The Reaper has no threads of its own. Workers of a
+    tinyback.scheduler.Scheduler take codes from it with next when the rate
+    limit and the circuit of the service allow a request, and fetch them
+    with process. Up to concurrency codes are in flight at once. Results are
+    written in generator order, as with Reaper.
+
+    Workers never wait for the service inside the Reaper: a code that can
+    not be sent because the circuit is open, or that the service blocked,
+    is handed out again by next once delay allows it.
+    """
+
+    def __init__(self, task, concurrency=8, checkpoint=None, stop=None):
+        Reaper.__init__(self, task, checkpoint=checkpoint, stop=stop)
+        self.task = task
+        if self._service.rate_limit:
+            concurrency = min(concurrency, self._service.rate_limit[0])
+        self._concurrency = max(concurrency, 1)
+        self._lock = threading.Lock()
+        self._fileobj = None
+        self._writer = None
+        self._code_iter = None
+        self._seq = 0
+        self._retries_due = []
+        self._in_flight = 0
+        self._exhausted = False
+        self._aborted = False
+
+    def start(self, temp_dir=None, sink=None):
+        """
+        Open the result file, see Reaper.run
+
+        Returns the results if the task was already finished before (as
+        recorded by the checkpoint), otherwise None.
+        """
+        self._log.info("Starting ScheduledReaper with up to %i requests in flight" % self._concurrency)
+        fileobj, codes = self._open(temp_dir, sink)
+        if codes is None:
+            return fileobj
+        self._fileobj = fileobj
+        self._writer = bgzf.BlockWriter(fileobj)
+        self._code_iter = iter(codes)
+        return None
+
+    def ready(self):
+        """
+        Return the number of seconds until there is a code to fetch
+
+        Returns None if there is nothing to fetch until a request that is in
+        flight comes back, or if the task is being interrupted.
+        """
+        if self._stopping():
+            return None
+        with self._lock:
+            due = self._retries.wait()
+            if due == 0 or self._retries_due:
+                return 0
+            if not self._exhausted and self._in_flight < self._concurrency and self._seq - self._next_seq < self.REORDER_SIZE:
+                return 0
+            return due
+
+    def delay(self):
+        """
+        Return the number of seconds until the service takes a request
+        """
+        delay = self._circuit.delay()
+        if self._rate_limiter:
+            delay = max(delay, self._rate_limiter.delay())
+        return delay
+
+    def reserve(self):
+        """
+        Take a token from the rate limit, see TokenBucket.reserve
+        """
+        if self._rate_limiter:
+            return self._rate_limiter.reserve()
+        return 0
+
+    def next(self):
+        """
+        Return (seq, code, attempts) for the next code to fetch, or None
+        """
+        with self._lock:
+            if self._aborted or self._stopping():
+                return None
+            for item in self._retries.due():
+                self._retries_due.append(item)
+            if self._retries_due:
+                self._in_flight += 1
+                return self._retries_due.pop(0)
+            while not self._exhausted and self._in_flight < self._concurrency and self._seq - self._next_seq < self.REORDER_SIZE:
+                try:
+                    code = self._code_iter.next()
+                except StopIteration:
+                    self._exhausted = True
+                    break
+                seq = self._seq
+                self._seq += 1
+                if self._skip_covered and code in self._coverage:
+                    self._results[seq] = (code, None, True)
+                    self._emit(self._writer)
+                    continue
+                self._in_flight += 1
+                return seq, code, 0
+            self._emit(self._writer)
+            return None
+
+    @property
+    def finished(self):
+        with self._lock:
+            if self._stopping():
+                return not self._in_flight
+            return self._exhausted and not self._in_flight and not self._retries and not self._retries_due
+
+    def process(self, item):
+        """
+        Fetch the code of an item returned by next
+
+        The rate limit token has to be taken with reserve first. If the
+        request can not be sent or was blocked, the item is put back.
+        """
+        seq, code, attempts = item
+        delay, probe = self._circuit.reserve()
+        if delay > 0:
+            self._put_back(item)
+            return
+        error = None
+        try:
+            result = self._request(self._service, code, probe, time.time())
+        except exceptions.BlockedException:
+            self._put_back(item)
+            return
+        except exceptions.ServiceException, e:
+            error = e
+        with self._lock:
+            if self._aborted:
+                return
+            self._in_flight -= 1
+            if error:
+                self._failure(seq, code, attempts + 1, error)
+            else:
+                self._results[seq] = (code, result, False)
+            self._emit(self._writer)
+            self._save_checkpoint(self._writer)
+
+    def abort(self):
+        """
+        Give up on the task once it has failed
+
+        Results that have not been written are dropped, and the result file
+        is closed (releasing the checkpoint, if any). Codes that are still
+        in flight are dropped when they come back.
+        """
+        with self._lock:
+            if self._aborted:
+                return
+            self._aborted = True
+            if self._writer:
+                self._writer.abort()
+            if self._checkpoint:
+                self._checkpoint.release()
+            elif self._sink and self._fileobj:
+                self._sink.abort()
+
+    def _put_back(self, item):
+        """
+        Hand out an item again, before any other code
+        """
+        with self._lock:
+            if self._aborted:
+                return
+            self._in_flight -= 1
+            self._retries_due.insert(0, item)
+
+    def finish(self):
+        """
+        Close the result file once the Reaper is finished, see Reaper.run
+        """
+        with self._lock:
+            if self._stopping():
+                return self._interrupt(self._writer)
+            self._emit(self._writer)
+        self._log_summary()
+        return self._close(self._writer, self._fileobj)
+
+class ShardedReaper:
+    """
+    Reaper that splits a task into several shards
+
+    Each shard is a contiguous part of the task's codes (see
+    generators.shard) and is handled by its own Reaper in its own thread. The
+    shard results are merged back into the order of the unsharded task.
+    All shards share the rate limit of the service.
+    """
+
+    def __init__(self, task, shards, progress=False, pipeline=None):
+        self._log = logging.getLogger("tinyback.ShardedReaper")
+        self._task = task
+        self._reapers = []
+        for i in range(shards):
+            shard_task = dict(task)
+            shard_task["shard"] = (shards, i)
+            self._reapers.append(Reaper(shard_task, progress and i == 0, pipeline))
+
+    @property
+    def codes_skipped(self):
+        return sum(reaper.codes_skipped for reaper in self._reapers)
+
+    def run(self, temp_dir=None, sink=None):
+        self._log.info("Starting %i shards" % len(self._reapers))
+        results = [None] * len(self._reapers)
+        errors = []
+
+        def run_shard(i):
+            try:
+                results[i] = self._reapers[i].run(temp_dir)
+            except:
+                errors.append(sys.exc_info())
+
+        threads = []
+        for i in range(len(self._reapers)):
+            thread = threading.Thread(target=run_shard, args=(i,))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        try:
+            if errors:
+                raise errors[0][0], errors[0][1], errors[0][2]
+            sink = sink or sinks.TemporaryFileSink(temp_dir)
+            merge(results, sink.open(self._task))
+            return sink.close()
+        finally:
+            for fileobj in results:
+                if fileobj:
+                    fileobj.close()
+
+def merge(fileobjs, fileobj):
+    """
+    Append the results of several shards to fileobj
+
+    The shard results must be given in shard order. Since the results consist
+    of independent blocks (see bgzf), the files are simply concatenated.
+    """
+    for shard_fileobj in fileobjs:
+        shard_fileobj.seek(0)
+        shutil.copyfileobj(shard_fileobj, fileobj)
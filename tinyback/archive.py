@@ -0,0 +1,472 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.archive - Local archive of all results with a code index
+
+There is one store per service. Results are appended as code|url lines to
+data segments, which are never modified. The index is a file of fixed-size
+records (code, segment, offset), sorted by code, that is memory-mapped for
+lookups. Results appended since the index was built (the tail) are kept in
+an index in memory, which is brought up to date by reading only the lines
+appended since it was last read. Lookups only look at the files again after
+this store flushed or compacted, or after REFRESH_INTERVAL to see results
+appended by other processes. Once the tail grows beyond a threshold, a
+background thread merges it into the index (compaction), so writers never
+wait for it. If a code was archived more than once, the newest result wins.
+
+Codes longer than KEY_SIZE are stored truncated in the index; lookups check
+the full code in the data segment.
+"""
+
+import bisect
+import glob
+import heapq
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+KEY_SIZE = 24
+RECORD = struct.Struct("<%isIQ" % KEY_SIZE)
+
+class Store:
+    """
+    Archive of the results for one service
+
+    Results are buffered in memory and appended to the data segments by
+    flush. Writers in several processes may share a store.
+    """
+
+    # Start a new data segment when the current one is this large
+    SEGMENT_SIZE = 256 * 1024 * 1024
+    # Compact when this many bytes have been appended since the last time
+    COMPACT_SIZE = 16 * 1024 * 1024
+    # Flush when this many bytes are buffered
+    BUFFER_SIZE = 65536
+    # Tail records to sort at once when compacting
+    RUN_SIZE = 4096
+    # Look for results appended by other processes at most this often
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(self, directory):
+        self._log = logging.getLogger("tinyback.archive")
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._index_file = os.path.join(directory, "index")
+        self._state_file = os.path.join(directory, "index.json")
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffered = 0
+        self._segments = {}
+        self._read_lock = threading.Lock()
+        self._index = None
+        self._index_stat = None
+        self._compactor = None
+        # Index of the tail: code -> (segment, offset) for the lines from
+        # _tail_start to _tail_end, and the codes in order (built on demand)
+        self._tail_lock = threading.Lock()
+        self._tail_codes = {}
+        self._tail_sorted = None
+        self._tail_start = None
+        self._tail_end = None
+        # Changed by every flush and compaction of this store, so the tail
+        # is brought up to date before the next lookup
+        self._version = 0
+        self._tail_version = None
+        self._tail_time = None
+
+    def add(self, code, url):
+        with self._lock:
+            self._buffer.append("%s|%s\n" % (code, url))
+            self._buffered += len(code) + len(url) + 2
+            if self._buffered >= self.BUFFER_SIZE:
+                self._flush()
+
+    def flush(self):
+        """
+        Append buffered results to the data segments
+
+        Starts a compaction in the background if the tail has grown too
+        large.
+        """
+        with self._lock:
+            self._flush()
+
+    def lookup(self, code):
+        """
+        Return the URL for code, or None if it is not in the archive
+        """
+        position = self._tail().get(code)
+        if position:
+            return self._read(*position)[1]
+        # The index lists newer results first
+        for found, url in self._indexed(code, True):
+            return url
+        return None
+
+    def prefix(self, prefix):
+        """
+        Return (code, url) for all codes starting with prefix, sorted by code
+        """
+        tail = self._tail_prefix(prefix)
+        results = {}
+        for code, url in self._indexed(prefix, False):
+            results.setdefault(code, url)
+        for code, position in tail:
+            results[code] = self._read(*position)[1]
+        return sorted(results.items())
+
+    def compact(self):
+        """
+        Merge the tail into the index
+        """
+        with _FileLock(os.path.join(self.directory, "compact.lock")):
+            self._compact()
+
+    def stats(self):
+        """
+        Return the number of indexed codes and the size of the tail in bytes
+        """
+        segment, offset = self._indexed_position()
+        tail = 0
+        for number in self._segment_numbers():
+            if number >= segment:
+                tail += os.path.getsize(self._segment_path(number)) - (offset if number == segment else 0)
+        index = 0
+        if os.path.exists(self._index_file):
+            index = os.path.getsize(self._index_file) // RECORD.size
+        return index, tail
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        data = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        with _FileLock(os.path.join(self.directory, "lock")):
+            numbers = self._segment_numbers()
+            number = numbers[-1] if numbers else 0
+            path = self._segment_path(number)
+            if os.path.exists(path) and os.path.getsize(path) >= self.SEGMENT_SIZE:
+                number += 1
+                path = self._segment_path(number)
+            f = open(path, "ab")
+            try:
+                f.write(data)
+            finally:
+                f.close()
+        self._version += 1
+
+        if self.stats()[1] >= self.COMPACT_SIZE and not (self._compactor and self._compactor.is_alive()):
+            # Not a daemon thread, so the index is not left half-written
+            self._compactor = threading.Thread(target=self._compact_thread)
+            self._compactor.start()
+
+    def _compact_thread(self):
+        try:
+            with _FileLock(os.path.join(self.directory, "compact.lock")):
+                # Another process may have compacted the store in the meantime
+                if self.stats()[1] >= self.COMPACT_SIZE:
+                    self._compact()
+        except Exception:
+            self._log.exception("Compacting %s failed" % self.directory)
+
+    def _compact(self):
+        """
+        Merge the tail into the index
+
+        Appending to the store goes on meanwhile, so only complete lines are
+        merged. The index records between two tail records are copied as
+        they are; since the tail is sorted, the next one is found by
+        galloping forward from the last. The tail is sorted in small runs,
+        as sorting it at once would hold the GIL for too long.
+        """
+        runs = [[]]
+        end = None
+        for i, (code, segment, offset, length) in enumerate(self._scan(self._indexed_position())):
+            # Newer results sort first among equal keys
+            runs[-1].append((_key(code), -i - 1, segment, offset))
+            end = segment, offset + length
+            if len(runs[-1]) >= self.RUN_SIZE:
+                runs[-1].sort()
+                runs.append([])
+        if end is None:
+            return
+        runs[-1].sort()
+
+        index = self._open_index() or ""
+        count = len(index) // RECORD.size
+        temp_file = "%s.%i.tmp" % (self._index_file, os.getpid())
+        f = open(temp_file, "wb")
+        try:
+            position = 0
+            previous = None
+            for key, order, segment, offset in heapq.merge(*runs):
+                # Truncated keys may belong to different codes, keep them all
+                truncated = key[-1] != "\0"
+                if key == previous and not truncated:
+                    continue
+                previous = key
+                stop = _gallop(index, key, position, count)
+                f.write(buffer(index, position * RECORD.size, (stop - position) * RECORD.size))
+                f.write(RECORD.pack(key, segment, offset))
+                position = stop
+                if not truncated:
+                    while position < count and RECORD.unpack_from(index, position * RECORD.size)[0] == key:
+                        position += 1
+            f.write(buffer(index, position * RECORD.size))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_file, self._index_file)
+
+        temp_file = "%s.%i.tmp" % (self._state_file, os.getpid())
+        f = open(temp_file, "w")
+        try:
+            json.dump({"segment": end[0], "offset": end[1]}, f)
+        finally:
+            f.close()
+        os.rename(temp_file, self._state_file)
+        self._version += 1
+
+    def _indexed(self, code, exact):
+        """
+        Yield (code, url) from the index for code, or for all codes starting
+        with code if exact is false
+
+        Uses the index mapped by the last call to _tail.
+        """
+        index = self._index
+        if not index:
+            return
+        key = code[:KEY_SIZE]
+        count = len(index) // RECORD.size
+
+        for i in xrange(_bisect(index, key, 0, count), count):
+            found_key, segment, offset = RECORD.unpack_from(index, i * RECORD.size)
+            if not found_key.startswith(key):
+                return
+            if exact and found_key.rstrip("\0") != key:
+                return
+            found, url = self._read(segment, offset)
+            if found == code or (not exact and found.startswith(code)):
+                yield found, url
+
+    def _open_index(self):
+        """
+        Return the memory-mapped index, mapping it again if it was rebuilt
+        """
+        try:
+            stat = os.stat(self._index_file)
+        except OSError:
+            return None
+        stat = (stat.st_ino, stat.st_size, stat.st_mtime)
+        if stat != self._index_stat:
+            f = open(self._index_file, "rb")
+            try:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return None
+                self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+            self._index_stat = stat
+        return self._index
+
+    def _tail(self):
+        """
+        Return the index of the tail as a dictionary code -> (segment, offset)
+
+        The files are only looked at if this store was flushed or compacted
+        since the last call, or REFRESH_INTERVAL has passed. Then the index is
+        mapped again if it was rebuilt, and only the lines appended since the
+        last call are read, unless the store was compacted meanwhile.
+        """
+        with self._tail_lock:
+            version = self._version
+            now = time.time()
+            if version == self._tail_version and now - self._tail_time < self.REFRESH_INTERVAL:
+                return self._tail_codes
+            self._tail_version = version
+            self._tail_time = now
+
+            start = self._indexed_position()
+            self._open_index()
+            if start != self._tail_start:
+                self._tail_codes = {}
+                self._tail_sorted = None
+                self._tail_start = self._tail_end = start
+            for code, segment, offset, length in self._scan(self._tail_end):
+                self._tail_codes[code] = segment, offset
+                self._tail_sorted = None
+                self._tail_end = segment, offset + length
+            return self._tail_codes
+
+    def _tail_prefix(self, prefix):
+        """
+        Return (code, (segment, offset)) for the codes in the tail starting
+        with prefix
+        """
+        codes = self._tail()
+        with self._tail_lock:
+            if self._tail_sorted is None:
+                self._tail_sorted = sorted(codes)
+            tail_sorted = self._tail_sorted
+        results = []
+        for i in xrange(bisect.bisect_left(tail_sorted, prefix), len(tail_sorted)):
+            if not tail_sorted[i].startswith(prefix):
+                break
+            results.append((tail_sorted[i], codes[tail_sorted[i]]))
+        return results
+
+    def _scan(self, start):
+        """
+        Yield (code, segment, offset, length) for all complete lines from
+        the position start on
+        """
+        segment, offset = start
+        for number in self._segment_numbers():
+            if number < segment:
+                continue
+            f = open(self._segment_path(number), "rb")
+            try:
+                position = offset if number == segment else 0
+                f.seek(position)
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    yield line.split("|", 1)[0], number, position, len(line)
+                    position += len(line)
+            finally:
+                f.close()
+
+    def _read(self, segment, offset):
+        with self._read_lock:
+            f = self._segments.get(segment)
+            if not f:
+                f = self._segments[segment] = open(self._segment_path(segment), "rb")
+            f.seek(offset)
+            line = f.readline()
+        code, url = line.rstrip("\n").split("|", 1)
+        return code, url
+
+    def _indexed_position(self):
+        try:
+            f = open(self._state_file, "r")
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return 0, 0
+        return state["segment"], state["offset"]
+
+    def _segment_numbers(self):
+        return sorted(int(os.path.basename(path)[:-4]) for path in glob.glob(os.path.join(self.directory, "*.seg")))
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, "%08i.seg" % number)
+
+class _FileLock:
+    """
+    Exclusive lock on a file, shared between processes
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._fileobj = None
+
+    def __enter__(self):
+        self._fileobj = open(self._path, "a")
+        if fcntl:
+            fcntl.flock(self._fileobj.fileno(), fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        self._fileobj.close()
+
+def _key(code):
+    return code[:KEY_SIZE].ljust(KEY_SIZE, "\0")
+
+def _bisect(index, key, lo, hi):
+    """
+    Return the number of the first record from lo to hi with a key not less
+    than key
+    """
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if RECORD.unpack_from(index, mid * RECORD.size)[0] < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+def _gallop(index, key, lo, hi):
+    """
+    Same as _bisect, but faster if the result is close to lo
+    """
+    if lo >= hi or RECORD.unpack_from(index, lo * RECORD.size)[0] >= key:
+        return lo
+    step = 1
+    while lo + step < hi and RECORD.unpack_from(index, (lo + step) * RECORD.size)[0] < key:
+        lo += step
+        step *= 2
+    return _bisect(index, key, lo + 1, min(lo + step, hi))
+
+_directory = None
+_stores = {}
+_lock = threading.Lock()
+
+def configure(directory):
+    """
+    Archive all results in directory, one store per service
+    """
+    global _directory
+    _directory = directory
+
+def exists(service):
+    """
+    Whether the archive has a store for service
+    """
+    return bool(_directory) and os.path.isdir(_store_path(service))
+
+def get(service):
+    """
+    Return the store for service, or None if there is no archive
+
+    The store is created if it does not exist yet.
+    """
+    if not _directory:
+        return None
+    with _lock:
+        store = _stores.get(service)
+        if not store:
+            store = _stores[service] = Store(_store_path(service))
+        return store
+
+def _store_path(service):
+    return os.path.join(_directory, re.sub(r"[^A-Za-z0-9_.-]", "_", service))
@@ -0,0 +1,289 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.bgzf - Block-compressed result files
+
+Results are written as a series of independent gzip members of at most 64 KiB
+each, like BGZF, so the file is still a valid gzip file. Every block carries
+two subfields in the gzip extra field: BC with the size of the block (as in
+BGZF) and TB with the first code in the block. The block index can therefore
+be read from the block headers alone, without decompressing anything, and
+looking up a single code only needs one block to be decompressed.
+
+A line that does not fit into one block on its own (a very long URL) is
+split across several blocks. Only the first of them has a TB subfield, the
+others continue it, and read_block returns them together.
+
+Blocks are compressed by a pool of background threads shared by all writers
+of the process; zlib releases the GIL, so this does not slow down the
+threads that write the results. Without compression threads, blocks are
+compressed by the writing thread.
+"""
+
+import Queue
+import struct
+import sys
+import threading
+import zlib
+
+# Uncompressed bytes per block. BGZF limits blocks to 64 KiB compressed;
+# blocks that do not compress well enough are split.
+BLOCK_SIZE = 65280
+MAX_BLOCK = 65536
+
+_level = 6
+_threads = 1
+_queue = Queue.Queue()
+_pool = []
+_pool_lock = threading.Lock()
+
+# Empty block marking the end of the file, as in BGZF
+EOF_BLOCK = "1f8b08040000000000ff0600424302001b0003000000000000000000".decode("hex")
+
+def configure(level=None, threads=None):
+    """
+    Set the compression level and the number of compression threads
+
+    With 0 threads, blocks are compressed by the thread writing them.
+    """
+    global _level, _threads
+    if level is not None:
+        _level = level
+    if threads is not None:
+        if threads < 0:
+            raise ValueError("Number of compression threads must not be negative")
+        _threads = threads
+
+def compress_block(data, first_code=None):
+    """
+    Return data compressed as one gzip member with BC and TB subfields
+
+    Without first_code, the block has no TB subfield and continues the
+    block before it. Returns None if the block would be larger than
+    MAX_BLOCK.
+    """
+    compressor = zlib.compressobj(_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    extra = ""
+    if first_code is not None:
+        extra = "TB" + struct.pack("<H", len(first_code)) + first_code
+    size = 12 + 6 + len(extra) + len(deflated) + 8
+    if size > MAX_BLOCK:
+        return None
+    header = struct.pack("<BBBBIBBH", 0x1f, 0x8b, 8, 4, 0, 0, 255, 6 + len(extra))
+    header += "BC" + struct.pack("<HH", 2, size - 1)
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + extra + deflated + trailer
+
+class _Block:
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.data = None
+        self.error = None
+        self.done = threading.Event()
+
+    def compress(self):
+        try:
+            self.data = "".join(_compress(self.lines))
+        except:
+            self.error = sys.exc_info()
+        self.lines = None
+        self.done.set()
+
+class BlockWriter:
+    """
+    Writes result lines (code|url) to fileobj in compressed blocks
+
+    Lines are collected in memory until a block is full and then handed to
+    the compression threads. Blocks are written to fileobj in order. Call
+    flush to write everything written so far (e.g. before a checkpoint) and
+    close to finish the file, or abort to give up on it; fileobj itself is
+    not closed.
+    """
+
+    def __init__(self, fileobj, block_size=BLOCK_SIZE):
+        self._fileobj = fileobj
+        self._block_size = block_size
+        self._lines = []
+        self._size = 0
+        self._pending = []
+        self._max_pending = 2 * _threads + 1
+        _start_pool()
+
+    def write(self, line):
+        self._lines.append(line)
+        self._size += len(line)
+        if self._size >= self._block_size:
+            self._submit()
+
+    def flush(self):
+        self._submit()
+        self._write_blocks(0)
+        self._fileobj.flush()
+
+    def close(self):
+        self.flush()
+        self._fileobj.write(EOF_BLOCK)
+
+    def abort(self):
+        """
+        Drop everything that has not been written to fileobj yet
+        """
+        self._lines = []
+        self._size = 0
+        self._pending = []
+
+    def _submit(self):
+        if self._lines:
+            block = _Block(self._lines)
+            self._lines = []
+            self._size = 0
+            self._pending.append(block)
+            if _pool:
+                _queue.put(block)
+            else:
+                block.compress()
+        self._write_blocks(self._max_pending)
+
+    def _write_blocks(self, keep):
+        """
+        Write finished blocks, waiting until at most keep blocks are pending
+        """
+        while self._pending:
+            block = self._pending[0]
+            if len(self._pending) <= keep and not block.done.is_set():
+                return
+            block.done.wait()
+            self._pending.pop(0)
+            if block.error:
+                self.abort()
+                raise block.error[0], block.error[1], block.error[2]
+            self._fileobj.write(block.data)
+
+def _start_pool():
+    """
+    Start compression threads until there are as many as configured
+    """
+    with _pool_lock:
+        while len(_pool) < _threads:
+            thread = threading.Thread(target=_compress_thread)
+            thread.daemon = True
+            thread.start()
+            _pool.append(thread)
+
+def _compress_thread():
+    while True:
+        _queue.get().compress()
+
+def _compress(lines):
+    first_code = lines[0].split("|", 1)[0]
+    data = compress_block("".join(lines), first_code)
+    if data:
+        return [data]
+    if len(lines) == 1:
+        return _split(lines[0], first_code)
+    middle = len(lines) // 2
+    return _compress(lines[:middle]) + _compress(lines[middle:])
+
+def _split(data, first_code):
+    """
+    Compress a single line into as many blocks as it needs
+    """
+    block = compress_block(data, first_code)
+    if block:
+        return [block]
+    middle = len(data) // 2
+    return _split(data[:middle], first_code) + _split(data[middle:], None)
+
+def index(fileobj):
+    """
+    Return a list of (offset, first code) for all blocks in fileobj
+
+    Only the block headers are read. Blocks without a TB subfield (like the
+    end of file block) are left out.
+    """
+    blocks = []
+    offset = 0
+    while True:
+        fileobj.seek(offset)
+        header = fileobj.read(12)
+        if len(header) < 12:
+            return blocks
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = fileobj.read(xlen)
+        subfields = _subfields(extra)
+        if "BC" not in subfields:
+            raise ValueError("Block at offset %i has no size" % offset)
+        if "TB" in subfields:
+            blocks.append((offset, subfields["TB"]))
+        offset += struct.unpack("<H", subfields["BC"])[0] + 1
+
+def read_block(fileobj, offset):
+    """
+    Return the uncompressed data of the block at offset
+
+    Blocks without a TB subfield that follow it are part of the same line
+    and are included.
+    """
+    data = []
+    while True:
+        fileobj.seek(offset)
+        header = fileobj.read(12)
+        if len(header) < 12:
+            break
+        xlen = struct.unpack("<H", header[10:12])[0]
+        subfields = _subfields(fileobj.read(xlen))
+        if data and "TB" in subfields:
+            break
+        size = struct.unpack("<H", subfields["BC"])[0] + 1
+        deflated = fileobj.read(size - 12 - xlen - 8)
+        data.append(zlib.decompress(deflated, -zlib.MAX_WBITS))
+        offset += size
+    return "".join(data)
+
+def lookup(fileobj, code, key=None, blocks=None):
+    """
+    Return the URL for code, or None if the file has no result for it
+
+    key maps codes to their position in the task (e.g. Codec.encode for
+    sequence tasks); with it, only the block that may contain code is
+    decompressed. Without it, blocks are searched one by one. blocks is the
+    result of index, if it is already known.
+    """
+    if blocks is None:
+        blocks = index(fileobj)
+    if key:
+        position = key(code)
+        candidates = [offset for offset, first_code in blocks if key(first_code) <= position][-1:]
+    else:
+        candidates = [offset for offset, first_code in blocks]
+
+    prefix = code + "|"
+    for offset in candidates:
+        for line in read_block(fileobj, offset).splitlines():
+            if line.startswith(prefix):
+                return line[len(prefix):]
+    return None
+
+def _subfields(extra):
+    subfields = {}
+    while len(extra) >= 4:
+        length = struct.unpack("<H", extra[2:4])[0]
+        subfields[extra[0:2]] = extra[4:4 + length]
+        extra = extra[4 + length:]
+    return subfields
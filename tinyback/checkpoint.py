@@ -0,0 +1,177 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.checkpoint - Resume interrupted tasks
+
+A checkpoint consists of two files in the checkpoint directory: the spool file
+with the results written so far, as a series of complete gzip members, and a
+small state file recording the task, the number of codes examined and the
+length of the spool file at that point. Since results are written in
+generator order, the number of codes examined is enough to continue the
+generator where it stopped.
+"""
+
+import errno
+import glob
+import json
+import logging
+import os
+import re
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class Checkpoint:
+    """
+    Checkpoint for a single task
+
+    A checkpoint has to be claimed before use, so that no two threads or
+    processes work on the same task. The claim is released when the spool
+    file is closed, including when the process dies.
+    """
+
+    # Seconds between two checkpoints
+    interval = 60
+
+    def __init__(self, directory, task):
+        self._log = logging.getLogger("tinyback.checkpoint")
+        self.task = task
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", "%s-%s" % (task["service"], task["id"]))
+        self._state_file = os.path.join(directory, name + ".checkpoint")
+        self._spool_file = os.path.join(directory, name + ".gz")
+        self._fileobj = None
+
+    def claim(self):
+        """
+        Open the spool file and lock it
+
+        Returns False if the checkpoint is already in use.
+        """
+        fd = os.open(self._spool_file, os.O_RDWR | os.O_CREAT, 0644)
+        fileobj = os.fdopen(fd, "r+b")
+        if fcntl:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                fileobj.close()
+                return False
+        self._fileobj = fileobj
+        return True
+
+    def resume(self):
+        """
+        Return the spool file and the state of the last checkpoint
+
+        The spool file is truncated to the length it had at the last
+        checkpoint and positioned at its end. Without a usable checkpoint,
+        the spool file is emptied and the state describes a fresh start.
+        """
+        if not self._fileobj and not self.claim():
+            raise Exception("Checkpoint for task %s is in use" % self.task["id"])
+
+        state = self._load()
+        if not state:
+            state = {"codes_tried": 0, "codes_skipped": 0, "urls_found": 0, "offset": 0, "finished": False}
+        self._fileobj.truncate(state["offset"])
+        self._fileobj.seek(0, os.SEEK_END)
+        return self._fileobj, state
+
+    def save(self, codes_tried, urls_found, finished=False, codes_skipped=0):
+        """
+        Record the current position
+
+        Everything written to the spool file so far must be complete gzip
+        members. The spool file is synced to disk before the state file is
+        replaced, so the state never points past the data on disk.
+        """
+        self._fileobj.flush()
+        os.fsync(self._fileobj.fileno())
+
+        state = {
+            "task": self.task,
+            "codes_tried": codes_tried,
+            "codes_skipped": codes_skipped,
+            "urls_found": urls_found,
+            "offset": self._fileobj.tell(),
+            "finished": finished,
+        }
+        temp_file = "%s.%i.tmp" % (self._state_file, os.getpid())
+        f = open(temp_file, "w")
+        try:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_file, self._state_file)
+
+    def release(self):
+        """
+        Close the spool file, so that the checkpoint can be claimed again
+        """
+        if self._fileobj:
+            self._fileobj.close()
+            self._fileobj = None
+
+    def remove(self):
+        """
+        Delete the checkpoint once its results have been delivered
+        """
+        for path in (self._state_file, self._spool_file):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _load(self):
+        try:
+            f = open(self._state_file, "r")
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            self._log.debug("Could not read checkpoint: %s" % e)
+            return None
+        if state.get("task") != self.task:
+            self._log.warn("Checkpoint belongs to a different task, ignoring it")
+            return None
+        return state
+
+def pending(directory):
+    """
+    Return checkpoints for all interrupted tasks in directory
+    """
+    checkpoints = []
+    for state_file in sorted(glob.glob(os.path.join(directory, "*.checkpoint"))):
+        try:
+            f = open(state_file, "r")
+            try:
+                task = json.load(f)["task"]
+            finally:
+                f.close()
+        except (IOError, ValueError, KeyError):
+            continue
+        checkpoints.append(Checkpoint(directory, task))
+    return checkpoints
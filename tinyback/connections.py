@@ -0,0 +1,278 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.connections - Shared HTTP connection pools
+
+Services check out a connection for every request and hand it back
+afterwards, so persistent connections are reused by all Reapers of a process
+and across tasks instead of being set up again for every task.
+"""
+
+import httplib
+import platform
+import select
+import socket
+import threading
+import time
+import urlparse
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent connections to one host
+
+    Up to `size` idle connections are kept. Connections that have been idle
+    for more than `idle_timeout` seconds are closed, and connections that the
+    server has closed (or that have unexpected data waiting) are discarded on
+    checkout.
+    """
+
+    def __init__(self, scheme, netloc, size=4, idle_timeout=60, timeout=30):
+        if scheme == "http":
+            self._klass = httplib.HTTPConnection
+        elif scheme == "https":
+            self._klass = httplib.HTTPSConnection
+        else:
+            raise ValueError("Unknown scheme %s" % scheme)
+
+        self.scheme = scheme
+        self.netloc = netloc
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Check out a connection
+        """
+        with self._lock:
+            self._evict()
+            while self._idle:
+                conn, since = self._idle.pop()
+                if self._healthy(conn):
+                    return conn
+                conn.close()
+        return self._connect()
+
+    def put(self, conn):
+        """
+        Return a connection that may be used for further requests
+        """
+        with self._lock:
+            self._evict()
+            if len(self._idle) < self.size:
+                self._idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    # Bytes to read at a time when reading a body incrementally
+    CHUNK_SIZE = 4096
+    # Read the rest of a body anyway if no more than this is left, so the
+    # connection can be reused
+    DRAIN_SIZE = 4 * CHUNK_SIZE
+
+    def request(self, method, path, headers=None, reuse=None, limit=None, until=None):
+        """
+        Perform a request on a pooled connection
+
+        Returns a tuple with the response object and the response body. The
+        connection goes back to the pool unless the server wants to close it
+        or reuse (called with the response) returns False. Exceptions from
+        httplib and socket are passed on.
+
+        If limit is given, at most limit bytes of the body are read. If until
+        is given, it is called with the body read so far after every chunk,
+        and reading stops once it returns True. If the rest of the body is
+        known to be at most DRAIN_SIZE bytes, it is read (and returned)
+        anyway. Otherwise resp.truncated is true and the connection is closed
+        instead of reading the rest.
+        """
+        conn = self.get()
+        try:
+            conn.request(method, path, headers=headers or {})
+            resp = conn.getresponse()
+            if limit is None and until is None:
+                data = resp.read()
+            else:
+                data = self._read(resp, limit, until)
+                if not resp.isclosed() and resp.length is not None and resp.length <= self.DRAIN_SIZE:
+                    data += resp.read()
+            resp.truncated = not resp.isclosed()
+        except:
+            conn.close()
+            raise
+
+        if resp.truncated or resp.will_close or (reuse and not reuse(resp)):
+            conn.close()
+        else:
+            self.put(conn)
+        return resp, data
+
+    def pipeline(self, method, paths, headers=None, reuse=None):
+        """
+        Send several bodiless requests back-to-back on one connection
+
+        Returns a list of response objects, in the order of paths. If the
+        server closes the connection before answering all requests, only the
+        responses that were received are returned; it is up to the caller to
+        repeat the remaining requests. Exceptions from httplib and socket are
+        only passed on if not even the first request could be sent.
+        """
+        conn = self.get()
+        if conn.sock is None:
+            try:
+                conn.connect()
+            except:
+                conn.close()
+                raise
+
+        request = []
+        for path in paths:
+            request.append("%s %s HTTP/1.1\r\nHost: %s\r\nAccept-Encoding: identity\r\n" % (method, path, self.netloc))
+            for name, value in (headers or {}).items():
+                request.append("%s: %s\r\n" % (name, value))
+            request.append("\r\n")
+        try:
+            conn.sock.sendall("".join(request))
+        except:
+            conn.close()
+            raise
+
+        responses = []
+        fp = conn.sock.makefile("rb")
+        sock = _PipelineSocket(fp)
+        reusable = True
+        try:
+            for path in paths:
+                resp = httplib.HTTPResponse(sock, method=method)
+                resp.begin()
+                resp.read()
+                responses.append(resp)
+                if resp.will_close or (reuse and not reuse(resp)):
+                    reusable = False
+                    break
+        except (httplib.HTTPException, socket.error):
+            reusable = False
+        fp.close()
+
+        if reusable and len(responses) == len(paths):
+            self.put(conn)
+        else:
+            conn.close()
+        return responses
+
+    def _read(self, resp, limit, until):
+        data = ""
+        while not resp.isclosed():
+            size = self.CHUNK_SIZE
+            if limit is not None:
+                size = min(size, limit - len(data))
+                if size <= 0:
+                    break
+            chunk = resp.read(size)
+            if not chunk:
+                # Reading nothing closes the response at the end of the body
+                break
+            data += chunk
+            if until and not resp.isclosed() and until(data):
+                break
+        return data
+
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for conn, since in idle:
+            conn.close()
+
+    def _connect(self):
+        version = platform.python_version_tuple()
+        if int(version[0]) == 2 and int(version[1]) <= 5:
+            return self._klass(self.netloc)
+        else:
+            return self._klass(self.netloc, timeout=self.timeout)
+
+    def _evict(self):
+        deadline = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < deadline:
+            self._idle.pop(0)[0].close()
+
+    def _healthy(self, conn):
+        if conn.sock is None:
+            return True
+        try:
+            readable = select.select([conn.sock], [], [], 0)[0]
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+class _PipelineSocket:
+    """
+    Lets several HTTPResponse objects read from the same buffered file
+
+    HTTPResponse closes its file once the response has been read, so close
+    does nothing here.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+
+    def makefile(self, *args):
+        return self
+
+    def read(self, *args):
+        return self._fp.read(*args)
+
+    def readline(self, *args):
+        return self._fp.readline(*args)
+
+    def close(self):
+        pass
+
+_pools = {}
+_pools_lock = threading.Lock()
+_settings = {"size": 4, "idle_timeout": 60}
+
+def configure(size=None, idle_timeout=None):
+    """
+    Change the settings for all (current and future) connection pools
+    """
+    with _pools_lock:
+        if size is not None:
+            _settings["size"] = size
+        if idle_timeout is not None:
+            _settings["idle_timeout"] = idle_timeout
+        for pool in _pools.values():
+            pool.size = _settings["size"]
+            pool.idle_timeout = _settings["idle_timeout"]
+
+def get(url):
+    """
+    Return the process-wide connection pool for the host of the given URL
+    """
+    parsed_url = urlparse.urlparse(url)
+    key = (parsed_url.scheme, parsed_url.netloc)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if not pool:
+            pool = ConnectionPool(parsed_url.scheme, parsed_url.netloc, **_settings)
+            _pools[key] = pool
+        return pool
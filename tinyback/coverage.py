@@ -0,0 +1,158 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.coverage - Remember which codes have already been examined
+
+For every service and code length there is a bitmap with one bit per
+possible code, numbered as by generators.Codec. A bit is set once the code
+has been resolved (to a URL or to nothing) by a task that finished; codes
+that could not be fetched are left unset. The bitmaps are memory-mapped
+sparse files, so only the parts of the keyspace that have actually been
+touched take up disk space: 62^6 bits are about 7 GB, but chain tasks of a
+few million codes only touch a fraction of the pages.
+
+Only chain tasks skip covered codes, but all tasks mark their codes as
+covered. Skipped codes are left out of the results of a task, unless their
+URL can be found in the local archive (see tinyback.archive). The number of
+codes left out is sent to the tracker as the skipped parameter of task/put,
+so the tracker has to accept incomplete results for this to work. The mock
+tracker does, the ArchiveTeam tracker does not know the parameter.
+
+Several processes may share the bitmaps; bits are set under a lock on the
+byte that holds them.
+"""
+
+import mmap
+import os
+import re
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from tinyback import generators
+
+# Keyspaces with more codes than this are not tracked (2^36 bits are 8 GB)
+MAX_BITS = 2 ** 36
+
+class Bitmap:
+    """
+    Memory-mapped bitset with size bits, stored in path
+    """
+
+    def __init__(self, path, size):
+        self.size = size
+        length = (size + 7) // 8
+        # Kept open for the byte locks
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        if os.fstat(self._fd).st_size < length:
+            os.ftruncate(self._fd, length)
+        self._map = mmap.mmap(self._fd, length)
+        self._lock = threading.Lock()
+
+    def __contains__(self, n):
+        return ord(self._map[n >> 3]) & (1 << (n & 7)) != 0
+
+    def add(self, n):
+        with self._lock:
+            if fcntl:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, n >> 3)
+            try:
+                byte = ord(self._map[n >> 3])
+                self._map[n >> 3] = chr(byte | (1 << (n & 7)))
+            finally:
+                if fcntl:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, n >> 3)
+
+class Coverage:
+    """
+    Bitmaps for all code lengths of one service
+    """
+
+    def __init__(self, directory, charset):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._codec = generators.Codec(charset)
+        self._bitmaps = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, code):
+        position = self._position(code)
+        if position is None:
+            return False
+        bitmap, n = position
+        return n in bitmap
+
+    def add(self, code):
+        position = self._position(code)
+        if position is not None:
+            bitmap, n = position
+            bitmap.add(n)
+
+    def _position(self, code):
+        """
+        Return the bitmap for code and the number of code in it, or None
+        """
+        bitmap = self._bitmap(len(code))
+        if not bitmap:
+            return None
+        try:
+            n = self._codec.encode(code) - self._codec.offset(len(code))
+        except ValueError:
+            return None
+        return bitmap, n
+
+    def _bitmap(self, length):
+        bitmap = self._bitmaps.get(length, False)
+        if bitmap is not False:
+            return bitmap
+        with self._lock:
+            if length not in self._bitmaps:
+                size = self._codec.base ** length
+                if length == 0 or size > MAX_BITS:
+                    self._bitmaps[length] = None
+                else:
+                    path = os.path.join(self.directory, "length-%i.bits" % length)
+                    self._bitmaps[length] = Bitmap(path, size)
+            return self._bitmaps[length]
+
+_directory = None
+_coverages = {}
+_lock = threading.Lock()
+
+def configure(directory):
+    """
+    Keep coverage bitmaps in directory, one subdirectory per service
+    """
+    global _directory
+    _directory = directory
+
+def get(service, charset):
+    """
+    Return the coverage for service, or None if coverage is not tracked
+    """
+    if not _directory:
+        return None
+    with _lock:
+        coverage = _coverages.get(service)
+        if not coverage:
+            name = re.sub(r"[^A-Za-z0-9_.-]", "_", service)
+            coverage = _coverages[service] = Coverage(os.path.join(_directory, name), charset)
+        return coverage
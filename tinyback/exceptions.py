@@ -38,3 +38,8 @@ class CodeBlockedException(NoRedirectException):
     """
     Raised when a shortcode has been blocked by the URL shortener.
     """
+
+class SpoolFullException(Exception):
+    """
+    Raised when results do not fit into the upload spool.
+    """
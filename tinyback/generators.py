@@ -23,6 +23,7 @@ yield the same sequence of shortcodes.
 """
 
 import hashlib
+import itertools
 
 def factory(generator_type, generator_options):
     """
@@ -40,6 +41,57 @@ def factory(generator_type, generator_options):
     else:
         raise ValueError("Unknown generator %s" % generator_type)
 
+def shard(generator_type, generator_options, k, i):
+    """
+    Returns part i of k of the codes of a generator
+
+    The codes are split into k contiguous, disjoint parts of (almost) equal
+    size, so concatenating the parts 0 to k-1 yields exactly the codes of the
+    unsharded generator, in the same order. Sequence and list parts are
+    computed directly, chain parts have to hash their way to their start.
+    """
+    if not 0 <= i < k:
+        raise ValueError("Shard %i out of range for %i shards" % (i, k))
+
+    if generator_type == "chain":
+        chain = ChainGenerator(generator_options)
+        total = len(chain)
+    elif generator_type == "sequence":
+        sequence = SequenceGenerator(generator_options)
+        total = len(sequence)
+    elif generator_type == "list":
+        total = len(generator_options["list"])
+    else:
+        raise ValueError("Unknown generator %s" % generator_type)
+
+    start = total * i // k
+    stop = total * (i + 1) // k
+
+    if generator_type == "chain":
+        chain.skip(start)
+        chain._total = stop
+        return chain
+    elif generator_type == "sequence":
+        return sequence[start:stop]
+    else:
+        return generator_options["list"][start:stop].__iter__()
+
+def skip(codes, n):
+    """
+    Skips the first n codes of a generator
+
+    codes is a generator returned by factory or shard. Sequence generators
+    jump ahead directly. Chain generators still have to compute every hash
+    up to the new position, but do not build the codes they skip.
+    """
+    if isinstance(codes, SequenceGenerator):
+        codes.seek(codes.tell() + n)
+        return codes
+    if isinstance(codes, ChainGenerator):
+        codes.skip(n)
+        return codes
+    return itertools.islice(codes, n, None)
+
 def chain_generator(options):
     """
     Chain generator - Pseudorandom shortcode generation
@@ -53,28 +105,110 @@ def chain_generator(options):
     count: Number of shortcodes to generate
     length: Length for each generated shortcode
     seed: Random seed for shortcode generation
+
+    See ChainGenerator for batches and checkpoints.
     """
-    if options["length"] > hashlib.md5().digest_size:
-        raise ValueError("Length must be shorter than digest size")
+    return ChainGenerator(options)
 
-    m = 256 - (256 % len(options["charset"]))
-    digest = options["seed"]
-    count = 0
+class ChainGenerator:
+    """
+    Chain generator with batching and checkpoints
 
-    while count < options["count"]:
-        md5 = hashlib.md5()
-        md5.update(digest)
-        digest = md5.digest()
+    Each digest byte is mapped to a shortcode character with a precomputed
+    translation table; bytes that would skew the distribution are dropped. A
+    digest that does not yield enough characters is skipped, but it still
+    feeds the next hash calculation.
 
-        code = ""
-        for byte in map(ord, digest):
-            if byte > m:
-                continue
-            code += options["charset"][byte % len(options["charset"])]
-            if len(code) == options["length"]:
-                count += 1
+    A checkpoint (the last digest plus the number of codes generated so far)
+    is enough to continue the chain without hashing from the seed again.
+    """
+
+    def __init__(self, options, checkpoint=None):
+        if options["length"] > hashlib.md5().digest_size:
+            raise ValueError("Length must be shorter than digest size")
+
+        # Tasks from the tracker are decoded from JSON, the table has to be a str
+        charset = str(options["charset"])
+        m = 256 - (256 % len(charset))
+        self._table = "".join(charset[byte % len(charset)] if byte <= m else "\0" for byte in range(256))
+        self._delete = "".join(chr(byte) for byte in range(m + 1, 256))
+        self._length = options["length"]
+        self._total = options["count"]
+
+        if checkpoint:
+            self._digest = checkpoint["digest"].decode("hex")
+            self._count = checkpoint["count"]
+        else:
+            self._digest = options["seed"]
+            self._count = 0
+
+    def __iter__(self):
+        while True:
+            batch = self.batch(1024)
+            if not batch:
+                return
+            for code in batch:
                 yield code
-                break
+
+    def __len__(self):
+        return self._total
+
+    def batch(self, size):
+        """
+        Return a list of the next size codes (or fewer at the end of the chain)
+        """
+        md5 = hashlib.md5
+        table = self._table
+        delete = self._delete
+        length = self._length
+        digest = self._digest
+        size = min(size, self._total - self._count)
+
+        codes = []
+        while len(codes) < size:
+            digest = md5(digest).digest()
+            code = digest.translate(table, delete)
+            if len(code) >= length:
+                codes.append(code[:length])
+
+        self._digest = digest
+        self._count += len(codes)
+        return codes
+
+    def skip(self, n):
+        """
+        Skip the next n codes (or fewer at the end of the chain)
+        """
+        md5 = hashlib.md5
+        table = self._table
+        delete = self._delete
+        length = self._length
+        digest = self._digest
+        n = min(n, self._total - self._count)
+
+        skipped = 0
+        while skipped < n:
+            digest = md5(digest).digest()
+            if len(digest.translate(table, delete)) >= length:
+                skipped += 1
+
+        self._digest = digest
+        self._count += skipped
+
+    def tell(self):
+        """
+        Return the number of codes generated so far
+        """
+        return self._count
+
+    def checkpoint(self):
+        """
+        Return a checkpoint for the current position in the chain
+
+        The checkpoint is a dictionary that can be serialized as JSON and
+        passed to the constructor to continue the chain at this position.
+        """
+        return {"digest": self._digest.encode("hex"), "count": self._count}
 
 def sequence_generator(options):
     """
@@ -90,17 +224,128 @@ def sequence_generator(options):
     charset: String with all possible shortcode characters
     start: Start sequence with this code
     stop: End sequence with this code
+
+    See SequenceGenerator for random access to the sequence.
     """
-    code = options["start"]
-    yield code
-    while code != options["stop"]:
-        for i in range(len(code) - 1, -1, -1):
-            if code[i] == options["charset"][-1]:
-                code = code[0:i] + options["charset"][0] + code[i+1:len(code)]
-            else:
-                code = code[0:i] + options["charset"][options["charset"].index(code[i]) + 1] + code[i+1:len(code)]
+    return SequenceGenerator(options)
+
+class Codec:
+    """
+    Maps shortcodes to integers and back
+
+    Codes are numbered in the order used by the sequence generator: shorter
+    codes come first, codes of the same length are ordered lexicographically
+    (determined by the charset). The empty code is number 0.
+    """
+
+    def __init__(self, charset):
+        self.charset = charset
+        self.base = len(charset)
+        self._index = dict((char, i) for i, char in enumerate(charset))
+
+    def offset(self, length):
+        """
+        Return the number of the first code with the given length
+        """
+        if self.base == 1:
+            return length
+        return (self.base ** length - 1) // (self.base - 1)
+
+    def encode(self, code):
+        """
+        Return the number of the given code
+        """
+        value = 0
+        try:
+            for char in code:
+                value = value * self.base + self._index[char]
+        except KeyError:
+            raise ValueError("Code %s contains characters not in charset" % code)
+        return self.offset(len(code)) + value
+
+    def decode(self, n):
+        """
+        Return the code with the given number
+        """
+        if n < 0:
+            raise ValueError("Code number must not be negative")
+        length = 0
+        while self.offset(length + 1) <= n:
+            length += 1
+
+        value = n - self.offset(length)
+        chars = []
+        for i in range(length):
+            value, digit = divmod(value, self.base)
+            chars.append(self.charset[digit])
+        chars.reverse()
+        return "".join(chars)
+
+class SequenceGenerator:
+    """
+    Sequence generator with random access
+
+    Yields the same codes as the original string-based sequence generator,
+    but works on code numbers (see Codec), so the length of the sequence is
+    known and it is possible to jump to any position. Indexing returns a
+    single code, slicing with a step of 1 returns a new SequenceGenerator for
+    that part of the sequence. Iteration continues from the current position,
+    see seek. If stop comes before start, the sequence is empty.
+    """
+
+    def __init__(self, options):
+        self._codec = Codec(options["charset"])
+        self._charset = options["charset"]
+        self.start = self._codec.encode(options["start"])
+        self.stop = self._codec.encode(options["stop"])
+        self._position = 0
+
+    def __iter__(self):
+        while self._position < len(self):
+            code = self._codec.decode(self.start + self._position)
+            if not code:
+                self._position += 1
                 yield code
-                break
-        else:
-            code = options["charset"][0] + code
-            yield code
+                continue
+
+            # Codes in one block only differ in their last character
+            prefix = code[:-1]
+            digit = self._charset.index(code[-1])
+            block = self._charset[digit:digit + len(self) - self._position]
+            for char in block:
+                self._position += 1
+                position = self._position
+                yield prefix + char
+                if self._position != position:
+                    break  # seek() was called
+
+    def __len__(self):
+        return max(self.stop - self.start + 1, 0)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            sequence = SequenceGenerator({"charset": self._charset, "start": "", "stop": ""})
+            sequence.start = self.start + start
+            sequence.stop = self.start + max(start, stop) - 1
+            return sequence
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Sequence index out of range")
+        return self._codec.decode(self.start + key)
+
+    def seek(self, position):
+        """
+        Continue the sequence at the given position (0 is the start code)
+        """
+        self._position = position
+
+    def tell(self):
+        """
+        Return the position of the next code in the sequence
+        """
+        return self._position
@@ -0,0 +1,279 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.mockserver - Local stand-in for URL shorteners
+
+The mock server answers requests the way the real URL shorteners do, so that
+Reapers can be tested and benchmarked without touching the live services.
+Whether a code exists (and where it leads) is derived from a hash of the code,
+so results are reproducible. Latency, blocks, server errors and dropped
+connections can be injected.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import cgi
+import hashlib
+import json
+import random
+import threading
+import time
+import urlparse
+
+from tinyback import services
+
+def long_url(code):
+    """
+    Return the long URL the mock server uses for code, or None
+    """
+    if _hash(code) % 3 == 0:
+        return None
+    return "http://www.example.org/%s?n=%i&from=mock" % (code, _hash(code) % 1000)
+
+def _hash(code):
+    return int(hashlib.md5(code).hexdigest()[:8], 16)
+
+class Faults:
+    """
+    Settings for injected misbehaviour
+
+    latency: Seconds to wait before each response
+    jitter: Up to this many additional seconds of random latency
+    block_rate: Probability that a request starts a burst of blocked responses
+    block_burst: Number of requests in a burst of blocked responses
+    error_rate: Probability of an HTTP 500 response
+    drop_rate: Probability of closing the connection instead of answering
+    """
+
+    def __init__(self, latency=0, jitter=0, block_rate=0, block_burst=10,
+            error_rate=0, drop_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.block_rate = block_rate
+        self.block_burst = block_burst
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler that imitates the URL shortener given by server.service
+    """
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_HEAD(self):
+        self._handle(False)
+
+    def do_GET(self):
+        self._handle(True)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self, body):
+        self.server.requests += 1
+        faults = self.server.faults
+        delay = faults.latency + random.random() * faults.jitter
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < faults.drop_rate:
+            self.close_connection = 1
+            return
+        if self.server.blocked():
+            return self._respond(self.server.blocked_status, body)
+        if random.random() < faults.error_rate:
+            return self._respond(500, body)
+
+        path = urlparse.urlparse(self.path)
+        handler = getattr(self, "_service_" + self.server.service, self._service_simple)
+        handler(path.path[1:], urlparse.parse_qs(path.query), body)
+
+    def _respond(self, status, body, headers={}, data="", reason=None):
+        self.send_response(status, reason)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _service_simple(self, code, query, body):
+        url = long_url(code)
+        if url:
+            self._respond(301, body, {"Location": url})
+        else:
+            self._respond(self.server.not_found_status, body)
+
+    def _service_trimnew(self, code, query, body):
+        self._respond(301, body, {"Location": long_url(code) or "http://tr.im/404"})
+
+    def _service_visibli(self, code, query, body):
+        url = long_url(code)
+        if not url:
+            return self._respond(302, body, {"Location": "http://sharedby.co/"})
+        if _hash(code) % 5 != 1:
+            return self._respond(301, body, {"Location": url})
+        data = "<html><body><iframe id=\"sharedby\" src=\"%s\"></iframe></body></html>" % cgi.escape(url, True)
+        self._respond(200, body, {"Content-Type": "text/html"}, data)
+
+    def _service_owly(self, code, query, body):
+        url = long_url(code)
+        if not url:
+            return self._respond(404, body)
+        if _hash(code) % 5 != 1:
+            return self._respond(301, body, {"Location": url})
+        data = ("<html><body><p>This link may be unsafe.</p><a class=\"btn ignore\" href=\"%s\" title=\"Continue\">Continue</a></body></html>"
+            % cgi.escape(url, True))
+        self._respond(200, body, {"Content-Type": "text/html"}, data)
+
+    def _service_snipurl(self, code, query, body):
+        url = long_url(code)
+        if not url:
+            return self._respond(410, body)
+        if _hash(code) % 5 != 1:
+            return self._respond(301, body, {"Location": url})
+        data = ("<html><body><p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>%s</div> <br /></body></html>"
+            % cgi.escape(url))
+        self._respond(500, body, {"Content-Type": "text/html"}, data)
+
+    def _service_bitly(self, code, query, body):
+        url = long_url(code)
+        if url:
+            self._respond(301, body, {"Location": url}, reason="Moved")
+        else:
+            self._respond(404, body)
+
+    def _service_tinyurl(self, code, query, body):
+        if code == "preview.php":
+            url = long_url(query["num"][0])
+            data = "<html><body><a id=\"redirecturl\" href=\"%s\">Proceed to this site.</a></body></html>" % cgi.escape(url, True)
+            return self._respond(200, body, {"Content-Type": "text/html"}, data)
+
+        url = long_url(code)
+        if not url:
+            return self._respond(404, body)
+        headers = {"Location": url}
+        if _hash(code) % 7 == 1:
+            headers["X-tiny"] = "aff 0.0001"
+        self._respond(301, body, headers)
+
+    def _service_isgd(self, code, query, body):
+        url = long_url(code)
+        if not url:
+            return self._respond(404, body)
+        if _hash(code) % 5 != 1:
+            return self._respond(301, body, {"Location": url})
+        data = ("<html><body><p>The full original link is shown below. <b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"%s\" class=\"biglink\">%s</a></p></body></html>"
+            % (cgi.escape(url, True), cgi.escape(url)))
+        self._respond(200, body, {"Content-Type": "text/html"}, data)
+
+    def _service_yourls(self, code, query, body):
+        url = long_url(query.get("shorturl", [""])[0])
+        self._respond(200, body, {"Content-Type": "text/plain"}, url or "not found")
+
+    def _service_googl(self, code, query, body):
+        short_url = query.get("shortUrl", [""])[0]
+        url = long_url(short_url.rsplit("/", 1)[-1])
+        if not url:
+            data = json.dumps({"error": {"code": 404, "message": "Not Found"}})
+            return self._respond(404, body, {"Content-Type": "application/json"}, data)
+        data = json.dumps({"kind": "urlshortener#url", "id": short_url, "longUrl": url, "status": "OK"})
+        self._respond(200, body, {"Content-Type": "application/json"}, data)
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server imitating one URL shortener
+
+    service is one of simple, bitly, tinyurl, isgd, owly, snipurl, trimnew,
+    visibli, yourls and googl; use create() to get a server for a tinyback
+    service.
+    not_found_status is the HTTP status the simple personality uses for codes
+    that do not exist.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service="simple", faults=None, address=("127.0.0.1", 0),
+            not_found_status=404):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockHandler)
+        self.service = service
+        self.faults = faults or Faults()
+        self.not_found_status = not_found_status
+        self.blocked_status = 403 if service in ("bitly", "googl") else 429
+        self.requests = 0
+        self._burst = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%i/" % self.server_address
+
+    def blocked(self):
+        with self._lock:
+            if self._burst == 0 and random.random() < self.faults.block_rate:
+                self._burst = self.faults.block_burst
+            if self._burst > 0:
+                self._burst -= 1
+                return True
+            return False
+
+_personalities = [
+    ("bitly", services.Bitly),
+    ("tinyurl", services.Tinyurl),
+    ("isgd", services.Isgd),
+    ("owly", services.Owly),
+    ("snipurl", services.Snipurl),
+    ("trimnew", services.Trimnew),
+    ("visibli", services.BaseVisibliService),
+    ("yourls", services.YourlsService),
+    ("googl", services.Googl),
+]
+
+def create(name, faults=None, address=("127.0.0.1", 0)):
+    """
+    Create a mock server imitating the tinyback service called name
+    """
+    service = services.factory(name)
+    for personality, base in _personalities:
+        if isinstance(service, base):
+            return MockServer(personality, faults, address)
+
+    not_found_status = 404
+    if isinstance(service, services.SimpleService) and service.http_status_no_redirect:
+        not_found_status = service.http_status_no_redirect[0]
+    return MockServer("simple", faults, address, not_found_status)
+
+def mock_service(name, url, rate_limit=False):
+    """
+    Create a service class that talks to the mock server at url
+
+    The class behaves like the service called name, but all requests go to
+    the mock server. Unless rate_limit is true, the class has no rate limit.
+    """
+    klass = services.factory_class(name)
+    attributes = {
+        "url": url,
+        "yourls_api_url": urlparse.urljoin(url, "yourls-api.php"),
+        "api_url": urlparse.urljoin(url, "urlshortener/v1/url"),
+    }
+    if not rate_limit:
+        attributes["rate_limit"] = None
+    return type("Mock" + klass.__name__, (klass,), attributes)
@@ -0,0 +1,304 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.mocktracker - Local stand-in for the tracker
+
+The mock tracker hands out a fixed list of tasks through task/get (singly or
+in batches), accepts results through task/put and forgets all progress on
+task/clear. Uploaded results are checked against the codes of the task and,
+optionally, against the long URLs they should lead to. Latency, refused
+uploads (409), 403 Forbidden and server errors can be injected.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import gzip
+import json
+import random
+import threading
+import time
+import urlparse
+
+from tinyback import generators
+
+class Faults:
+    """
+    Settings for injected misbehaviour
+
+    latency: Seconds to wait before each response
+    jitter: Up to this many additional seconds of random latency
+    conflict_rate: Probability of refusing an upload with 409 Conflict (the
+        task counts as done, as if someone else had delivered it)
+    forbidden_rate: Probability of a 403 Forbidden response
+    error_rate: Probability of an HTTP 500 response
+    """
+
+    def __init__(self, latency=0, jitter=0, conflict_rate=0, forbidden_rate=0,
+            error_rate=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.conflict_rate = conflict_rate
+        self.forbidden_rate = forbidden_rate
+        self.error_rate = error_rate
+
+def make_tasks(service, generator_type, count, codes, charset, length=5):
+    """
+    Create count tasks for service with codes codes each
+
+    Chain tasks use a different seed for each task, sequence tasks cover
+    consecutive ranges of codes of the given length and list tasks contain
+    codes from a chain generator.
+    """
+    tasks = []
+    codec = generators.Codec(charset)
+    for i in range(count):
+        chain_options = {"charset": charset, "count": codes, "length": length, "seed": "mocktracker-%i" % i}
+        if generator_type == "chain":
+            options = chain_options
+        elif generator_type == "sequence":
+            start = codec.offset(length) + i * codes
+            options = {"charset": charset, "start": codec.decode(start), "stop": codec.decode(start + codes - 1)}
+        elif generator_type == "list":
+            options = {"list": list(generators.chain_generator(chain_options))}
+        else:
+            raise ValueError("Unknown generator %s" % generator_type)
+        tasks.append({"id": "mock-%i" % i, "service": service, "generator_type": generator_type, "generator_options": options})
+    return tasks
+
+class MockTrackerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Request handler for the tracker API
+    """
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        url = urlparse.urlparse(self.path)
+        query = dict((name, values[0]) for name, values in urlparse.parse_qs(url.query).items())
+        body = ""
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = self._read_chunked()
+        elif "Content-Length" in self.headers:
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+        endpoint = url.path.rsplit("/", 2)[-2:]
+        endpoint = "/".join(endpoint)
+        self.server.count(endpoint)
+
+        faults = self.server.faults
+        delay = faults.latency + random.random() * faults.jitter
+        if delay:
+            time.sleep(delay)
+
+        if random.random() < faults.forbidden_rate:
+            return self._respond(403, "Forbidden by mock tracker")
+        if random.random() < faults.error_rate:
+            return self._respond(500, "Internal Server Error")
+
+        if endpoint == "task/get":
+            if "count" in query and self.server.batches:
+                data = {"tasks": self.server.lease(int(query["count"])), "lease": self.server.lease_time}
+            else:
+                tasks = self.server.lease(1)
+                data = tasks[0] if tasks else None
+            self._respond(200, json.dumps(data))
+        elif endpoint == "task/put" and self.command == "POST":
+            self._respond(self.server.complete(query.get("id"), body, query.get("username"), int(query.get("skipped", 0))))
+        elif endpoint == "task/clear":
+            self.server.clear()
+            self._respond(200)
+        else:
+            self._respond(404, "Not Found")
+
+    def _read_chunked(self):
+        chunks = []
+        while True:
+            length = int(self.rfile.readline().split(";", 1)[0], 16)
+            if not length:
+                break
+            chunks.append(self.rfile.read(length))
+            self.rfile.readline()
+        while self.rfile.readline() not in ("\r\n", "\n", ""):
+            pass
+        return "".join(chunks)
+
+    def _respond(self, status, data=""):
+        headers = {}
+        if len(data) > 1024 and "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = StringIO.StringIO()
+            gzip_fileobj = gzip.GzipFile(mode="wb", fileobj=buf)
+            gzip_fileobj.write(data)
+            gzip_fileobj.close()
+            data = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class MockTracker(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Threaded HTTP server imitating the tracker
+
+    tasks is the list of tasks to hand out. A task that has not been
+    delivered within lease_time seconds is handed out again. If batches is
+    false, task/get ignores the count parameter, like older trackers.
+    expected is a function returning the long URL for a code (or None); if
+    given, uploaded results must match it exactly.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tasks, faults=None, address=("127.0.0.1", 0),
+            lease_time=600, batches=True, expected=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MockTrackerHandler)
+        self.tasks = tasks
+        self.faults = faults or Faults()
+        self.lease_time = lease_time
+        self.batches = batches
+        self.expected = expected
+        self.requests = {}
+        self.errors = []
+        self.started = time.time()
+        self._leases = {}
+        self._done = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://%s:%i/" % self.server_address
+
+    @property
+    def done(self):
+        """
+        Number of tasks whose results have been delivered
+        """
+        return len(self._done)
+
+    def finished(self):
+        return len(self._done) == len(self.tasks)
+
+    def count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def lease(self, count):
+        """
+        Hand out up to count tasks that are neither done nor leased
+        """
+        now = time.time()
+        tasks = []
+        with self._lock:
+            for task in self.tasks:
+                if len(tasks) >= count:
+                    break
+                if task["id"] in self._done or self._leases.get(task["id"], 0) > now:
+                    continue
+                self._leases[task["id"]] = now + self.lease_time
+                tasks.append(task)
+        return tasks
+
+    def complete(self, task_id, data, username=None, skipped=0):
+        """
+        Accept the results for a task and return the HTTP status
+
+        skipped is the number of codes the client left out of the results.
+        """
+        task = None
+        for candidate in self.tasks:
+            if candidate["id"] == task_id:
+                task = candidate
+        if not task:
+            return 404
+
+        if random.random() < self.faults.conflict_rate:
+            status = 409
+        else:
+            error = self.verify(task, data, skipped)
+            if error:
+                with self._lock:
+                    self.errors.append("Task %s: %s" % (task_id, error))
+                return 400
+            status = 200
+
+        with self._lock:
+            self._done[task_id] = username
+            self._leases.pop(task_id, None)
+        return status
+
+    def clear(self):
+        with self._lock:
+            self._leases = {}
+            self._done = {}
+
+    def verify(self, task, data, skipped=0):
+        """
+        Check uploaded results against the task, return an error or None
+
+        If skipped codes were left out, the results only have to be a part of
+        the expected results, missing at most skipped codes.
+        """
+        try:
+            lines = gzip.GzipFile(mode="rb", fileobj=StringIO.StringIO(data)).read().splitlines()
+        except (IOError, EOFError, ValueError), e:
+            return "Broken gzip data (%s)" % e
+
+        results = []
+        for line in lines:
+            if "|" not in line:
+                return "Malformed line %r" % line
+            results.append(tuple(line.split("|", 1)))
+
+        # Short chain tasks may contain a code more than once
+        codes = list(generators.factory(task["generator_type"], task["generator_options"]))
+        known = set(codes)
+        position = 0
+        for code, url in results:
+            if code not in known:
+                return "Code %s is not part of the task" % code
+            while position < len(codes) and codes[position] != code:
+                position += 1
+            if position == len(codes):
+                return "Code %s is out of order" % code
+            position += 1
+
+        if self.expected:
+            expected = [(code, self.expected(code)) for code in codes]
+            expected = [(code, url) for code, url in expected if url is not None]
+            if skipped:
+                unexpected = set(results) - set(expected)
+                if unexpected:
+                    return "Unexpected result %s|%s" % sorted(unexpected)[0]
+                if len(expected) - len(results) > skipped:
+                    return "Found %i URLs, expected at least %i" % (len(results), len(expected) - skipped)
+            elif results != expected:
+                return "Found %i URLs, expected %i" % (len(results), len(expected))
+        return None
@@ -0,0 +1,122 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.parsers - Extract long URLs from HTML pages
+
+Services that scrape pages declare their rules once, when the module is
+imported: a Rule is a compiled regular expression whose first group is the
+long URL, and a Parser holds the rules for all kinds of pages a request can
+return. While a page is being downloaded, Parser.complete tells whether one
+of the rules has found its final match, so the rest of the page does not
+have to be read.
+
+A match is final once reading more of the page can not change it. A lazy
+group like (.*?) or ([^"]+) is final as soon as it matches, but a greedy .*
+may still grow until the end of the line. The final argument of Rule is the
+text that has to follow the match before it counts as final: "" for lazy
+patterns, "\\n" for greedy ones without re.DOTALL. Rules without it never
+stop a read early.
+"""
+
+import HTMLParser
+import re
+
+class Rule:
+    """
+    Regular expression that extracts the long URL from one kind of page
+
+    If marker is given, the rule only completes a read once the marker (a
+    string that identifies the kind of page) has been read as well. Unless
+    unescape is false, HTML entities in the URL are decoded.
+    """
+
+    def __init__(self, pattern, flags=0, final=None, marker=None, unescape=True):
+        self.regex = re.compile(pattern, flags)
+        self.final = final
+        self.marker = marker
+        self.unescape = unescape
+
+    def complete(self, data):
+        """
+        Whether data, the beginning of a page, already has the final match
+        """
+        if self.final is None:
+            return False
+        if self.marker is not None and self.marker not in data:
+            return False
+        match = self.regex.search(data)
+        return match is not None and data.find(self.final, match.end()) != -1
+
+    def extract(self, data):
+        """
+        Return the URL found in data, or None if the rule does not match
+        """
+        match = self.regex.search(data)
+        if not match:
+            return None
+        if self.unescape:
+            return unescape(match.group(1))
+        return match.group(1)
+
+class Parser:
+    """
+    Rules for all kinds of pages a request may return
+    """
+
+    def __init__(self, *rules):
+        self.rules = rules
+
+    def complete(self, data):
+        """
+        Whether any of the rules already has its final match in data
+        """
+        for rule in self.rules:
+            if rule.complete(data):
+                return True
+        return False
+
+# Number of entities to remember
+CACHE_SIZE = 4096
+
+_html_parser = HTMLParser.HTMLParser()
+_entity = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
+_entities = {}
+
+def _replace_entity(match):
+    entity = match.group(0)
+    try:
+        return _entities[entity]
+    except KeyError:
+        pass
+    result = _html_parser.unescape(entity)
+    if len(_entities) >= CACHE_SIZE:
+        _entities.clear()
+    _entities[entity] = result
+    return result
+
+def unescape(url):
+    """
+    Decode HTML entities in url, a UTF-8 bytestring, and return it as UTF-8
+
+    Same as HTMLParser.unescape, but the pattern is compiled once and the
+    character for each entity is looked up only once. Raises
+    UnicodeDecodeError if url is not valid UTF-8.
+    """
+    url = url.decode("utf-8")
+    if "&" in url:
+        url = _entity.sub(_replace_entity, url)
+    return url.encode("utf-8")
@@ -0,0 +1,537 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.ratelimit - Process-wide rate limiting
+
+All Reapers working on the same service share one token bucket, so the
+aggregate request rate of a process stays within the rate limit of the URL
+shortener, no matter how many threads are running.
+
+The static rate limit of a service is only used as a starting point: buckets
+adapt their rate to the feedback they get from the service (additive increase,
+multiplicative decrease). The learned rates can be kept in a small state file,
+so they survive across tasks and processes.
+
+When a service blocks us, its circuit (see Circuit) stops all Reapers of
+the process from sending requests to it until the block is likely over.
+
+Worker processes can share the registry of a supervisor process (see
+Registry.connect), so the rate limit and the circuits hold for all processes
+together.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+class TokenBucket:
+    """
+    Thread-safe token bucket
+
+    The bucket holds up to `rate` tokens and refills at `rate` tokens per `per`
+    seconds. Callers reserve a token under a lock and then sleep outside of it
+    until their token becomes available, so waiting callers are served in the
+    order they arrived and nobody busy-waits.
+    """
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until it is available
+
+        Returns the number of seconds spent waiting.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self):
+        """
+        Take one token without waiting for it
+
+        Returns the number of seconds until the token may be used.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens * self.per / self.rate
+
+    def delay(self):
+        """
+        Return the number of seconds until a token is available
+
+        No token is taken.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) * self.per / self.rate
+
+    def drain(self):
+        """
+        Remove all tokens that are currently available
+
+        Used after the service blocked us, so that nobody bursts right back
+        into the block.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate / self.per)
+        self._last = now
+
+class AdaptiveTokenBucket(TokenBucket):
+    """
+    Token bucket with an AIMD rate controller
+
+    While responses are clean, the rate is raised by INCREASE tokens after
+    each full window of successful requests. When the service blocks us or
+    the latency spikes for SPIKES responses in a row, the rate is multiplied
+    by DECREASE. Every latency goes into the running average, so after a
+    lasting change in latency, the average catches up and the spikes stop.
+    The rate always stays between MIN_FACTOR and MAX_FACTOR times the initial
+    rate.
+    """
+
+    INCREASE = 1.0
+    DECREASE = 0.5
+    MIN_FACTOR = 0.1
+    MAX_FACTOR = 10.0
+    LATENCY_SPIKE = 4.0
+    LATENCY_SAMPLES = 20
+    SPIKES = 3
+
+    def __init__(self, rate, per, learned_rate=None):
+        TokenBucket.__init__(self, rate, per)
+        self._log = logging.getLogger("tinyback.ratelimit")
+        self.initial_rate = rate
+        if learned_rate:
+            self.rate = self._clamp(learned_rate)
+            self._tokens = min(self._tokens, self.rate)
+        self._successes = 0
+        self._latency = None
+        self._samples = 0
+        self._spikes = 0
+        self._last_decrease = 0
+
+    def success(self, latency):
+        """
+        Report a clean response that took latency seconds
+
+        latency may be None if it is not known, e.g. for pipelined requests.
+        """
+        with self._lock:
+            if latency is None:
+                pass
+            elif self._latency is None:
+                self._samples = 1
+                self._latency = latency
+            else:
+                average = self._latency
+                self._samples += 1
+                self._latency = 0.9 * self._latency + 0.1 * latency
+                if self._samples > self.LATENCY_SAMPLES and latency > self.LATENCY_SPIKE * average:
+                    self._spikes += 1
+                else:
+                    self._spikes = 0
+                if self._spikes >= self.SPIKES:
+                    self._spikes = 0
+                    self._decrease("latency spike (%.2fs, average %.2fs)" % (latency, average))
+                    return
+
+            self._successes += 1
+            if self._successes >= self.rate:
+                self._successes = 0
+                self.rate = self._clamp(self.rate + self.INCREASE)
+
+    def failure(self):
+        """
+        Report that the service blocked us or told us to slow down
+
+        Also drains the bucket.
+        """
+        with self._lock:
+            self._decrease("blocked")
+            self._refill()
+            self._tokens = min(self._tokens, 0)
+
+    def _decrease(self, reason):
+        now = time.time()
+        self._successes = 0
+        if now - self._last_decrease < self.per:
+            return
+        self._last_decrease = now
+        self.rate = self._clamp(self.rate * self.DECREASE)
+        self._log.info("Reducing rate to %.2f requests per %i seconds: %s" % (self.rate, self.per, reason))
+
+    def _clamp(self, rate):
+        return max(self.initial_rate * self.MIN_FACTOR, min(rate, self.initial_rate * self.MAX_FACTOR))
+
+class RemoteTokenBucket:
+    """
+    Token bucket that lives in the registry of another process
+
+    Tokens are reserved in the other process, but waiting for them happens
+    locally, so the other process never blocks.
+    """
+
+    def __init__(self, remote, name, rate_limit):
+        self._remote = remote
+        self._args = (name, rate_limit)
+        self.per = rate_limit[1]
+
+    @property
+    def rate(self):
+        return self._call("rate")
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def reserve(self):
+        return self._call("reserve")
+
+    def delay(self):
+        return self._call("delay")
+
+    def drain(self):
+        self._call("drain")
+
+    def success(self, latency):
+        self._call("success", latency)
+
+    def failure(self):
+        self._call("failure")
+
+    def _call(self, method, *args):
+        return self._remote.call(*(self._args + (method,) + args))
+
+class Circuit:
+    """
+    Circuit breaker for one service, shared by all Reapers
+
+    While the circuit is closed, requests flow freely. When the service
+    blocks us, the circuit opens and nobody sends requests for a cooldown
+    period, which grows by a factor of FACTOR with every block in a row, up
+    to MAXIMUM seconds. Cooldowns are randomized to between half and all of
+    that, so that processes which are not sharing a circuit do not come back
+    at the same time. After the cooldown, the circuit is half-open: a single
+    probe request is let through while everyone else keeps waiting. If the
+    probe is not blocked, the circuit closes again, otherwise it opens for a
+    longer cooldown.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    INITIAL = 5
+    FACTOR = 5
+    MAXIMUM = 3600
+    # Seconds between two checks while the probe is running
+    POLL = 1
+
+    def __init__(self):
+        self._log = logging.getLogger("tinyback.ratelimit")
+        self.state = self.CLOSED
+        self._blocks = 0
+        self._until = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.state == self.CLOSED
+
+    def wait(self):
+        """
+        Wait until a request may be sent
+
+        Returns True if the request is the probe. The caller has to report
+        the outcome of every request it sends, or release the probe if the
+        outcome is not known.
+        """
+        while True:
+            delay, probe = self.reserve()
+            if delay <= 0:
+                return probe
+            time.sleep(delay)
+
+    def reserve(self):
+        """
+        Ask to send a request without waiting
+
+        Returns the number of seconds until the caller should ask again (0
+        if the request may be sent now) and whether the request is the probe.
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self._until - time.time()
+                if remaining > 0:
+                    return remaining, False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return self.POLL, False
+                self._probing = True
+                return 0, True
+            return 0, False
+
+    def delay(self):
+        """
+        Return the number of seconds until reserve may let a request through
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return max(self._until - time.time(), 0)
+            if self.state == self.HALF_OPEN and self._probing:
+                return self.POLL
+            return 0
+
+    def report(self, probe, blocked=False):
+        """
+        Report the outcome of a request
+
+        Returns the cooldown in seconds if this opened the circuit, otherwise
+        None. Blocks reported while the circuit is already open (by requests
+        sent before it opened) do not extend the cooldown.
+        """
+        with self._lock:
+            if not blocked:
+                if probe:
+                    self._log.info("Probe request went through, resuming requests")
+                    self.state = self.CLOSED
+                    self._blocks = 0
+                return None
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and not probe):
+                return None
+            cooldown = min(self.INITIAL * self.FACTOR ** self._blocks, self.MAXIMUM)
+            if cooldown < self.MAXIMUM:
+                self._blocks += 1
+            cooldown *= random.uniform(0.5, 1)
+            self.state = self.OPEN
+            self._until = time.time() + cooldown
+            return cooldown
+
+    def release(self, probe):
+        """
+        Report a request that ended without telling whether we are blocked
+
+        If it was the probe, the next request becomes the probe instead.
+        """
+        with self._lock:
+            if probe and self.state == self.HALF_OPEN:
+                self._probing = False
+
+class RemoteCircuit:
+    """
+    Circuit that lives in the registry of another process
+
+    As with RemoteTokenBucket, waiting happens locally.
+    """
+
+    def __init__(self, remote, name):
+        self._remote = remote
+        self._args = (name,)
+
+    @property
+    def closed(self):
+        return self._call("closed")
+
+    def wait(self):
+        while True:
+            delay, probe = self.reserve()
+            if delay <= 0:
+                return probe
+            time.sleep(delay)
+
+    def reserve(self):
+        return self._call("reserve")
+
+    def delay(self):
+        return self._call("delay")
+
+    def report(self, probe, blocked=False):
+        return self._call("report", probe, blocked)
+
+    def release(self, probe):
+        return self._call("release", probe)
+
+    def _call(self, method, *args):
+        return self._remote.call_circuit(*(self._args + (method,) + args))
+
+class Registry:
+    """
+    Collection of token buckets and circuits keyed by service name
+    """
+
+    def __init__(self):
+        self._log = logging.getLogger("tinyback.ratelimit")
+        self._buckets = {}
+        self._circuits = {}
+        self._learned = {}
+        self._state_file = None
+        self._remote = None
+        self._lock = threading.Lock()
+
+    def connect(self, remote):
+        """
+        Use the token buckets of another registry
+
+        remote is a proxy (e.g. from multiprocessing.managers) for a Registry
+        in another process. From now on, get and circuit return buckets and
+        circuits that live in that registry, and save is passed on to it.
+        """
+        with self._lock:
+            self._remote = remote
+            self._buckets = {}
+            self._circuits = {}
+
+    def get(self, name, rate_limit):
+        """
+        Return the token bucket for the given service
+
+        rate_limit is the tuple from Service.rate_limit. Returns None if the
+        service has no rate limit.
+        """
+        if not rate_limit:
+            return None
+
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket:
+                return bucket
+            if self._remote:
+                bucket = RemoteTokenBucket(self._remote, name, tuple(rate_limit))
+            else:
+                learned_rate = self._learned.get(name)
+                bucket = AdaptiveTokenBucket(rate_limit[0], rate_limit[1], learned_rate)
+            self._buckets[name] = bucket
+            return bucket
+
+    def circuit(self, name):
+        """
+        Return the circuit for the given service
+        """
+        with self._lock:
+            circuit = self._circuits.get(name)
+            if circuit:
+                return circuit
+            if self._remote:
+                circuit = RemoteCircuit(self._remote, name)
+            else:
+                circuit = Circuit()
+            self._circuits[name] = circuit
+            return circuit
+
+    def call(self, name, rate_limit, method, *args):
+        """
+        Call method on the token bucket for the given service
+
+        If the method is an attribute, returns its value instead. This is the
+        interface used by RemoteTokenBucket.
+        """
+        return _call(self.get(name, rate_limit), method, args)
+
+    def call_circuit(self, name, method, *args):
+        """
+        Call method on the circuit for the given service, see call
+        """
+        return _call(self.circuit(name), method, args)
+
+    def load(self, state_file):
+        """
+        Read learned rates from state_file and keep saving them there
+
+        A missing or broken state file is not an error, the static rate limits
+        are used in that case.
+        """
+        with self._lock:
+            self._state_file = state_file
+            try:
+                f = open(state_file, "r")
+                try:
+                    self._learned = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError), e:
+                self._log.debug("Could not read rate limit state: %s" % e)
+                self._learned = {}
+
+    def save(self):
+        """
+        Write learned rates to the state file, if one was loaded
+        """
+        if self._remote:
+            self._remote.save()
+            return
+
+        with self._lock:
+            if not self._state_file:
+                return
+            for name, bucket in self._buckets.items():
+                self._learned[name] = bucket.rate
+
+            temp_file = "%s.%i.tmp" % (self._state_file, os.getpid())
+            try:
+                f = open(temp_file, "w")
+                try:
+                    json.dump(self._learned, f)
+                finally:
+                    f.close()
+                os.rename(temp_file, self._state_file)
+            except (IOError, OSError), e:
+                self._log.warn("Could not write rate limit state: %s" % e)
+
+def _call(obj, method, args):
+    value = getattr(obj, method)
+    if callable(value):
+        return value(*args)
+    return value
+
+registry = Registry()
+
+def get(name, rate_limit):
+    """
+    Return the process-wide token bucket for the given service
+    """
+    return registry.get(name, rate_limit)
+
+def circuit(name):
+    """
+    Return the process-wide circuit for the given service
+    """
+    return registry.circuit(name)
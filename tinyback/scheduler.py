@@ -0,0 +1,240 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.scheduler - Run many tasks on a fixed pool of worker threads
+
+With one thread per task, a thread working on a slow rate-limited service
+spends nearly all of its time sleeping in the rate limiter. The scheduler
+instead keeps any number of tasks (ScheduledReapers) open and lets a pool of
+workers send requests for all of them. A worker always takes the task whose
+service will accept a request the soonest (earliest eligible time), taking
+turns between tasks that are eligible at the same time. Each service keeps
+its own rate limit and circuit (see tinyback.ratelimit), so tasks for
+services without a rate limit can use all the workers that are left.
+
+Asking a task when its service takes the next request may be a round trip
+to another process (see tinyback.ratelimit.Registry), so the workers ask
+without holding the scheduler's lock.
+"""
+
+import logging
+import sys
+import threading
+import time
+
+class _Job:
+
+    def __init__(self, reaper, callback):
+        self.reaper = reaper
+        self.callback = callback
+        self.last = 0
+        self.error = None
+        # Set once the callback is due, so that it runs only once
+        self.done = False
+
+class Scheduler:
+    """
+    Pool of worker threads serving a number of ScheduledReapers
+    """
+
+    # Longest time a worker waits before looking at the tasks again, in
+    # case another process changed a rate limit or circuit
+    MAX_WAIT = 1
+
+    def __init__(self, workers=8):
+        self._log = logging.getLogger("tinyback.scheduler")
+        self._workers = workers
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        # Counts changes to the jobs, so that a worker notices the ones it
+        # missed while it was not holding the lock
+        self._changes = 0
+
+    def __len__(self):
+        """
+        Return the number of open tasks
+        """
+        with self._cond:
+            return len(self._jobs)
+
+    def start(self):
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, reaper, callback):
+        """
+        Add a started ScheduledReaper
+
+        callback is called with the reaper, the result of its finish method
+        and None when the task is done, or with the reaper, None and the
+        exception info if it failed. It runs in a worker thread, once per
+        task. A failed reaper has already been aborted.
+        """
+        with self._cond:
+            self._jobs.append(_Job(reaper, callback))
+            self._notify()
+
+    def wait(self, count, timeout=None):
+        """
+        Wait until fewer than count tasks are open, or timeout seconds
+
+        Returns True if fewer than count tasks are open.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while len(self._jobs) >= count:
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return len(self._jobs) < count
+
+    def stop(self):
+        """
+        Wait for all open tasks to finish and stop the workers
+        """
+        with self._cond:
+            self._stopping = True
+            self._notify()
+        while [thread for thread in self._threads if thread.is_alive()]:
+            time.sleep(1)
+
+    def _run(self):
+        while True:
+            job, item, wait = self._next()
+            if not job:
+                return
+            try:
+                if item:
+                    if wait > 0:
+                        time.sleep(wait)
+                    job.reaper.process(item)
+                elif job.error:
+                    self._fail(job, job.error)
+                else:
+                    fileobj = job.reaper.finish()
+                    if self._claim(job):
+                        self._callback(job, fileobj, None)
+            except:
+                self._fail(job, sys.exc_info())
+            with self._cond:
+                self._notify()
+
+    def _next(self):
+        """
+        Wait for work and return (job, item, wait)
+
+        item is the code to fetch for job, after waiting wait seconds for
+        the rate limit. If item is None, job is finished (or failed, see
+        job.error) and has been removed. Returns None for job when the
+        workers should stop.
+        """
+        while True:
+            with self._cond:
+                if self._stopping and not self._jobs:
+                    return None, None, 0
+                jobs = list(self._jobs)
+                changes = self._changes
+
+            best = None
+            best_wait = self.MAX_WAIT
+            for job in jobs:
+                try:
+                    if job.reaper.finished:
+                        if self._remove(job):
+                            return job, None, 0
+                        continue
+                    wait = job.reaper.ready()
+                    if wait is not None:
+                        wait = max(wait, job.reaper.delay())
+                except:
+                    job.error = sys.exc_info()
+                    if self._remove(job):
+                        return job, None, 0
+                    continue
+                if wait is None:
+                    continue
+                if wait < best_wait or (best and wait == best_wait and job.last < best.last):
+                    best = job
+                    best_wait = wait
+
+            if best and best_wait <= 0:
+                try:
+                    item = best.reaper.next()
+                    if item:
+                        best.last = time.time()
+                        return best, item, best.reaper.reserve()
+                except:
+                    best.error = sys.exc_info()
+                    if self._remove(best):
+                        return best, None, 0
+                continue
+
+            with self._cond:
+                if self._changes == changes:
+                    self._cond.wait(best_wait)
+
+    def _remove(self, job):
+        """
+        Remove job, returns False if another worker already did
+        """
+        with self._cond:
+            if job not in self._jobs:
+                return False
+            self._jobs.remove(job)
+            self._notify()
+            return True
+
+    def _notify(self):
+        self._changes += 1
+        self._cond.notify_all()
+
+    def _claim(self, job):
+        """
+        Remove job for good, returns False if its callback is already due
+        """
+        with self._cond:
+            if job.done:
+                return False
+            job.done = True
+            if job in self._jobs:
+                self._jobs.remove(job)
+                self._notify()
+            return True
+
+    def _fail(self, job, exc_info):
+        if not self._claim(job):
+            return
+        # Other workers may still be fetching codes of the task
+        job.reaper.abort()
+        self._log.error("Task %s failed" % job.reaper.task["id"], exc_info=exc_info)
+        self._callback(job, None, exc_info)
+
+    def _callback(self, job, fileobj, exc_info):
+        # An error here must not cost the pool a worker
+        try:
+            job.callback(job.reaper, fileobj, exc_info)
+        except:
+            self._log.exception("Callback for task %s failed" % job.reaper.task["id"])
@@ -15,18 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import HTMLParser
 import abc
 import httplib
 import json
-import platform
 import re
 import socket
 import urllib
 import urlparse
 
 import tinyback
-from tinyback import exceptions
+from tinyback import connections, exceptions, parsers, strategy
 
 class Service:
     """
@@ -93,48 +91,127 @@ class HTTPService(Service):
         """
         return True
 
+    @property
+    def http_pipelining(self):
+        """
+        Whether HEAD requests for several codes may be pipelined on one
+        connection, see prefetch
+        """
+        return False
+
+    @property
+    def http_body_limit(self):
+        """
+        Number of bytes of a page the parsers need at most. When the first
+        request for a code is a GET (see tinyback.strategy), longer bodies
+        are not used and the page is requested again.
+        """
+        return 65536
+
+    @property
+    def http_parser(self):
+        """
+        Parser for the pages that a code can lead to (see tinyback.parsers),
+        or None. Reading a page stops as soon as it has found the long URL.
+        """
+        return None
+
+    @property
+    def http_prefetch(self):
+        """
+        Whether prefetch should be used right now: the service allows
+        pipelining and the first request for a code is a HEAD
+        """
+        return self.http_pipelining and not self._strategy.get
+
     def __init__(self):
-        parsed_url = urlparse.urlparse(self.url)
-        self._path = parsed_url.path or "/"
+        self._path = urlparse.urlparse(self.url).path or "/"
+        self._pool = connections.get(self.url)
+        self._prefetched = {}
+        self._strategy = strategy.get(self.url)
 
-        if parsed_url.scheme == "http":
-            klass = httplib.HTTPConnection
-        elif parsed_url.scheme == "https":
-            klass = httplib.HTTPSConnection
-        else:
-            raise ValueError("Unknown scheme %s" % parsed_url.scheme)
+    def http_reuse_connection(self, resp):
+        """
+        Whether the connection may be reused after the given response. If not,
+        the connection is closed instead of going back to the pool.
+        """
+        return True
 
-        version = platform.python_version_tuple()
-        if int(version[0]) == 2 and int(version[1]) <= 5:
-            self._conn = klass(parsed_url.netloc)
-        else:
-            self._conn = klass(parsed_url.netloc, timeout=30)
+    def prefetch(self, codes):
+        """
+        Send HEAD requests for several codes at once using HTTP pipelining
+
+        Returns the list of codes that got a response. The next fetch for one
+        of these codes uses the stored response instead of sending a new
+        request. Codes without a response (because the server closed the
+        connection) are fetched normally.
+        """
+        headers = self.http_headers
+        headers["Connection"] = "Keep-Alive"
+        paths = [self._path + code for code in codes]
+
+        try:
+            responses = self._pool.pipeline("HEAD", paths, headers, self.http_reuse_connection)
+        except (httplib.HTTPException, socket.error):
+            return []
+
+        answered = codes[:len(responses)]
+        self._prefetched.update(zip(answered, responses))
+        return answered
 
     def _http_head(self, code):
+        """
+        Send the first request for code and return the response
+
+        Depending on the strategy of the service, this is a HEAD or a GET
+        request. After a GET, resp.body is the body, or None if it was cut
+        off at http_body_limit before http_parser found the long URL.
+        """
+        self._strategy.request()
+        resp = self._prefetched.pop(code, None)
+        if resp:
+            return resp
+        if self._strategy.get:
+            parser = self.http_parser
+            until = parser.complete if parser else None
+            resp, data = self._http_fetch(code, "GET", self.http_body_limit, until)
+            if resp.truncated and not (parser and parser.complete(data)):
+                data = None
+            resp.body = data
+            return resp
         return self._http_fetch(code, "HEAD")[0]
 
-    def _http_get(self, code):
-        return self._http_fetch(code, "GET")
+    def _http_get(self, code, first=None, parser=None):
+        """
+        Return the response and body of a GET request for code
 
-    def _http_fetch(self, code, method):
+        first is the response from _http_head, if the body is needed because
+        of it. Its body is used if there is one, otherwise a new request is
+        sent. The body is read until parser (by default http_parser) has found
+        the long URL.
+        """
+        if first is not None:
+            body = getattr(first, "body", None)
+            self._strategy.body(body is not None, body is None and getattr(first, "truncated", False))
+            if body is not None:
+                return first, body
+        parser = parser or self.http_parser
+        return self._http_fetch(code, "GET", until=parser.complete if parser else None)
+
+    def _http_fetch(self, code, method, limit=None, until=None):
         headers = self.http_headers
         if self.http_keepalive:
             headers["Connection"] = "Keep-Alive"
+            reuse = self.http_reuse_connection
         else:
             headers["Connection"] = "close"
+            reuse = lambda resp: False
 
         try:
-            self._conn.request(method, self._path + code, headers=headers)
-            resp = self._conn.getresponse()
-            result = (resp, resp.read())
-            if not self.http_keepalive:
-                self._conn.close()
-            return result
+            return self._pool.request(method, self._path + code, headers, reuse, limit, until)
         except httplib.HTTPException, e:
-            self._conn.close()
             raise exceptions.ServiceException("HTTP exception: %s" % e)
         except socket.error, e:
-            self._conn.close()
             raise exceptions.ServiceException("Socket error: %s" % e)
 
 class SimpleService(HTTPService):
@@ -224,39 +301,24 @@ class YourlsService(Service):
         raise RuntimeError("Bad value for yourls_url_convert parameter")
 
     def __init__(self):
-        parsed_url = urlparse.urlparse(self.yourls_api_url)
-        self._path = parsed_url.path or "/"
-
-        if parsed_url.scheme == "http":
-            klass = httplib.HTTPConnection
-        elif parsed_url.scheme == "https":
-            klass = httplib.HTTPSConnection
-        else:
-            raise ValueError("Unknown scheme %s" % parsed_url.scheme)
-
-        version = platform.python_version_tuple()
-        if int(version[0]) == 2 and int(version[1]) <= 5:
-            self._conn = klass(parsed_url.netloc)
-        else:
-            self._conn = klass(parsed_url.netloc, timeout=30)
+        self._path = urlparse.urlparse(self.yourls_api_url).path or "/"
+        self._pool = connections.get(self.yourls_api_url)
 
     def fetch(self, code):
         params = {"action": "expand", "shorturl": code, "format": "simple"}
         try:
-            self._conn.request("GET", self._path + "?" + urllib.urlencode(params))
-            resp = self._conn.getresponse()
-            data = resp.read()
+            resp, data = self._pool.request("GET", self._path + "?" + urllib.urlencode(params))
         except httplib.HTTPException, e:
-            self._conn.close()
             raise exceptions.ServiceException("HTTP exception: %s" % e)
         except socket.error, e:
-            self._conn.close()
             raise exceptions.ServiceException("Socket error: %s" % e)
 
         if resp.status == 200:
             if data == "not found":
                 raise exceptions.NoRedirectException()
             return data
+        elif resp.status in [420, 429]:
+            raise exceptions.BlockedException()
         raise exceptions.ServiceException("Unexpected HTTP status %i" % resp.status)
 
 class Bitly(HTTPService):
@@ -272,6 +334,10 @@ class Bitly(HTTPService):
     def url(self):
         return "http://bit.ly/"
 
+    @property
+    def http_pipelining(self):
+        return True
+
     def fetch(self, code):
         resp = self._http_head(code)
 
@@ -282,9 +348,7 @@ class Bitly(HTTPService):
             if resp.reason == "Moved":  # Normal bit.ly redirect
                 return location
             elif resp.reason == "Moved Permanently":
-                # Weird "bundles" redirect, forces connection close despite
-                # sending Keep-Alive header
-                self._conn.close()
+                # Weird "bundles" redirect, see http_reuse_connection
                 raise exceptions.CodeBlockedException()
             else:
                 raise exceptions.ServiceException("Unknown HTTP reason %s after HTTP status 301" % resp.reason)
@@ -293,7 +357,7 @@ class Bitly(HTTPService):
             if not location:
                 raise exceptions.ServiceException("No Location header after HTTP status 302")
             return self._parse_warning_url(code, location)
-        elif resp.status == 403:
+        elif resp.status in [403, 420, 429]:
             raise exceptions.BlockedException()
         elif resp.status == 404:
             raise exceptions.NoRedirectException()
@@ -302,6 +366,11 @@ class Bitly(HTTPService):
         else:
             raise exceptions.ServiceException("Unknown HTTP status %i" % resp.status)
 
+    def http_reuse_connection(self, resp):
+        # Weird "bundles" redirect forces connection close despite sending
+        # Keep-Alive header
+        return not (resp.status == 301 and resp.reason == "Moved Permanently")
+
     def _parse_warning_url(self, code, url):
         url = urlparse.urlparse(url)
         if url.scheme != "http" or url.netloc != "bit.ly" or url.path != "/a/warning":
@@ -337,11 +406,21 @@ class Isgd(SimpleService):
         """
         return [502]
 
+    _blocked_rule = parsers.Rule("<p>For reference and to help those fighting spam the original destination of this URL is given below \(we strongly recommend you don't visit it since it may damage your PC\): -<br />(.*)</p><h2>is\.gd</h2><p>is\.gd is a free service used to shorten long URLs\.",
+        final="\n", marker="<div id=\"disabled\"><h2>Link Disabled</h2>")
+    _preview_rule = parsers.Rule("<b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"(.*)\" class=\"biglink\">",
+        final="\n")
+    _parser = parsers.Parser(_blocked_rule, _preview_rule)
+
+    @property
+    def http_parser(self):
+        return self._parser
+
     def unexpected_http_status(self, code, resp):
         if resp.status != 200:
             return super(Isgd, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_get(code, resp)
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
 
@@ -355,23 +434,19 @@ class Isgd(SimpleService):
             return self._parse_preview(code, data)
 
     def _parse_blocked(self, code, data):
-        match = re.search("<p>For reference and to help those fighting spam the original destination of this URL is given below \(we strongly recommend you don't visit it since it may damage your PC\): -<br />(.*)</p><h2>is\.gd</h2><p>is\.gd is a free service used to shorten long URLs\.", data)
-        if not match:
+        url = self._blocked_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL in 'Link Disabled' page")
 
-        url = match.group(1).decode("utf-8")
-        url = HTMLParser.HTMLParser().unescape(url).encode("utf-8")
         if url == "":
             raise exceptions.CodeBlockedException("Empty URL on preview")
         return url
 
     def _parse_preview(self, code, data):
-        match = re.search("<b>Click the link</b> if you'd like to proceed to the destination shown: -<br /><a href=\"(.*)\" class=\"biglink\">", data)
-        if not match:
+        url = self._preview_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL in 'Preview' page")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
 
 class Owly(SimpleService):
@@ -387,20 +462,29 @@ class Owly(SimpleService):
     def url(self):
         return "http://ow.ly/"
 
+    @property
+    def http_pipelining(self):
+        return True
+
+    _warning_rule = parsers.Rule("<a class=\"btn ignore\" href=\"(.*?)\" title=", final="")
+    _parser = parsers.Parser(_warning_rule)
+
+    @property
+    def http_parser(self):
+        return self._parser
+
     def unexpected_http_status(self, code, resp):
         if resp.status != 200:
             return super(Owly, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_get(code, resp)
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
 
-        match = re.search("<a class=\"btn ignore\" href=\"(.*?)\" title=", data)
-        if not match:
+        url = self._warning_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL in safety warning")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
 
 class Tinyurl(HTTPService):
@@ -416,11 +500,28 @@ class Tinyurl(HTTPService):
     def url(self):
         return "http://tinyurl.com/"
 
+    @property
+    def http_pipelining(self):
+        return True
+
+    _errorhelp_rule = parsers.Rule('<meta http-equiv="refresh" content="0;url=(.*?)">',
+        final="", marker="<title>Redirecting...</title>", unescape=False)
+    _tinyurl_redirect_rule = parsers.Rule("<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site\\. The URL it redirects to is <a href=\"(.*?)\">",
+        re.DOTALL, final="", marker="Error: TinyURL redirects to a TinyURL.")
+    _preview_rule = parsers.Rule("<a id=\"redirecturl\" href=\"(.*?)\">Proceed to this site.</a>",
+        re.DOTALL, final="")
+    _parser = parsers.Parser(_errorhelp_rule, _tinyurl_redirect_rule)
+    _preview_parser = parsers.Parser(_preview_rule)
+
+    @property
+    def http_parser(self):
+        return self._parser
+
     def fetch(self, code):
         resp = self._http_head(code)
 
         if resp.status == 200:
-            return self._fetch_200(code)
+            return self._fetch_200(code, resp)
         elif resp.status == 301:
             location = resp.getheader("Location")
             if not location:
@@ -433,17 +534,23 @@ class Tinyurl(HTTPService):
             raise exceptions.CodeBlockedException()
         elif resp.status == 404:
             raise exceptions.NoRedirectException()
+        elif resp.status in [420, 429]:
+            raise exceptions.BlockedException()
         elif resp.status == 500:
-            # Some "errorhelp" URLs result in HTTP status 500, which goes away when trying a different server
-            self._conn.close()
+            # Some "errorhelp" URLs result in HTTP status 500, see http_reuse_connection
             raise exceptions.ServiceException("HTTP status 500")
         else:
             raise exceptions.ServiceException("Unknown HTTP status %i" % resp.status)
 
         return resp.status
 
-    def _fetch_200(self, code):
-        resp, data = self._http_get(code)
+    def http_reuse_connection(self, resp):
+        # Some "errorhelp" URLs result in HTTP status 500, which goes away when
+        # trying a different server
+        return resp.status != 500
+
+    def _fetch_200(self, code, first):
+        resp, data = self._http_get(code, first)
 
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
@@ -456,10 +563,10 @@ class Tinyurl(HTTPService):
             raise exceptions.ServiceException("Unexpected response on status 200")
 
     def _parse_errorhelp(self, code, data):
-        match = re.search('<meta http-equiv="refresh" content="0;url=(.*?)">', data)
-        if not match:
+        url = self._errorhelp_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("No redirect on \"errorhelp\" page on HTTP status 200")
-        url = urlparse.urlparse(match.group(1))
+        url = urlparse.urlparse(url)
         if url.scheme != "http" or url.netloc != "tinyurl.com" or url.path != "/errorb.php":
             raise exceptions.ServiceException("Unexpected redirect on \"errorhelp\" page  on HTTP status 200")
         query = urlparse.parse_qs(url.query)
@@ -471,27 +578,24 @@ class Tinyurl(HTTPService):
         return query["url"][0]
 
     def _parse_tinyurl_redirect(self, data):
-        match = re.search("<p class=\"intro\">The URL you followed redirects back to a TinyURL and therefore we can't directly send you to the site\\. The URL it redirects to is <a href=\"(.*?)\">", data, re.DOTALL)
-        if not match:
+        url = self._tinyurl_redirect_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("No redirect on \"tinyurl redirect\" page on HTTP status 200")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
     def _preview(self, code, affiliate_url):
-        resp, data = self._http_get("preview.php?num=" + code)
+        resp, data = self._http_get("preview.php?num=" + code, parser=self._preview_parser)
 
         if resp.status != 200:
             raise exceptions.ServiceException("Unexpected HTTP status %i on preview page" % resp.status)
 
-        match = re.search("<a id=\"redirecturl\" href=\"(.*?)\">Proceed to this site.</a>", data, re.DOTALL)
-        if not match:
+        url = self._preview_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("No redirect on preview page")
 
-        url = match.group(1).decode("utf-8")
         if url == "":
             return self._scrub_url(code, affiliate_url)
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
     def _scrub_url(self, code, url):
         parsed_url = urlparse.urlparse(url)
@@ -519,6 +623,10 @@ class Ur1ca(SimpleService):
     def url(self):
         return "http://ur1.ca/"
 
+    @property
+    def http_pipelining(self):
+        return True
+
     @property
     def http_status_no_redirect(self):
         return [200]
@@ -544,6 +652,14 @@ class Snipurl(SimpleService):
     def http_keepalive(self):
         return False
 
+    _preview_rule = parsers.Rule("<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>(.*?)</div> <br />",
+        final="")
+    _parser = parsers.Parser(_preview_rule)
+
+    @property
+    def http_parser(self):
+        return self._parser
+
     def fetch(self, code):
         location = super(Snipurl, self).fetch(code)
         try:
@@ -557,16 +673,14 @@ class Snipurl(SimpleService):
         if resp.status != 500:
             return super(Snipurl, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_get(code, resp)
         if resp.status != 500:
             raise exceptions.ServiceException("HTTP status changed from 500 to %i on second request" % resp.status)
 
-        match = re.search("<p>You clicked on a snipped URL, which will take you to the following looong URL: </p> <div class=\"quote\"><span class=\"quotet\"></span><br/>(.*?)</div> <br />", data)
-        if not match:
+        url = self._preview_rule.extract(data)
+        if url is None:
             raise exceptions.ServiceException("Could not find target URL on preview page")
-
-        url = match.group(1).decode("utf-8")
-        return HTMLParser.HTMLParser().unescape(url).encode("utf-8")
+        return url
 
 class Googl(Service):
     """
@@ -581,30 +695,28 @@ class Googl(Service):
     def charset(self):
         return "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
-    def __init__(self):
-        host = "www.googleapis.com"
+    @property
+    def api_url(self):
+        """
+        The endpoint of the URL shortener API
+        """
+        return "https://www.googleapis.com/urlshortener/v1/url"
 
-        version = platform.python_version_tuple()
-        if int(version[0]) == 2 and int(version[1]) <= 5:
-            self._conn = httplib.HTTPSConnection(host)
-        else:
-            self._conn = httplib.HTTPSConnection(host, timeout=30)
+    def __init__(self):
+        self._path = urlparse.urlparse(self.api_url).path
+        self._pool = connections.get(self.api_url)
 
     def fetch(self, code):
         try:
-            self._conn.request("GET", "/urlshortener/v1/url?shortUrl=http://goo.gl/%s" % code)
-            resp = self._conn.getresponse()
-            data = resp.read()
+            resp, data = self._pool.request("GET", "%s?shortUrl=http://goo.gl/%s" % (self._path, code))
         except httplib.HTTPException, e:
-            self._conn.close()
             raise exceptions.ServiceException("HTTP exception: %s" % e)
         except socket.error, e:
-            self._conn.close()
             raise exceptions.ServiceException("Socket error: %s" % e)
 
         if resp.status == 200:
             return self._parse_json(data)
-        elif resp.status == 403:
+        elif resp.status in [403, 420, 429]:
             raise exceptions.BlockedException()
         elif resp.status == 404:
             raise exceptions.NoRedirectException()
@@ -696,6 +808,10 @@ class Wpme(SimpleService):
     def url(self):
         return "http://wp.me/"
 
+    @property
+    def http_pipelining(self):
+        return True
+
 
 class BaseVisibliService(SimpleService):
     @property
@@ -715,6 +831,13 @@ class BaseVisibliService(SimpleService):
         return {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.8.3) "
             "Gecko/20120431 Firefox/18.0"}
 
+    _iframe_rule = parsers.Rule(r'<iframe id="[^"]+" src="([^"]+)">', final="")
+    _parser = parsers.Parser(_iframe_rule)
+
+    @property
+    def http_parser(self):
+        return self._parser
+
     def unexpected_http_status(self, code, resp):
         if resp.status == 302:
             location = resp.getheader("Location")
@@ -728,21 +851,18 @@ class BaseVisibliService(SimpleService):
             return location
 
         if resp.status != 200:
-            return super(BaseVisbliService, self).unexpected_http_status(code, resp)
+            return super(BaseVisibliService, self).unexpected_http_status(code, resp)
 
-        resp, data = self._http_get(code)
+        resp, data = self._http_get(code, resp)
         if resp.status != 200:
             raise exceptions.ServiceException("HTTP status changed from 200 to %i on second request" % resp.status)
 
-        match = re.search(r'<iframe id="[^"]+" src="([^"]+)">', data)
-        if not match:
+        url = self._iframe_rule.extract(data)
+        if url is None:
             if 'Undefined index:  HTTP_USER_AGENT' in data:
                 raise exceptions.ServiceException("Website broken about user-agent")
 
             raise exceptions.ServiceException("No iframe url found")
-
-        url = match.group(1).decode("utf-8")
-        url = HTMLParser.HTMLParser().unescape(url).encode("utf-8")
         return url
 
 
@@ -827,8 +947,19 @@ _factory_map = {
 
 
 def factory(name):
+    return factory_class(name)()
+
+
+def factory_class(name):
     service = _factory_map.get(name)
     if not service:
         raise ValueError("Unknown service %s" % name)
     else:
-        return service()
+        return service
+
+
+def register(name, klass):
+    """
+    Make the service class klass available to factory under name
+    """
+    _factory_map[name] = klass
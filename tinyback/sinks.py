@@ -0,0 +1,162 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.sinks - Destinations for the results of a task
+
+A sink is used for a single task. Reaper.run calls open with the task and
+writes the compressed results to the file object it returns, then calls
+close. close returns a file with the results that still have to be uploaded
+to the tracker, or None if the sink has already delivered them. If the task
+fails, abort is called instead of close.
+"""
+
+import errno
+import logging
+import os
+import re
+import tempfile
+
+class TemporaryFileSink:
+    """
+    Results go to an anonymous temporary file
+    """
+
+    def __init__(self, temp_dir=None):
+        self._temp_dir = temp_dir
+        self._fileobj = None
+
+    def open(self, task):
+        self._fileobj = tempfile.TemporaryFile(dir=self._temp_dir)
+        return self._fileobj
+
+    def close(self):
+        return self._fileobj
+
+    def abort(self):
+        self._fileobj.close()
+
+class MemorySink:
+    """
+    Results are kept in memory, unless they grow beyond max_size bytes
+
+    Larger results are moved to a temporary file in temp_dir.
+    """
+
+    def __init__(self, max_size=16 * 1024 * 1024, temp_dir=None):
+        self._max_size = max_size
+        self._temp_dir = temp_dir
+        self._fileobj = None
+
+    def open(self, task):
+        self._fileobj = tempfile.SpooledTemporaryFile(self._max_size, dir=self._temp_dir)
+        return self._fileobj
+
+    def close(self):
+        return self._fileobj
+
+    def abort(self):
+        self._fileobj.close()
+
+class ArchiveSink:
+    """
+    Results are kept in directory, as SERVICE/ID.gz
+
+    The files stay there after they have been uploaded.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._fileobj = None
+
+    def open(self, task):
+        directory = os.path.join(self._directory, _filename(task["service"]))
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = os.path.join(directory, _filename(str(task["id"])) + ".gz")
+        self._fileobj = open(path, "w+b")
+        return self._fileobj
+
+    def close(self):
+        self._fileobj.flush()
+        return self._fileobj
+
+    def abort(self):
+        self._fileobj.close()
+
+class StreamSink:
+    """
+    Results are uploaded to the tracker while the task is running
+
+    A copy of the results is kept (see MemorySink). If the upload fails at
+    any point, close returns that copy, so the results can be uploaded the
+    usual way.
+    """
+
+    def __init__(self, tracker, username=None, max_size=16 * 1024 * 1024, temp_dir=None):
+        self._log = logging.getLogger("tinyback.sinks")
+        self._tracker = tracker
+        self._username = username
+        self._copy = MemorySink(max_size, temp_dir)
+        self._fileobj = None
+        self._upload = None
+
+    def open(self, task):
+        self._fileobj = self._copy.open(task)
+        try:
+            self._upload = self._tracker.put_stream(task, self._username)
+        except Exception, e:
+            self._log.info("Could not start upload (%s), uploading when done" % e)
+        return self
+
+    def write(self, data):
+        self._fileobj.write(data)
+        if self._upload:
+            try:
+                self._upload.write(data)
+            except Exception, e:
+                self._abort(e)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def close(self):
+        if self._upload:
+            try:
+                self._upload.finish()
+            except Exception, e:
+                self._abort(e)
+            else:
+                self._fileobj.close()
+                return None
+        return self._copy.close()
+
+    def abort(self):
+        if self._upload:
+            self._upload.abort()
+            self._upload = None
+        self._copy.abort()
+
+    def _abort(self, e):
+        self._log.info("Upload failed (%s), uploading when done" % e)
+        self._upload.abort()
+        self._upload = None
+
+def _filename(name):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", name)
@@ -0,0 +1,240 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.spool - Local store for results that could not be uploaded
+
+Each spooled task consists of the result file (NAME.gz) and the task itself
+(NAME.task). Both are written to temporary files, synced and renamed into
+place, results first, so a task file always refers to complete results. The
+spool survives restarts; a Sender drains it in the background.
+
+Tasks are uploaded oldest first. A task the tracker keeps rejecting is moved
+to the back of the queue after MAX_FAILURES attempts, so it does not hold
+up the others.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from tinyback import exceptions, tracker
+
+class Spool:
+    """
+    Directory of results waiting for upload
+
+    If quota is given, the results in the spool never take up more than
+    quota bytes.
+    """
+
+    # Failed uploads of a task before it goes to the back of the queue
+    MAX_FAILURES = 3
+    # Files without a task file are left alone for this many seconds, they
+    # may still be in the middle of being added
+    ORPHAN_AGE = 3600
+
+    def __init__(self, directory, quota=None):
+        self._log = logging.getLogger("tinyback.spool")
+        self.directory = directory
+        self.quota = quota
+        self._lock = threading.Lock()
+        self._failures = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def add(self, task, fileobj):
+        """
+        Store the results of task
+
+        Raises SpoolFullException if the results would exceed the quota.
+        """
+        fileobj.seek(0, os.SEEK_END)
+        length = fileobj.tell()
+        fileobj.seek(0)
+
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", "%s-%s" % (task["service"], task["id"]))
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if self.quota is not None and self.size() + length > self.quota:
+                raise exceptions.SpoolFullException("Spool is full")
+            self._write(path + ".gz", lambda f: shutil.copyfileobj(fileobj, f))
+            self._write(path + ".task", lambda f: json.dump(task, f))
+        self._log.info("Spooled results for task %s" % task["id"])
+
+    def size(self):
+        """
+        Return the number of bytes used by spooled results
+        """
+        size = 0
+        for path in glob.glob(os.path.join(self.directory, "*.gz")):
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+    def pending(self):
+        """
+        Return the names of all spooled tasks, oldest first
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, "*.task")):
+            try:
+                entries.append((os.path.getmtime(path), path[:-len(".task")]))
+            except OSError:
+                pass
+        return [os.path.basename(path) for mtime, path in sorted(entries)]
+
+    def send(self, tracker, username=None):
+        """
+        Upload all spooled tasks
+
+        Tasks that are being uploaded by another thread or process are
+        skipped. Returns the number of tasks uploaded; tracker errors are
+        passed on.
+        """
+        sent = 0
+        for name in self.pending():
+            path = os.path.join(self.directory, name)
+            try:
+                f = open(path + ".task", "r")
+                try:
+                    task = json.load(f)
+                finally:
+                    f.close()
+                fileobj = open(path + ".gz", "rb")
+            except (IOError, ValueError):
+                continue
+
+            try:
+                if fcntl:
+                    try:
+                        fcntl.flock(fileobj.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        continue
+                # Another sender may have finished this task in the meantime
+                if not os.path.exists(path + ".task"):
+                    continue
+                try:
+                    tracker.put(task, fileobj, username)
+                except:
+                    self._failed(name)
+                    raise
+                self._failures.pop(name, None)
+                os.unlink(path + ".task")
+                os.unlink(path + ".gz")
+                sent += 1
+            finally:
+                fileobj.close()
+        return sent
+
+    def clean(self):
+        """
+        Remove result and temporary files that belong to no task
+
+        These are left over when a process dies while adding a task.
+        """
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, "*.gz")) + glob.glob(os.path.join(self.directory, "*.tmp")):
+            if path.endswith(".gz") and os.path.exists(path[:-len(".gz")] + ".task"):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.ORPHAN_AGE:
+                    os.unlink(path)
+                    self._log.info("Removed orphaned file %s" % path)
+            except OSError:
+                pass
+
+    def _failed(self, name):
+        """
+        Count a failed upload, moving the task to the back of the queue
+        """
+        failures = self._failures.get(name, 0) + 1
+        if failures < self.MAX_FAILURES:
+            self._failures[name] = failures
+            return
+        self._failures.pop(name, None)
+        self._log.warn("Upload of spooled task %s failed %i times, trying the others first" % (name, failures))
+        try:
+            os.utime(os.path.join(self.directory, name + ".task"), None)
+        except OSError:
+            pass
+
+    def _write(self, path, write):
+        temp_file = "%s.%i.tmp" % (path, os.getpid())
+        f = open(temp_file, "wb")
+        try:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_file, path)
+
+class Sender(threading.Thread):
+    """
+    Background thread that drains a spool
+
+    After a tracker error, the sender backs off exponentially. Otherwise it
+    looks at the spool every interval seconds, or when notify is called
+    because something was added. Call stop to end the thread.
+    """
+
+    def __init__(self, spool, tracker, username=None, interval=60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._log = logging.getLogger("tinyback.spool")
+        self._spool = spool
+        self._tracker = tracker
+        self._username = username
+        self._interval = interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def notify(self):
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    def run(self):
+        self._spool.clean()
+        backoff = tracker.Backoff()
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                sent = self._spool.send(self._tracker, self._username)
+            except Exception, e:
+                wait = backoff.failure()
+                self._log.info("Error uploading spooled results (%s) - Retrying in %i seconds" % (e, wait))
+                self._stopping.wait(wait)
+                continue
+            backoff.reset()
+            if sent:
+                self._log.info("Uploaded %i spooled tasks" % sent)
+            self._wakeup.wait(self._interval)
@@ -0,0 +1,173 @@
+# TinyBack - A tiny web scraper
+# Copyright (C) 2012 David Triendl
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+tinyback.strategy - Choose between HEAD and GET for the first request
+
+HTTP services look at a code with a HEAD request. Most codes are answered by
+the status and headers alone, but some (preview and warning pages) need the
+page itself, so the service sends a second request, this time a GET. For
+services where that happens for most codes, the second round trip is wasted.
+
+Every service has a Strategy, shared by all Reapers of the process, that
+keeps a running rate of the codes that needed the body. Once the rate rises
+above GET_RATE, the first request is a GET and the body (up to the limit of
+the service, see HTTPService.http_body_limit) is kept for the parser. When
+the rate falls below HEAD_RATE, the service goes back to HEAD requests and
+to pipelining, if it supports that.
+
+Results do not depend on the strategy: a body that was cut off at the limit
+is never parsed, the service requests the whole page instead.
+"""
+
+import logging
+import threading
+
+class Strategy:
+    """
+    Fetch strategy and hit rates for one service
+    """
+
+    # Weight of the latest code in the running rate
+    WEIGHT = 0.02
+    # Codes to see before the first switch
+    SAMPLES = 50
+    # Switch to GET when the body was needed for more than this share of codes
+    GET_RATE = 0.5
+    # Switch back to HEAD when the share drops below this
+    HEAD_RATE = 0.3
+
+    def __init__(self, name, mode="auto"):
+        self._log = logging.getLogger("tinyback.strategy")
+        self.name = name
+        self.mode = mode
+        self.codes = 0
+        self.bodies = 0
+        self.saved = 0
+        self.refetched = 0
+        self.switches = 0
+        self.rate = 0.0
+        self._get = mode == "get"
+        self._lock = threading.Lock()
+
+    @property
+    def get(self):
+        """
+        Whether the first request for a code should be a GET
+        """
+        return self._get
+
+    def request(self):
+        """
+        Count the first request for a code
+        """
+        with self._lock:
+            self.codes += 1
+            self.rate *= 1 - self.WEIGHT
+            self._decide()
+
+    def body(self, saved, truncated=False):
+        """
+        Count a code that needed the body
+
+        saved is true if the body of the first request could be used,
+        truncated is true if it could not because it was cut off.
+        """
+        with self._lock:
+            self.bodies += 1
+            if saved:
+                self.saved += 1
+            if truncated:
+                self.refetched += 1
+            self.rate += self.WEIGHT
+            self._decide()
+
+    def stats(self):
+        """
+        Return the counters and the current decision as a dictionary
+        """
+        with self._lock:
+            return {
+                "name": self.name,
+                "mode": self.mode,
+                "method": "GET" if self._get else "HEAD",
+                "codes": self.codes,
+                "bodies": self.bodies,
+                "saved": self.saved,
+                "refetched": self.refetched,
+                "switches": self.switches,
+                "rate": self.rate,
+            }
+
+    def summary(self):
+        stats = self.stats()
+        share = 100.0 * stats["bodies"] / stats["codes"] if stats["codes"] else 0
+        return ("%(name)s: %(method)s first (%(mode)s), " % stats
+            + "body needed for %.1f%% of %i codes (recent %.1f%%), " % (share, stats["codes"], 100 * stats["rate"])
+            + "%(saved)i second requests saved, %(refetched)i bodies cut off, %(switches)i switches" % stats)
+
+    def _decide(self):
+        if self.mode != "auto" or self.codes < self.SAMPLES:
+            return
+        if not self._get and self.rate > self.GET_RATE:
+            self._get = True
+        elif self._get and self.rate < self.HEAD_RATE:
+            self._get = False
+        else:
+            return
+        self.switches += 1
+        self._log.info("Switching %s to %s first, body needed for %.1f%% of recent codes"
+            % (self.name, "GET" if self._get else "HEAD", 100 * self.rate))
+
+_mode = "auto"
+_strategies = {}
+_lock = threading.Lock()
+
+def configure(mode):
+    """
+    Set the mode of all (current and future) strategies
+
+    mode is one of "auto" (decide by the hit rates), "head" or "get" (always
+    send that request first).
+    """
+    global _mode
+    if mode not in ("auto", "head", "get"):
+        raise ValueError("Unknown strategy mode %s" % mode)
+    with _lock:
+        _mode = mode
+        for strategy in _strategies.values():
+            with strategy._lock:
+                strategy.mode = mode
+                if mode != "auto":
+                    strategy._get = mode == "get"
+
+def get(name):
+    """
+    Return the process-wide strategy for the service called name
+    """
+    with _lock:
+        strategy = _strategies.get(name)
+        if not strategy:
+            strategy = _strategies[name] = Strategy(name, _mode)
+        return strategy
+
+def strategies():
+    """
+    Return the strategies of all services that have been used, sorted by name
+    """
+    with _lock:
+        used = [strategy for strategy in _strategies.values() if strategy.codes]
+    return sorted(used, key=lambda strategy: strategy.name)
@@ -1,20 +1,71 @@
 import httplib
 import json
 import logging
+import os
+import random
+import socket
+import threading
+import time
 import urllib
 import urlparse
+import zlib
 
 import tinyback
 
+class Backoff:
+    """
+    Exponential backoff for retrying requests to the tracker
+
+    The delay doubles with every failure, up to maximum seconds. Each delay
+    is randomized to between half and all of that, so clients that failed
+    at the same time do not all come back at the same time.
+    """
+
+    def __init__(self, initial=5, maximum=600):
+        self.initial = initial
+        self.maximum = maximum
+        self.failures = 0
+
+    def failure(self):
+        """
+        Record a failure and return the number of seconds to wait
+        """
+        delay = min(self.initial * 2 ** self.failures, self.maximum)
+        if delay < self.maximum:
+            self.failures += 1
+        return delay * random.uniform(0.5, 1)
+
+    def reset(self):
+        self.failures = 0
+
 class Tracker:
+    """
+    Client for the tracker
 
-    def __init__(self, tracker_url):
+    Every thread keeps its own persistent connection to the tracker. A
+    request on a connection that turns out to be closed is retried once on a
+    new connection. Responses may be gzip-compressed, uploads are streamed
+    from the data file.
+    """
+
+    # Size of the blocks an upload is sent in
+    CHUNK_SIZE = 65536
+
+    def __init__(self, tracker_url, timeout=60, connect_timeout=10):
         self._log = logging.getLogger("tinyback.Tracker")
         self._log.info("Initializing tracker at %s" % tracker_url)
 
         if tracker_url[-1] != "/":
             tracker_url += "/"
         self._url = urlparse.urlparse(tracker_url)
+        if self._url.scheme == "https":
+            self._klass = httplib.HTTPSConnection
+        else:
+            self._klass = httplib.HTTPConnection
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._local = threading.local()
+        self._batches = True
 
     def clear(self):
         self._log.info("Clearing all tasks")
@@ -33,15 +84,77 @@ class Tracker:
             self._log.info("No tasks available")
         return task
 
+    def fetch_many(self, count):
+        """
+        Lease up to count tasks with a single request
+
+        Returns a list of tasks and the time (as returned by time.time())
+        their lease expires, or None if the tracker did not say. After that,
+        the tracker hands the tasks out again. If the tracker does not
+        support batches, it returns a single task and all further calls
+        fetch single tasks.
+        """
+        if count == 1 or not self._batches:
+            task = self.fetch()
+            return ([task] if task else []), None
+
+        status, data = self._request("GET", "task/get", {"count": count})
+        if status != httplib.OK:
+            raise Exception("Unexpected status %i" % status)
+        data = json.loads(data)
+        if isinstance(data, dict) and "tasks" in data:
+            expires = None
+            if data.get("lease"):
+                expires = time.time() + data["lease"]
+            self._log.info("Received %i tasks" % len(data["tasks"]))
+            return data["tasks"], expires
+
+        self._log.info("Tracker does not support batches, fetching single tasks")
+        self._batches = False
+        if data:
+            self._log.info("Received task %s for service %s" % (data["id"], data["service"]))
+            return [data], None
+        self._log.info("No tasks available")
+        return [], None
+
     def put(self, task, data_file, username=None):
+        """
+        Upload the results of task
+
+        If the task has a skipped entry (see Reaper.codes_skipped), the
+        number of codes left out of the results is sent along.
+        """
         task_id = task["id"]
-        data_file.seek(0)
 
         params = {"id": task_id}
         if username:
             params["username"] = username
+        if task.get("skipped"):
+            params["skipped"] = task["skipped"]
 
         status, task= self._request("POST", "task/put", params, data_file)
+        self._check_put(task_id, status)
+
+    def put_stream(self, task, username=None):
+        """
+        Start uploading the results of task while they are being written
+
+        Returns an Upload. The results are sent with chunked transfer
+        encoding, on a connection of their own.
+        """
+        params = {"id": task["id"]}
+        if username:
+            params["username"] = username
+
+        conn = self._klass(self._url.netloc, timeout=self._connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self._timeout)
+        conn.putrequest("POST", self._path("task/put", params), skip_accept_encoding=True)
+        conn.putheader("Transfer-Encoding", "chunked")
+        conn.endheaders()
+        return Upload(self, conn, task["id"])
+
+    def _check_put(self, task_id, status):
         if status == httplib.CONFLICT:
             self._log.warn("Server refused data for task %s" % task_id)
         elif status == httplib.OK:
@@ -49,22 +162,108 @@ class Tracker:
         else:
             raise Exception("Unexpected status %i" % status)
 
-    def _request(self, method, path, params={}, body=None):
+    def _path(self, path, params):
+        params = dict(params or {})
         params["version"] = tinyback.__version__
 
-        conn = httplib.HTTPConnection(self._url.netloc)
         path = self._url.path + path
         if len(params):
             path += "?" + urllib.urlencode(params)
+        return path
 
-        if body:
-            conn.request(method, path, body=body)
-        else:
-            conn.request(method, path)
+    def _request(self, method, path, params=None, body=None):
+        path = self._path(path, params)
+
+        for attempt in range(2):
+            conn, reused = self._connection()
+            try:
+                self._send(conn, method, path, body)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (httplib.HTTPException, socket.error), e:
+                self._close()
+                if not reused or attempt:
+                    raise
+                self._log.debug("Tracker connection was closed (%s), reconnecting" % e)
+                continue
+            if resp.will_close:
+                self._close()
+            break
 
-        resp = conn.getresponse()
+        if resp.getheader("Content-Encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
         if resp.status == 403:
             self._log.warn("Received 403 Forbidden from tracker")
-            self._log.warn("Tracker says: %s" % resp.read())
+            self._log.warn("Tracker says: %s" % data)
             raise Exception("403 Forbidden")
-        return (resp.status, resp.read())
+        return (resp.status, data)
+
+    def _send(self, conn, method, path, body):
+        """
+        Send a request, streaming the body from a file if there is one
+        """
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        conn.putheader("Accept-Encoding", "gzip")
+        if body is None:
+            conn.endheaders()
+            return
+
+        body.seek(0, os.SEEK_END)
+        conn.putheader("Content-Length", str(body.tell()))
+        body.seek(0)
+        conn.endheaders()
+        while True:
+            chunk = body.read(self.CHUNK_SIZE)
+            if not chunk:
+                break
+            conn.send(chunk)
+
+    def _connection(self):
+        """
+        Return the connection of the current thread and whether it was used before
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn:
+            return conn, True
+        conn = self._klass(self._url.netloc, timeout=self._connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self._timeout)
+        self._local.conn = conn
+        return conn, False
+
+    def _close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn:
+            conn.close()
+            self._local.conn = None
+
+class Upload:
+    """
+    Upload in progress, see Tracker.put_stream
+    """
+
+    def __init__(self, tracker, conn, task_id):
+        self._tracker = tracker
+        self._conn = conn
+        self._task_id = task_id
+
+    def write(self, data):
+        if data:
+            self._conn.send("%x\r\n%s\r\n" % (len(data), data))
+
+    def finish(self):
+        """
+        Complete the upload and check the tracker's response
+        """
+        try:
+            self._conn.send("0\r\n\r\n")
+            resp = self._conn.getresponse()
+            data = resp.read()
+        finally:
+            self._conn.close()
+        if resp.status == 403:
+            raise Exception("403 Forbidden: %s" % data)
+        self._tracker._check_put(self._task_id, resp.status)
+
+    def abort(self):
+        self._conn.close()